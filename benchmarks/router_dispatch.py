@@ -0,0 +1,30 @@
+# Times UpdateRouter.dispatch_message with N and 10N routed button texts.
+# A dict lookup keeps the two close; a linear scan would be about ten times
+# slower with 10N. Run from the repository root:
+#
+#     python benchmarks/router_dispatch.py
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("SESSION_STORE", "memory")
+os.environ.setdefault("CONVERSATION_STORE", "memory")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+def dispatch_cost(actions, repeat=5, number=2000):
+    router = bot.UpdateRouter()
+    for index in range(actions):
+        router.text(f'action {index}')(lambda message: None)
+    # The last registered text is the worst case for a linear scan.
+    message = SimpleNamespace(chat=SimpleNamespace(id=1), text=f'action {actions - 1}')
+    return min(timeit.repeat(lambda: router.dispatch_message(message), repeat=repeat, number=number)) / number
+
+if __name__ == '__main__':
+    small = dispatch_cost(30)
+    large = dispatch_cost(300)
+    print(f"30 actions:  {small * 1e6:.2f}us per dispatch")
+    print(f"300 actions: {large * 1e6:.2f}us per dispatch ({large / small:.2f}x)")
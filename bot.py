@@ -3,12 +3,41 @@
 import telebot
 from telebot import types
 import psycopg2
+import psycopg2.extensions
+import psycopg2.errors
 from psycopg2 import Error
-from datetime import datetime, timedelta
+from psycopg2.pool import PoolError
+from datetime import date, datetime, timedelta
+import asyncio
+import contextvars
 import os
+import re
+import time
+import runpy
+import hashlib
+import hmac
+import json
+import select
+import secrets
+import sys
+import threading
+import random
+import urllib.request
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import chain
 from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unidecode import unidecode
 
+# Only BOT_MODE=asyncio needs these.
+try:
+    import greenlet
+    import psycopg
+    import psycopg_pool
+except ImportError:
+    greenlet = psycopg = psycopg_pool = None
+
 # endregion
 
 # region --------------------- Environment Variables ---------------------
@@ -18,15 +47,1697 @@ DB_URI = os.environ.get("DB_URI")
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME")  
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD")  
 
-bot = telebot.TeleBot(BOT_TOKEN) # type: ignore
-user_sessions = {}
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800"))
+DB_POOL_HEALTH_CHECK_IDLE = float(os.environ.get("DB_POOL_HEALTH_CHECK_IDLE", "30"))
+DB_PREPARED_STATEMENTS = os.environ.get("DB_PREPARED_STATEMENTS", "on")
+QUERY_SLOW_MS = float(os.environ.get("QUERY_SLOW_MS", "250"))
+QUERY_SLOW_LOG = os.environ.get("QUERY_SLOW_LOG", "slow_queries.log")
+QUERY_EXPLAIN_INTERVAL = float(os.environ.get("QUERY_EXPLAIN_INTERVAL", "300"))
+
+LIST_PAGE_SIZE = int(os.environ.get("LIST_PAGE_SIZE", "10"))
+STREAM_ITERSIZE = int(os.environ.get("STREAM_ITERSIZE", "100"))
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "10"))
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", "100"))
+SEARCH_CONTINUATIONS_MAX = int(os.environ.get("SEARCH_CONTINUATIONS_MAX", "1000"))
+SEARCH_SKELETON_MIN_LENGTH = int(os.environ.get("SEARCH_SKELETON_MIN_LENGTH", "4"))
+ENTITY_CACHE_SIZE = int(os.environ.get("ENTITY_CACHE_SIZE", "1000"))
+ENTITY_CACHE_TTL = float(os.environ.get("ENTITY_CACHE_TTL", "60"))
+NAME_INDEX_KEEPALIVE = float(os.environ.get("NAME_INDEX_KEEPALIVE", "60"))
+NAME_INDEX_RETRY_DELAY = float(os.environ.get("NAME_INDEX_RETRY_DELAY", "5"))
+DISPATCH_GLOBAL_RATE = float(os.environ.get("DISPATCH_GLOBAL_RATE", "30"))
+DISPATCH_CHAT_RATE = float(os.environ.get("DISPATCH_CHAT_RATE", "1"))
+DISPATCH_CHAT_BURST = float(os.environ.get("DISPATCH_CHAT_BURST", "3"))
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS", "4"))
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get("DISPATCH_MAX_ATTEMPTS", "3"))
+CONVERSATION_STORE = os.environ.get("CONVERSATION_STORE", "memory")
+CONVERSATION_IDLE_TIMEOUT = float(os.environ.get("CONVERSATION_IDLE_TIMEOUT", "1800"))
+CONVERSATION_SWEEP_INTERVAL = float(os.environ.get("CONVERSATION_SWEEP_INTERVAL", "300"))
+SESSION_STORE = os.environ.get("SESSION_STORE", "postgres")
+SESSION_TTL = float(os.environ.get("SESSION_TTL", "86400"))
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", "7200"))
+SESSION_MAX_ENTRIES = int(os.environ.get("SESSION_MAX_ENTRIES", "10000"))
+SESSION_TOUCH_INTERVAL = float(os.environ.get("SESSION_TOUCH_INTERVAL", str(SESSION_IDLE_TIMEOUT / 10)))
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "8"))
+UPDATE_MAX_PENDING = int(os.environ.get("UPDATE_MAX_PENDING", "100"))
+UPDATE_MAX_CHAT_PENDING = int(os.environ.get("UPDATE_MAX_CHAT_PENDING", "5"))
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_MAX_BODY = int(os.environ.get("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+ASYNC_POLL_TIMEOUT = int(os.environ.get("ASYNC_POLL_TIMEOUT", "30"))
+ASYNC_POLL_RETRY_DELAY = float(os.environ.get("ASYNC_POLL_RETRY_DELAY", "3"))
+ASYNC_MAX_UPDATES = int(os.environ.get("ASYNC_MAX_UPDATES", "1000"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "off")
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_URL = os.environ.get("TRACE_OTLP_URL", "http://127.0.0.1:4318/v1/traces")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1"))
+TRACE_MAX_QUEUE = int(os.environ.get("TRACE_MAX_QUEUE", "10000"))
+TRACE_FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", "1"))
+
+
+# endregion
+
+# region ------------------------- Update Context -------------------------
+
+class UpdateLocal:
+    # Per-update state, used like threading.local. The sync modes run each
+    # update on a worker thread, but the asyncio mode runs many updates on
+    # the loop thread, each in a greenlet of its own. Threads and greenlets
+    # both start with an empty contextvars context, so attributes kept
+    # there stay separate per update in every mode.
+    def __init__(self, name):
+        object.__setattr__(self, '_values', contextvars.ContextVar(name))
+
+    def _dict(self):
+        values = self._values.get(None)
+        if values is None:
+            values = {}
+            self._values.set(values)
+        return values
+
+    def __getattr__(self, name):
+        try:
+            return self._dict()[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        self._dict()[name] = value
+
+# endregion
+
+# region ---------------------- Query Instrumentation ----------------------
+
+# Every cursor handed out by the pool is an InstrumentedCursor. Each
+# execute() is timed into a histogram keyed by a stable query name: the
+# function that issued it plus the prepared statement name, or a short
+# digest of the SQL text with its whitespace collapsed. Statements slower
+# than QUERY_SLOW_MS are appended to QUERY_SLOW_LOG. The queries registered
+# with prepared_query() also get an EXPLAIN (ANALYZE, BUFFERS) plan, at most
+# once per QUERY_EXPLAIN_INTERVAL for each query name, since ANALYZE runs
+# the query a second time. Nothing else is re-run: a SELECT can still take
+# an advisory lock, call nextval() or pg_notify(), or lock rows.
+
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Helpers that run SQL on behalf of their caller; the query is named after
+# the function that called them instead.
+QUERY_NAME_SKIP = {'execute', 'execute_prepared', 'execute_list_page', 'run_statement', 'sample_planning_time'}
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.errors = 0
+
+    def observe(self, elapsed_ms, rows=0, failed=False):
+        index = 0
+        while index < len(LATENCY_BUCKETS_MS) and elapsed_ms > LATENCY_BUCKETS_MS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        if rows > 0:
+            self.rows += rows
+        if failed:
+            self.errors += 1
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total_ms,
+            'avg_ms': self.total_ms / self.count if self.count else 0.0,
+            'max_ms': self.max_ms,
+            'rows': self.rows,
+            'errors': self.errors,
+            'buckets': dict(zip([*LATENCY_BUCKETS_MS, 'inf'], self.buckets)),
+        }
+
+query_histograms = {}
+pool_wait_histogram = LatencyHistogram()
+instrumentation_lock = threading.Lock()
+slow_query_explained = {}
+
+def query_name(sql):
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_name in QUERY_NAME_SKIP:
+        frame = frame.f_back
+    caller = frame.f_code.co_name if frame is not None else '?'
+
+    words = sql.split(None, 2)
+    if len(words) >= 2 and words[0].upper() == 'EXECUTE':
+        return f"{caller}:{words[1]}"
+    if len(words) >= 2 and words[0].upper() == 'PREPARE':
+        return f"{caller}:{words[1]}.prepare"
+    digest = hashlib.sha1(' '.join(sql.split()).encode()).hexdigest()[:8]
+    return f"{caller}:{digest}"
+
+def record_query(name, elapsed_ms, rows, failed):
+    with instrumentation_lock:
+        histogram = query_histograms.get(name)
+        if histogram is None:
+            histogram = query_histograms[name] = LatencyHistogram()
+        histogram.observe(elapsed_ms, rows, failed)
+
+def record_pool_wait(elapsed_ms):
+    with instrumentation_lock:
+        pool_wait_histogram.observe(elapsed_ms)
+
+def explainable(sql):
+    # Registered queries run either as EXECUTE <name> or, with prepared
+    # statements off, as their own SQL text.
+    words = sql.split(None, 2)
+    if len(words) >= 2 and words[0].upper() == 'EXECUTE':
+        return words[1] in prepared_queries
+    return sql in prepared_sql
+
+def explain_slow_query(cursor, name):
+    now = time.monotonic()
+    with instrumentation_lock:
+        last = slow_query_explained.get(name)
+        if last is not None and now - last < QUERY_EXPLAIN_INTERVAL:
+            return None
+        slow_query_explained[name] = now
+
+    connection = cursor.connection
+    in_transaction = connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    explain_cursor = connection.plain_cursor()
+    try:
+        # A savepoint keeps a failing EXPLAIN from aborting the caller's
+        # transaction.
+        if in_transaction:
+            explain_cursor.execute("SAVEPOINT explain_slow_query")
+        explain_cursor.execute(b"EXPLAIN (ANALYZE, BUFFERS) " + cursor.query)
+        plan = '\n'.join(row[0] for row in explain_cursor.fetchall())
+        if in_transaction:
+            explain_cursor.execute("RELEASE SAVEPOINT explain_slow_query")
+        return plan
+    except Error as e:
+        if in_transaction:
+            try:
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            except Error:
+                pass
+        return f"EXPLAIN failed: {e}"
+    finally:
+        explain_cursor.close()
+
+def log_slow_query(cursor, name, sql, elapsed_ms):
+    plan = explain_slow_query(cursor, name) if explainable(sql) else None
+    entry = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'query': name,
+        'elapsed_ms': round(elapsed_ms, 3),
+        'rows': cursor.rowcount,
+        'sql': cursor.query.decode(errors='replace') if cursor.query else sql,
+    }
+    if plan is not None:
+        entry['plan'] = plan
+    try:
+        with instrumentation_lock, open(QUERY_SLOW_LOG, 'a', encoding='utf-8') as log:
+            log.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    except OSError as e:
+        print(f"Slow query log error: {e}")
+
+def instrumented_execute(cursor, execute, query, vars):
+    sql = query.decode(errors='replace') if isinstance(query, bytes) else str(query)
+    name = query_name(sql)
+    failed = True
+    with span('sql', query=name) as sql_span:
+        start = time.perf_counter()
+        try:
+            result = execute(query, vars)
+            failed = False
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            record_query(name, elapsed_ms, cursor.rowcount, failed)
+            add_handler_db_time(elapsed_ms)
+            if sql_span is not None:
+                sql_span.attributes['rows'] = cursor.rowcount
+            if not failed and elapsed_ms >= QUERY_SLOW_MS:
+                log_slow_query(cursor, name, sql, elapsed_ms)
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        return instrumented_execute(self, super().execute, query, vars)
+
+def query_stats():
+    with instrumentation_lock:
+        queries = {name: histogram.snapshot() for name, histogram in query_histograms.items()}
+        pool_wait = pool_wait_histogram.snapshot()
+    return {'queries': queries, 'pool_wait': pool_wait}
+
+# endregion
+
+# region ------------------------ Handler Metrics ------------------------
+
+# Each update runs inside run_update(), which times it end to end (unit of
+# work commit included) and adds up the time its queries took. The router
+# names the update after the handler or wizard step it lands on. Messages
+# the handler queues carry that name to the outbound dispatcher, which
+# records how long each took to reach Telegram; direct API calls such as
+# answer_callback_query are timed the same way.
+
+handler_metrics_state = UpdateLocal('handler_metrics')
+handler_histograms = {}
+
+class UpdateMetrics:
+    def __init__(self):
+        self.handler = 'unrouted'
+        self.db_ms = 0.0
+
+def current_update_metrics():
+    return getattr(handler_metrics_state, 'current', None)
+
+def current_handler_name():
+    metrics = current_update_metrics()
+    return metrics.handler if metrics is not None else None
+
+def name_handler(name):
+    metrics = current_update_metrics()
+    if metrics is not None:
+        metrics.handler = name
+
+def add_handler_db_time(elapsed_ms):
+    metrics = current_update_metrics()
+    if metrics is not None:
+        metrics.db_ms += elapsed_ms
+
+def handler_histogram(handler, kind):
+    # Called with instrumentation_lock held.
+    histograms = handler_histograms.get(handler)
+    if histograms is None:
+        histograms = handler_histograms[handler] = {
+            'duration': LatencyHistogram(), 'db': LatencyHistogram(), 'send': LatencyHistogram(),
+        }
+    return histograms[kind]
+
+def record_handler_send(handler, elapsed_ms):
+    if handler is None:
+        return
+    with instrumentation_lock:
+        handler_histogram(handler, 'send').observe(elapsed_ms)
+
+def run_update(task, *args, **kwargs):
+    metrics = UpdateMetrics()
+    handler_metrics_state.current = metrics
+    root = start_trace('update', chat_id=task_chat_id(args) or 0)
+    failed = True
+    start = time.perf_counter()
+    try:
+        result = run_in_unit_of_work(task, *args, **kwargs)
+        failed = False
+        return result
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        handler_metrics_state.current = None
+        if root is not None:
+            root.attributes['handler'] = metrics.handler
+            end_trace(root, 'failed' if failed else None)
+        with instrumentation_lock:
+            handler_histogram(metrics.handler, 'duration').observe(elapsed_ms, failed=failed)
+            handler_histogram(metrics.handler, 'db').observe(metrics.db_ms)
+
+def handler_stats():
+    with instrumentation_lock:
+        return {
+            handler: {kind: histogram.snapshot() for kind, histogram in histograms.items()}
+            for handler, histograms in handler_histograms.items()
+        }
+
+# endregion
+
+# region ---------------------------- Tracing ----------------------------
+
+# With TRACE_EXPORTER=file or otlp, each sampled update gets a trace id and
+# a root "update" span. Spans for dispatch, the traced helpers, every SQL
+# statement and every Telegram call nest under it through a per-update
+# stack. Sends run later on the outbound dispatcher, so a queued message
+# carries its parent span along and reports its own span once it is
+# delivered or given up on. Finished spans are exported in the background:
+# "file" appends one OTLP-style span per line to TRACE_FILE, and "otlp"
+# posts OTLP/HTTP JSON batches to TRACE_OTLP_URL. When the export queue is
+# full, spans are dropped rather than slowing handlers down.
+
+trace_state = UpdateLocal('trace')
+
+class Span:
+    def __init__(self, trace_id, parent_id, name, attributes, start_ns=None):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def finish(self, error=None):
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = error
+        span_exporter.export(self)
+
+class SpanExporter:
+    def __init__(self, exporter, max_queue, flush_interval):
+        self.exporter = exporter
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self._spans = deque()
+        self._lock = threading.Condition()
+        self._thread = None
+        self._stats = {'exported': 0, 'dropped': 0, 'failed': 0}
+
+    def enabled(self):
+        return self.exporter in ('file', 'otlp')
+
+    def export(self, span):
+        with self._lock:
+            if len(self._spans) >= self.max_queue:
+                self._stats['dropped'] += 1
+                return
+            self._spans.append(span)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+                self._thread.start()
+            self._lock.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._spans:
+                    self._lock.wait()
+            # Let a batch build up instead of writing span by span.
+            time.sleep(self.flush_interval)
+            with self._lock:
+                batch = list(self._spans)
+                self._spans.clear()
+            try:
+                if self.exporter == 'otlp':
+                    self._post(batch)
+                else:
+                    self._write(batch)
+            except (OSError, ValueError) as e:
+                with self._lock:
+                    self._stats['failed'] += len(batch)
+                print(f"Error exporting spans: {e}")
+                continue
+            with self._lock:
+                self._stats['exported'] += len(batch)
+
+    def _write(self, batch):
+        with open(TRACE_FILE, 'a', encoding='utf-8') as trace_file:
+            for span in batch:
+                trace_file.write(json.dumps(otlp_span(span), ensure_ascii=False) + '\n')
+
+    def _post(self, batch):
+        body = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': otlp_attributes({'service.name': 'fightclub-bot'})},
+            'scopeSpans': [{'scope': {'name': 'bot'}, 'spans': [otlp_span(span) for span in batch]}],
+        }]}).encode('utf-8')
+        request = urllib.request.Request(TRACE_OTLP_URL, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queued'] = len(self._spans)
+        return stats
+
+span_exporter = SpanExporter(TRACE_EXPORTER, TRACE_MAX_QUEUE, TRACE_FLUSH_INTERVAL)
+
+def otlp_attributes(attributes):
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            result.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            result.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            result.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            result.append({'key': key, 'value': {'stringValue': str(value)}})
+    return result
+
+def otlp_span(span):
+    data = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': 1,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': otlp_attributes(span.attributes),
+        'status': {'code': 2, 'message': span.error} if span.error else {},
+    }
+    if span.parent_id:
+        data['parentSpanId'] = span.parent_id
+    return data
+
+def trace_stack():
+    stack = getattr(trace_state, 'stack', None)
+    if stack is None:
+        stack = trace_state.stack = []
+    return stack
+
+def current_span():
+    stack = getattr(trace_state, 'stack', None)
+    return stack[-1] if stack else None
+
+def start_trace(name, **attributes):
+    # Returns the root span, or None when tracing is off or the update is
+    # not sampled; every span() below it is then a no-op.
+    if not span_exporter.enabled() or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    root = Span(secrets.token_hex(16), None, name, attributes)
+    trace_stack().append(root)
+    return root
+
+def end_trace(root, error=None):
+    if root is None:
+        return
+    trace_stack().clear()
+    root.finish(error)
+
+@contextmanager
+def span(name, **attributes):
+    parent = current_span()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace_id, parent.span_id, name, attributes)
+    stack = trace_stack()
+    stack.append(child)
+    error = None
+    try:
+        yield child
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        stack.pop()
+        child.finish(error)
+
+def traced(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if current_span() is None:
+            return function(*args, **kwargs)
+        with span(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def trace_parent():
+    parent = current_span()
+    return (parent.trace_id, parent.span_id) if parent is not None else None
+
+def record_span(parent, name, start_ns, error=None, **attributes):
+    # For work that finished on another thread, such as a queued send.
+    if parent is None:
+        return
+    trace_id, parent_id = parent
+    Span(trace_id, parent_id, name, attributes, start_ns).finish(error)
+
+# endregion
+
+# region ------------------------ Connection Pool ------------------------
+
+class PoolTimeout(PoolError):
+    pass
+
+class PoolConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.prepared = set()
+
+    def plain_cursor(self):
+        # Not instrumented, for statements that must not be timed or logged
+        # as queries of their own.
+        return psycopg2.extensions.cursor(self)
+
+class PooledConnection:
+    # Handed out by get_db_connection(). Call sites keep calling close() as
+    # before; it hands the connection back to its owner (the pool, or the
+    # current unit of work) instead of dropping it.
+    def __init__(self, connection, release=None):
+        self._connection = connection
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._connection, name, value)
+
+    def close(self):
+        if self._connection is not None:
+            if self._release is not None:
+                self._release(self._connection)
+            self._connection = None
+
+    def discard(self):
+        # Closes the server session; the pool drops closed connections.
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Error:
+                pass
+        self.close()
+
+class ConnectionPool:
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=10.0, max_lifetime=1800.0, health_check_idle=30.0):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_idle = health_check_idle
+
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'discarded': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+        }
+
+    def _connect(self):
+        connection = psycopg2.connect(self.dsn, connection_factory=PoolConnection, cursor_factory=InstrumentedCursor)
+        try:
+            probe_prepared_statements(connection)
+        except Error:
+            connection.close()
+            raise
+        with self._lock:
+            self._stats['created'] += 1
+        return connection
+
+    def _release_slot(self):
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+
+    def _discard(self, connection, stat='discarded'):
+        try:
+            if not connection.closed:
+                connection.close()
+        except Error:
+            pass
+        with self._lock:
+            self._stats[stat] += 1
+        self._release_slot()
+
+    def _expired(self, connection):
+        return self.max_lifetime > 0 and time.monotonic() - connection.created_at > self.max_lifetime
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        if time.monotonic() - connection.last_used < self.health_check_idle:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            connection.rollback()
+            return True
+        except Error:
+            return False
+
+    def fill(self):
+        while True:
+            with self._lock:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = self._connect()
+            except Error:
+                self._release_slot()
+                raise
+            with self._lock:
+                self._idle.append(connection)
+                self._lock.notify()
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+
+        while True:
+            connection = None
+            with self._lock:
+                while True:
+                    if self._closed:
+                        raise PoolError("connection pool is closed")
+                    if self._idle:
+                        connection = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(f"no database connection available after {self.timeout}s")
+                    self._lock.wait(remaining)
+
+            if connection is None:
+                try:
+                    connection = self._connect()
+                except Error:
+                    self._release_slot()
+                    raise
+            elif self._expired(connection):
+                self._discard(connection, 'recycled')
+                continue
+            elif not self._is_healthy(connection):
+                self._discard(connection)
+                continue
+
+            waited = time.monotonic() - start
+            record_pool_wait(waited * 1000)
+            with self._lock:
+                self._stats['checkouts'] += 1
+                self._stats['wait_total'] += waited
+                self._stats['wait_max'] = max(self._stats['wait_max'], waited)
+            return connection
+
+    def putconn(self, connection):
+        if not connection.closed:
+            try:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                if connection.autocommit:
+                    connection.autocommit = False
+            except Error:
+                connection.close()
+
+        if connection.closed:
+            self._discard(connection)
+            return
+        if self._closed or self._expired(connection):
+            self._discard(connection, 'recycled')
+            return
+
+        connection.last_used = time.monotonic()
+        with self._lock:
+            self._idle.append(connection)
+            self._lock.notify()
+
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._lock.notify_all()
+        for connection in idle:
+            try:
+                connection.close()
+            except Error:
+                pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+        stats['wait_avg'] = stats['wait_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global db_pool
+    if async_db_pool is not None and in_async_update():
+        return async_db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                pool = ConnectionPool(
+                    DB_URI,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    health_check_idle=DB_POOL_HEALTH_CHECK_IDLE,
+                )
+                pool.fill()
+                db_pool = pool
+    return db_pool
+
+# endregion
+
+# region ------------------------- Async Postgres -------------------------
+
+# With BOT_MODE=asyncio every update runs as a task on the event loop. The
+# handler code is shared with the sync modes, so each task runs it in a
+# greenlet of its own. When the handler reaches Postgres, await_only()
+# switches back to the task, which awaits the psycopg 3 call on the loop
+# and then switches into the handler again with the result. While one
+# update waits on the database the loop runs the others. The number of
+# updates in flight is bounded by ASYNC_MAX_UPDATES, and their database
+# work by the DB_POOL_MAX_SIZE connections of the async pool, not by one
+# thread per update.
+#
+# Handlers keep the psycopg2 interface. Bridge connections bind parameters
+# client-side, as psycopg2 does, so every query runs unchanged. Their
+# cursors go through the same instrumentation. psycopg 3 errors are
+# re-raised as the psycopg2 class for the same SQLSTATE, so except Error
+# and the unique-violation checks still work. Code outside an update
+# greenlet keeps the psycopg2 pool: migrations, the conversation sweeper
+# and the metrics endpoint.
+
+async_db_pool = None
+
+def in_async_update():
+    return greenlet is not None and getattr(greenlet.getcurrent(), 'async_update', False)
+
+def await_only(awaitable):
+    # Hands the awaitable to the task running this update greenlet and
+    # returns its result, or raises its error, once the loop has it.
+    current = greenlet.getcurrent()
+    if not getattr(current, 'async_update', False):
+        raise RuntimeError("await_only() called outside an async update")
+    return current.parent.switch(awaitable)
+
+async def run_in_greenlet(func, *args, **kwargs):
+    handler = greenlet.greenlet(func, greenlet.getcurrent())
+    handler.async_update = True
+    result = handler.switch(*args, **kwargs)
+    while not handler.dead:
+        try:
+            value = await result
+        except BaseException:
+            result = handler.throw(*sys.exc_info())
+        else:
+            result = handler.switch(value)
+    return result
+
+def psycopg2_error(e):
+    error_class = None
+    if e.sqlstate:
+        try:
+            error_class = psycopg2.errors.lookup(e.sqlstate)
+        except KeyError:
+            pass
+    if error_class is None:
+        # Errors without a SQLSTATE (connection loss, misuse) map by their
+        # DB-API class name, which both drivers share.
+        for base in type(e).__mro__:
+            error_class = getattr(psycopg2, base.__name__, None)
+            if isinstance(error_class, type) and issubclass(error_class, Error):
+                break
+    return error_class(str(e))
+
+def await_db(awaitable):
+    try:
+        return await_only(awaitable)
+    except psycopg.Error as e:
+        raise psycopg2_error(e) from e
+
+class AsyncCursorBridge:
+    def __init__(self, connection, cursor, instrumented=True):
+        self.connection = connection
+        self.instrumented = instrumented
+        self.itersize = 2000
+        self._cursor = cursor
+        self._last = None
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def query(self):
+        # The last statement with its parameters merged in, as psycopg2
+        # keeps it; the slow-query log and its EXPLAIN use it.
+        if self._last is None:
+            return None
+        query, vars = self._last
+        return psycopg.AsyncClientCursor(self.connection.raw).mogrify(query, vars).encode()
+
+    def execute(self, query, vars=None):
+        if not self.instrumented:
+            return self._execute(query, vars)
+        return instrumented_execute(self, self._execute, query, vars)
+
+    def _execute(self, query, vars):
+        self._last = (query, vars)
+        await_db(self._cursor.execute(query, vars))
+
+    def fetchone(self):
+        return await_db(self._cursor.fetchone())
+
+    def fetchmany(self, size=None):
+        return await_db(self._cursor.fetchmany(size or 0))
+
+    def fetchall(self):
+        return await_db(self._cursor.fetchall())
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        await_db(self._cursor.close())
+
+class AsyncConnectionBridge:
+    def __init__(self, connection):
+        self.raw = connection
+        self.prepared = connection.prepared
+
+    @property
+    def closed(self):
+        return self.raw.closed
+
+    def cursor(self, name=None):
+        return AsyncCursorBridge(self, self.raw.cursor(name=name) if name else self.raw.cursor())
+
+    def plain_cursor(self):
+        return AsyncCursorBridge(self, self.raw.cursor(), instrumented=False)
+
+    def get_transaction_status(self):
+        # psycopg 3 numbers the states the same way psycopg2 does.
+        return int(self.raw.info.transaction_status)
+
+    def commit(self):
+        await_db(self.raw.commit())
+
+    def rollback(self):
+        await_db(self.raw.rollback())
+
+    def close(self):
+        await_db(self.raw.close())
+
+class AsyncPoolBridge:
+    # What get_db_pool() returns inside an async update.
+    def __init__(self, pool):
+        self.pool = pool
+
+    def getconn(self):
+        start = time.monotonic()
+        try:
+            connection = await_only(self.pool.getconn())
+        except psycopg_pool.PoolTimeout as e:
+            raise PoolTimeout(str(e)) from e
+        except psycopg.Error as e:
+            raise psycopg2_error(e) from e
+        record_pool_wait((time.monotonic() - start) * 1000)
+        return AsyncConnectionBridge(connection)
+
+    def putconn(self, connection):
+        await_only(self.pool.putconn(connection.raw))
+
+    def stats(self):
+        return self.pool.get_stats()
+
+async def open_async_db_pool():
+    async def configure(connection):
+        # New connections get the same prepared-statement bookkeeping and
+        # session probe as the psycopg2 pool's.
+        connection.prepared = set()
+        await run_in_greenlet(probe_prepared_statements, AsyncConnectionBridge(connection))
+
+    pool = psycopg_pool.AsyncConnectionPool(
+        DB_URI,
+        kwargs={'cursor_factory': psycopg.AsyncClientCursor},
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_lifetime=DB_POOL_MAX_LIFETIME if DB_POOL_MAX_LIFETIME > 0 else float('inf'),
+        configure=configure,
+        open=False,
+    )
+    await pool.open(wait=True)
+    return pool
+
+# endregion
+
+# region ---------------------- Prepared Statements ----------------------
+
+# The hot lookups are prepared once per pooled connection and then run with
+# EXECUTE, so Postgres parses them once and, after its first few custom
+# plans, reuses a generic plan instead of planning every call. Prepared
+# statements belong to the server session: when the pool recycles or
+# discards a connection they go with it, and the replacement prepares them
+# again on first use. Behind a transaction-mode pooler consecutive
+# transactions can land on different server sessions. Every new pooled
+# connection is probed for that before any update uses it, and the layer
+# switches itself off for the rest of the run if sessions are swapped; set
+# DB_PREPARED_STATEMENTS=off to skip the probe behind such a pooler.
+
+PREPARED_STATEMENT_ERRORS = (
+    psycopg2.errors.InvalidSqlStatementName,
+    psycopg2.errors.DuplicatePreparedStatement,
+)
+# Postgres plans the first five executions of a prepared statement with the
+# actual parameters before it settles on a generic plan.
+CUSTOM_PLAN_EXECUTIONS = 5
+
+prepared_queries = {}
+prepared_stats = {}
+prepared_sql = set()
+prepared_lock = threading.Lock()
+prepared_state = {'enabled': DB_PREPARED_STATEMENTS != 'off'}
+
+def prepared_query(name, sql):
+    # Registered queries must be side-effect-free reads: slow ones are run
+    # a second time under EXPLAIN ANALYZE. They are written with positional
+    # %s parameters; PREPARE wants $n.
+    count = sql.count('%s')
+    numbers = iter(range(1, count + 1))
+    prepared_queries[name] = {
+        'sql': sql,
+        'prepare': f"PREPARE {name} AS " + re.sub(r'%s', lambda m: f"${next(numbers)}", sql),
+        'execute': f"EXECUTE {name} ({', '.join(['%s'] * count)})" if count else f"EXECUTE {name}",
+    }
+    prepared_stats[name] = {'prepares': 0, 'executions': 0, 'plain': 0, 'plan_ms': None}
+    prepared_sql.add(sql)
+    return name
+
+def disable_prepared_statements(reason):
+    with prepared_lock:
+        if not prepared_state['enabled']:
+            return
+        prepared_state['enabled'] = False
+    print(f"Prepared statements disabled: {reason}")
+
+def probe_prepared_statements(connection):
+    # Prepare a throwaway statement in one transaction and look for it from
+    # the next. A pooler that swaps server sessions between transactions
+    # loses it, and is caught here rather than by some update's EXECUTE.
+    if not prepared_state['enabled']:
+        return
+    name = f"session_probe_{secrets.token_hex(4)}"
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"PREPARE {name} AS SELECT 1")
+        connection.commit()
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_prepared_statements WHERE name = %s)", (name,))
+        kept = cursor.fetchone()[0]
+        if kept:
+            cursor.execute(f"DEALLOCATE {name}")
+        connection.commit()
+    finally:
+        cursor.close()
+    if not kept:
+        disable_prepared_statements("server sessions change between transactions")
+
+def sample_planning_time(cursor, query, params):
+    # Measured once per query with the parameters of its first call; it is
+    # what every plain execution of the same text would spend planning.
+    cursor.execute("EXPLAIN (SUMMARY ON, FORMAT JSON) " + query['sql'], params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0].get('Planning Time', 0.0)
+
+def execute_prepared(cursor, name, params=()):
+    query = prepared_queries[name]
+    stats = prepared_stats[name]
+    connection = cursor.connection
+    prepared = getattr(connection, 'prepared', None)
+
+    if not prepared_state['enabled'] or prepared is None:
+        cursor.execute(query['sql'], params)
+        with prepared_lock:
+            stats['plain'] += 1
+        return
+
+    idle = connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    try:
+        if name not in prepared:
+            with prepared_lock:
+                sample = stats['plan_ms'] is None
+            if sample:
+                plan_ms = sample_planning_time(cursor, query, params)
+                with prepared_lock:
+                    if stats['plan_ms'] is None:
+                        stats['plan_ms'] = plan_ms
+            cursor.execute(query['prepare'])
+            prepared.add(name)
+            with prepared_lock:
+                stats['prepares'] += 1
+        cursor.execute(query['execute'], params)
+    except PREPARED_STATEMENT_ERRORS as e:
+        # The server session does not match what this connection prepared,
+        # so something between us and Postgres swaps sessions and the probe
+        # missed it. An update that already did work in this transaction
+        # loses it and fails; the ones after it run plain SQL.
+        disable_prepared_statements(e)
+        prepared.clear()
+        if not idle:
+            raise
+        # Nothing ran in this transaction before the failed statement, so
+        # it is safe to roll back and answer the call with plain SQL.
+        connection.rollback()
+        cursor.execute(query['sql'], params)
+        with prepared_lock:
+            stats['plain'] += 1
+        return
+
+    with prepared_lock:
+        stats['executions'] += 1
+
+def prepared_statement_stats():
+    with prepared_lock:
+        queries = {name: dict(stats) for name, stats in prepared_stats.items()}
+    saved_ms = 0.0
+    for stats in queries.values():
+        # An estimate: executions past the custom-plan phase skip planning.
+        reused = max(0, stats['executions'] - CUSTOM_PLAN_EXECUTIONS * stats['prepares'])
+        stats['saved_ms'] = reused * (stats['plan_ms'] or 0.0)
+        saved_ms += stats['saved_ms']
+    return {'enabled': prepared_state['enabled'], 'saved_ms': saved_ms, 'queries': queries}
+
+# endregion
+
+# region ------------------------- Unit of Work -------------------------
+
+unit_of_work_state = UpdateLocal('unit_of_work')
+
+class UnitOfWork:
+    # One connection and one transaction for everything a single update
+    # does. The connection is only checked out on first use, so updates
+    # that never touch the database never touch the pool.
+    def __init__(self):
+        self._connection = None
+        self._kept = {}
+
+    def connection(self):
+        if self._connection is None:
+            self._connection = get_db_pool().getconn()
+        return self._connection
+
+    def keep_on_rollback(self, key, query, params):
+        # Statements that must stand even if the update fails, such as the
+        # conversation state changes. Only the latest one per key is kept;
+        # they are run again in a fresh transaction after a rollback.
+        self._kept[key] = (query, params)
+
+    def _replay_kept(self, connection):
+        if not self._kept:
+            return
+        cursor = connection.cursor()
+        for query, params in self._kept.values():
+            cursor.execute(query, params)
+        cursor.close()
+        connection.commit()
+
+    def finish(self, failed=False):
+        connection = self._connection
+        if connection is None:
+            return
+        self._connection = None
+        try:
+            with span('unit_of_work.finish'):
+                if not connection.closed:
+                    status = connection.get_transaction_status()
+                    if failed or status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                        connection.rollback()
+                        self._replay_kept(connection)
+                    elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        connection.commit()
+        except Error as e:
+            print(f"Error finishing unit of work: {e}")
+        finally:
+            get_db_pool().putconn(connection)
+
+def current_unit_of_work():
+    return getattr(unit_of_work_state, 'current', None)
+
+@contextmanager
+def unit_of_work():
+    outer = current_unit_of_work()
+    if outer is not None:
+        yield outer
+        return
+
+    uow = UnitOfWork()
+    unit_of_work_state.current = uow
+    failed = False
+    try:
+        yield uow
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        unit_of_work_state.current = None
+        uow.finish(failed)
+
+def run_in_unit_of_work(task, *args, **kwargs):
+    with unit_of_work():
+        return task(*args, **kwargs)
+
+def keep_on_rollback(key, query, params):
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.keep_on_rollback(key, query, params)
+
+# endregion
+
+# region --------------------- Outbound Dispatcher ----------------------
+
+# Telegram allows about 30 messages a second per bot and about one a
+# second per chat, and answers anything faster with 429 and a retry_after.
+# Handlers therefore never call the API to send: they queue the message
+# and return, and a few sender threads drain the per-chat queues through
+# a global and a per-chat token bucket.
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+class OutboundDispatcher:
+    def __init__(self, bot, global_rate, chat_rate, chat_burst, workers, max_attempts):
+        self._bot = bot
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._queues = {}
+        self._buckets = {}
+        self._ready = deque()
+        self._in_flight = set()
+        self._lock = threading.Condition()
+        self._threads = []
+        self._wakeup = None
+        self._last_prune = time.monotonic()
+        self._depth = 0
+        self._stats = {
+            'queued': 0, 'sent': 0, 'coalesced': 0, 'rate_limited': 0,
+            'retried': 0, 'failed': 0, 'max_depth': 0, 'wait_total': 0.0, 'wait_max': 0.0,
+        }
+
+    def enqueue(self, chat_id, method, text, kwargs):
+        op = {
+            'method': method, 'text': text, 'kwargs': kwargs, 'attempts': 0,
+            'queued_at': time.monotonic(), 'handler': current_handler_name(),
+            'trace': trace_parent(), 'queued_ns': time.time_ns(),
+        }
+        with self._lock:
+            self._start()
+            queue = self._queues.setdefault(chat_id, deque())
+            queue.append(op)
+            if chat_id not in self._in_flight and chat_id not in self._ready:
+                self._ready.append(chat_id)
+            self._depth += 1
+            self._stats['queued'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'], self._depth)
+            self._lock.notify()
+        if self._wakeup is not None:
+            self._wakeup()
+
+    def _start(self):
+        if self._threads or self._wakeup is not None:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'outbound-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune_buckets(self, now):
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._queues and bucket.idle(now)]:
+            del self._buckets[chat_id]
+
+    def _coalesce(self, queue, op):
+        # Consecutive plain messages to the same chat go out as one, as long
+        # as no keyboard would end up in the middle of the text.
+        while queue and op['method'] == 'send_message' and queue[0]['method'] == 'send_message':
+            following = queue[0]
+            if op['kwargs'].get('reply_markup') is not None:
+                break
+            if op['kwargs'].get('parse_mode') != following['kwargs'].get('parse_mode'):
+                break
+            text = op['text'] + "\n\n" + following['text']
+            if len(text) > TELEGRAM_MESSAGE_LIMIT:
+                break
+            queue.popleft()
+            self._depth -= 1
+            self._stats['coalesced'] += 1
+            op = dict(following, text=text, queued_at=op['queued_at'])
+        return op
+
+    def _next(self):
+        # Called with the lock held. Picks the next chat round robin whose
+        # bucket has a token; returns (chat_id, op) or (None, seconds to wait).
+        now = time.monotonic()
+        wait = None
+        for _ in range(len(self._ready)):
+            chat_id = self._ready[0]
+            chat_delay = self._chat_bucket(chat_id).delay(now)
+            if chat_delay > 0:
+                self._ready.rotate(-1)
+                wait = chat_delay if wait is None else min(wait, chat_delay)
+                continue
+            global_delay = self._global_bucket.delay(now)
+            if global_delay > 0:
+                return None, global_delay
+
+            self._ready.popleft()
+            self._global_bucket.take()
+            self._chat_bucket(chat_id).take()
+            queue = self._queues[chat_id]
+            op = self._coalesce(queue, queue.popleft())
+            self._depth -= 1
+            if not queue:
+                del self._queues[chat_id]
+            self._in_flight.add(chat_id)
+            return chat_id, op
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    chat_id, op = self._next()
+                    if chat_id is not None:
+                        break
+                    self._lock.wait(op)
+
+            op['attempts'] += 1
+            try:
+                getattr(telebot.TeleBot, op['method'])(self._bot, chat_id=chat_id, text=op['text'], **op['kwargs'])
+            except Exception as e:
+                self._finish(chat_id, op, self._failed(chat_id, op, e))
+            else:
+                self._finish(chat_id, op, None, sent=True)
+
+    async def run_async(self, api):
+        # The asyncio engine's replacement for the sender threads: every
+        # send is a task on the event loop, so sends to different chats
+        # overlap without a thread each. api is an AsyncTeleBot.
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self._wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+        sending = set()
+        while True:
+            ready.clear()
+            with self._lock:
+                chat_id, op = self._next()
+            if chat_id is None:
+                try:
+                    await asyncio.wait_for(ready.wait(), op)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._send_async(api, chat_id, op))
+            sending.add(task)
+            task.add_done_callback(sending.discard)
+
+    async def _send_async(self, api, chat_id, op):
+        op['attempts'] += 1
+        try:
+            await getattr(api, op['method'])(chat_id=chat_id, text=op['text'], **op['kwargs'])
+        except Exception as e:
+            self._finish(chat_id, op, self._failed(chat_id, op, e))
+        else:
+            self._finish(chat_id, op, None, sent=True)
+
+    def _failed(self, chat_id, op, e):
+        # Returns the delay before a retry, or None to give up on the op.
+        # Bot API errors carry an error_code; anything else is the network.
+        error_code = getattr(e, 'error_code', None)
+        with self._lock:
+            if error_code == 429:
+                self._stats['rate_limited'] += 1
+                op['attempts'] -= 1
+                return ((getattr(e, 'result_json', None) or {}).get('parameters') or {}).get('retry_after', 1)
+            if error_code is None and op['attempts'] < self.max_attempts:
+                self._stats['retried'] += 1
+                return 2 ** op['attempts']
+            self._stats['failed'] += 1
+        print(f"Error sending to chat {chat_id}: {e}")
+        return None
+
+    def _finish(self, chat_id, op, retry_after, sent=False):
+        now = time.monotonic()
+        with self._lock:
+            if sent:
+                waited = now - op['queued_at']
+                self._stats['sent'] += 1
+                self._stats['wait_total'] += waited
+                self._stats['wait_max'] = max(self._stats['wait_max'], waited)
+            self._in_flight.discard(chat_id)
+            if retry_after is not None:
+                self._chat_bucket(chat_id).block(retry_after)
+                self._queues.setdefault(chat_id, deque()).appendleft(op)
+                self._depth += 1
+            if chat_id in self._queues and chat_id not in self._ready:
+                self._ready.append(chat_id)
+            if now - self._last_prune > 60:
+                self._last_prune = now
+                self._prune_buckets(now)
+            self._lock.notify_all()
+        if sent:
+            record_handler_send(op['handler'], (now - op['queued_at']) * 1000)
+        if retry_after is None:
+            record_span(op['trace'], f"telegram.{op['method']}", op['queued_ns'], None if sent else 'failed',
+                        chat_id=chat_id, attempts=op['attempts'])
+        if self._wakeup is not None:
+            self._wakeup()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['depth'] = self._depth
+            stats['chats_waiting'] = len(self._queues)
+        stats['wait_avg'] = stats['wait_total'] / stats['sent'] if stats['sent'] else 0.0
+        return stats
+
+# endregion
+
+# region ------------------------ Update Executor ------------------------
+
+# Handlers block on Postgres and Telegram, so they run on a fixed pool of
+# worker threads. Tasks for one chat run strictly one after another, in the
+# order they arrived, which the wizards rely on; different chats run in
+# parallel, so a slow chat only ever holds up itself. The backlog is
+# bounded: past max_pending waiting tasks overall, or max_chat_pending for
+# one chat, submit() refuses and the update is shed with a "busy" reply.
+
+class ChatSerialExecutor:
+    def __init__(self, workers, max_pending, max_chat_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_chat_pending = max_chat_pending
+        # Chat -> its waiting tasks. A chat stays in here, possibly with an
+        # empty queue, for as long as a worker is running one of its tasks.
+        self._queues = {}
+        self._ready = deque()
+        self._lock = threading.Condition()
+        self._threads = []
+        self._wakeup = None
+        self._pending = 0
+        self._running = 0
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'shed': 0, 'max_pending': 0}
+
+    def submit(self, chat_id, task, *args, **kwargs):
+        with self._lock:
+            self._start()
+            chat_queue = self._queues.get(chat_id)
+            if self._pending >= self.max_pending or (chat_queue is not None and len(chat_queue) >= self.max_chat_pending):
+                self._stats['shed'] += 1
+                return False
+            if chat_queue is None:
+                chat_queue = self._queues[chat_id] = deque()
+                self._ready.append(chat_id)
+            chat_queue.append((task, args, kwargs))
+            self._pending += 1
+            self._stats['submitted'] += 1
+            self._stats['max_pending'] = max(self._stats['max_pending'], self._pending)
+            self._lock.notify()
+        if self._wakeup is not None:
+            self._wakeup()
+        return True
+
+    def _start(self):
+        if self._threads or self._wakeup is not None:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'update-worker-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _take(self):
+        # Called with the lock held and a chat in _ready.
+        chat_id = self._ready.popleft()
+        task, args, kwargs = self._queues[chat_id].popleft()
+        self._pending -= 1
+        return chat_id, task, args, kwargs
+
+    def _done(self, chat_id, failed):
+        # Called with the lock held. The chat only gets back in line now, so
+        # its next task cannot start before this one has finished.
+        self._stats['failed' if failed else 'completed'] += 1
+        if self._queues[chat_id]:
+            self._ready.append(chat_id)
+            self._lock.notify()
+        else:
+            del self._queues[chat_id]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._ready:
+                    self._lock.wait()
+                chat_id, task, args, kwargs = self._take()
+
+            failed = False
+            try:
+                task(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                print(f"Error handling update for chat {chat_id}: {e}")
+
+            with self._lock:
+                self._done(chat_id, failed)
+
+    async def run_async(self, max_running):
+        # The asyncio engine's replacement for the worker threads: every
+        # task runs in a greenlet of its own on the event loop (see Async
+        # Postgres), up to max_running of them at once.
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self._wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+        running = set()
+        while True:
+            ready.clear()
+            with self._lock:
+                started = []
+                while self._ready and self._running < max_running:
+                    started.append(self._take())
+                    self._running += 1
+            for chat_id, task, args, kwargs in started:
+                running_task = asyncio.create_task(self._run_async_task(chat_id, task, args, kwargs))
+                running.add(running_task)
+                running_task.add_done_callback(running.discard)
+            await ready.wait()
+
+    async def _run_async_task(self, chat_id, task, args, kwargs):
+        failed = False
+        try:
+            await run_in_greenlet(task, *args, **kwargs)
+        except Exception as e:
+            failed = True
+            print(f"Error handling update for chat {chat_id}: {e}")
+
+        with self._lock:
+            self._running -= 1
+            self._done(chat_id, failed)
+        self._wakeup()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = self._pending
+            stats['running'] = self._running
+            stats['active_chats'] = len(self._queues)
+        return stats
+
+update_executor = ChatSerialExecutor(UPDATE_WORKERS, UPDATE_MAX_PENDING, UPDATE_MAX_CHAT_PENDING)
+
+def task_chat_id(args):
+    # telebot hands handlers a Message or a CallbackQuery.
+    target = args[0] if args else None
+    message = target.message if isinstance(target, types.CallbackQuery) else target
+    chat = getattr(message, 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(target, 'from_user', None)
+    return user.id if user is not None else None
+
+def shed_update(chat_id):
+    if chat_id is not None:
+        bot.send_message(chat_id, "ربات در حال حاضر مشغول است. لطفاً چند لحظه دیگر دوباره تلاش کنید.")
+
+# endregion
+
+# region ------------------------------ Bot ------------------------------
+
+class FightClubBot(telebot.TeleBot):
+    # Every handler telebot runs for an update goes through _exec_task. It
+    # is queued on the update executor under its chat, and runs there in
+    # its own unit of work.
+    async_api = None
+
+    def _exec_task(self, task, *args, **kwargs):
+        chat_id = task_chat_id(args)
+        if not update_executor.submit(chat_id, run_update, task, *args, **kwargs):
+            shed_update(chat_id)
+
+    # Sends and edits are queued on the outbound dispatcher and return
+    # nothing.
+    def send_message(self, chat_id, text, **kwargs):
+        outbound.enqueue(chat_id, 'send_message', text, kwargs)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        outbound.enqueue(chat_id, 'edit_message_text', text, dict(kwargs, message_id=message_id))
+
+    def answer_callback_query(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with span('telegram.answer_callback_query'):
+                if self.async_api is not None and in_async_update():
+                    # A blocking call here would stall every update on the loop.
+                    return await_only(self.async_api.answer_callback_query(*args, **kwargs))
+                return super().answer_callback_query(*args, **kwargs)
+        finally:
+            record_handler_send(current_handler_name(), (time.perf_counter() - start) * 1000)
+
+# Lets the bot talk to a local fake of the Bot API in tests.
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+
+# telebot's own thread pool is not needed; the update executor runs handlers.
+bot = FightClubBot(BOT_TOKEN, threaded=False) # type: ignore
+outbound = OutboundDispatcher(
+    bot,
+    global_rate=DISPATCH_GLOBAL_RATE,
+    chat_rate=DISPATCH_CHAT_RATE,
+    chat_burst=DISPATCH_CHAT_BURST,
+    workers=DISPATCH_WORKERS,
+    max_attempts=DISPATCH_MAX_ATTEMPTS,
+)
+
+class UpdateRouter:
+    # Button texts, commands and callback prefixes map straight to their
+    # handler, so routing an update is one dict lookup however many menu
+    # actions there are. telebot itself only sees the two handlers that
+    # install() registers, instead of a predicate per action to try in turn.
+    def __init__(self):
+        self.texts = {}
+        self.commands = {}
+        self.callbacks = {}
+
+    def _register(self, table, keys):
+        def decorator(handler):
+            for key in keys:
+                if key in table:
+                    raise ValueError(f"{key!r} is already routed to {table[key].__name__}")
+                table[key] = handler
+            return handler
+        return decorator
+
+    def text(self, *texts):
+        return self._register(self.texts, texts)
+
+    def command(self, *commands):
+        return self._register(self.commands, commands)
+
+    def callback(self, prefix):
+        return self._register(self.callbacks, [prefix])
+
+    def message_handler_for(self, message):
+        command = telebot.util.extract_command(message.text)
+        if command is not None:
+            return self.commands.get(command.split('@')[0])
+        return self.texts.get(message.text)
+
+    def callback_handler_for(self, call):
+        return self.callbacks.get((call.data or '').split(':', 1)[0])
+
+    def dispatch_message(self, message):
+        # A chat in the middle of a wizard hands whatever it sends to the
+        # step it is on, as telebot's next-step handlers used to.
+        if resume_conversation(message):
+            return
+        handler = self.message_handler_for(message)
+        if handler is not None:
+            name_handler(handler.__name__)
+            with span('dispatch', handler=handler.__name__):
+                handler(message)
+
+    def dispatch_callback(self, call):
+        handler = self.callback_handler_for(call)
+        name_handler(handler.__name__)
+        with span('dispatch', handler=handler.__name__):
+            return handler(call)
+
+    def install(self, bot):
+        bot.register_message_handler(self.dispatch_message, func=lambda message: True)
+        bot.register_callback_query_handler(self.dispatch_callback, func=lambda call: self.callback_handler_for(call) is not None)
+
+router = UpdateRouter()
+router.install(bot)
 
 # endregion
 
 # region ----------------------- Starting Methods -----------------------
 
+@traced
 def check_login(chat_id):
-    return user_sessions.get(chat_id, False)
+    return sessions.touch(chat_id)
 
 def login_required(func):
     @wraps(func)
@@ -40,112 +1751,35 @@ def login_required(func):
 
 def get_db_connection():
     try:
-        connection = psycopg2.connect(DB_URI)
-        return connection
+        uow = current_unit_of_work()
+        if uow is not None:
+            return PooledConnection(uow.connection())
+        pool = get_db_pool()
+        return PooledConnection(pool.getconn(), pool.putconn)
     except Error as e:
         print(f"Error connecting to database: {e}")
         return None
 
-def create_tables():
-    connection = get_db_connection()
-    if connection is None:
-        return
-    try:
-        cursor = connection.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS gym (
-                gym_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                name varchar NOT NULL,
-                location varchar NOT NULL,
-                owner varchar NOT NULL,
-                reputation_score integer DEFAULT 75 CHECK (reputation_score >= 0 AND reputation_score <= 100)
-            );
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS fighter (
-                fighter_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                name varchar NOT NULL,
-                nickname varchar,
-                weight_class varchar NOT NULL,
-                age integer NOT NULL CHECK (age > 0),
-                nationality varchar,
-                status varchar DEFAULT 'active' CHECK (status IN ('active', 'retired', 'suspended')),
-                gym_id integer REFERENCES gym(gym_id) ON DELETE SET NULL
-            );
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS trainer (
-                trainer_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                name varchar NOT NULL,
-                specialty varchar NOT NULL,
-                gym_id integer REFERENCES gym(gym_id) ON DELETE SET NULL
-            );
-        """)
-
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS fighter_trainer (
-                ft_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                fighter_id integer REFERENCES fighter(fighter_id) ON DELETE CASCADE,
-                trainer_id integer REFERENCES trainer(trainer_id) ON DELETE CASCADE,
-                start_date date NOT NULL DEFAULT CURRENT_DATE,
-                end_date date,
-                UNIQUE NULLS NOT DISTINCT (fighter_id, trainer_id, end_date)
-            );
-        """)
-
-        cursor.execute("""
-            ALTER TABLE fighter_trainer
-            ADD CONSTRAINT check_date_order 
-            CHECK (end_date IS NULL OR end_date >= start_date);
-        """)
-
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS match_event (
-                match_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                start_date timestamp NOT NULL,
-                end_date timestamp,
-                location varchar NOT NULL
-            );
-        """)
-
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS participants (
-                match_id integer REFERENCES match_event(match_id) ON DELETE CASCADE,
-                fighter_id integer REFERENCES fighter(fighter_id) ON DELETE CASCADE,
-                result varchar CHECK (result IN ('win', 'loss', 'draw', 'no contest')),
-                PRIMARY KEY (match_id, fighter_id)
-            );
-        """)
-        
-        connection.commit()
-        print("Tables created successfully.")
-        cursor.close()
-    except Error as e:
-        print(f"Error creating tables: {e}")
-    finally:
-        if connection:
-            connection.close()
-
-# endregion
-
-# region ----------------------- Helper Functions -----------------------
-
-def get_gym_id_by_name(gym_name):
+def run_statement(query, params, fetch=None):
+    # One statement for the bookkeeping stores. Inside an update's unit of
+    # work it commits or rolls back together with everything else the
+    # update did; outside one it commits right away.
     connection = get_db_connection()
     if not connection:
         return None
 
     try:
         cursor = connection.cursor()
-        cursor.execute(
-            "SELECT gym_id FROM gym WHERE name = %s;",
-            (gym_name,)
-        )
-        row = cursor.fetchone()
-        return row[0] if row else None
+        cursor.execute(query, params)
+        if fetch == "one":
+            result = cursor.fetchone()
+        elif fetch == "all":
+            result = cursor.fetchall()
+        else:
+            result = None
+        if current_unit_of_work() is None:
+            connection.commit()
+        return result
     except Error as e:
         print(f"DB error: {e}")
         return None
@@ -153,37 +1787,593 @@ def get_gym_id_by_name(gym_name):
         cursor.close() # type: ignore
         connection.close()
 
-def get_gym_name_by_id(gym_id):
-    connection = get_db_connection()
-    if not connection:
+# endregion
+
+# region ------------------------- Conversations -------------------------
+
+# Multi-step wizards are a state machine: each step is a registered
+# function, and what a chat waits on is just the step's name plus its
+# arguments as JSON. That state lives in a ConversationStore rather than in
+# telebot's in-process next-step closures.
+#
+# The default memory store costs nothing per update, but its wizards are
+# lost on restart. CONVERSATION_STORE=postgres lets a restart or a second
+# bot worker pick the conversation up where it was. The price is one
+# DELETE ... RETURNING round trip on every incoming message, wizard or not,
+# since any message may be the answer to an open step.
+
+conversation_steps = {}
+
+def conversation_step(func):
+    conversation_steps[func.__name__] = func
+    return func
+
+def encode_step_value(value):
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    raise TypeError(f"cannot store {type(value).__name__} in conversation state")
+
+def decode_step_value(value):
+    if '$datetime' in value:
+        return datetime.fromisoformat(value['$datetime'])
+    if '$date' in value:
+        return date.fromisoformat(value['$date'])
+    return value
+
+def dump_step_args(args):
+    return json.dumps(args, separators=(',', ':'), ensure_ascii=False, default=encode_step_value)
+
+def load_step_args(payload):
+    return json.loads(payload, object_hook=decode_step_value)
+
+# A conversation nobody answered for idle_timeout seconds is abandoned: pop
+# reports it as expired instead of resuming it, and sweep() deletes all of
+# them and returns their chat ids.
+
+class MemoryConversationStore:
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        # Ordered by last save, so the abandoned ones are always in front.
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def save(self, chat_id, step, args):
+        with self._lock:
+            self._states[chat_id] = (step, args, time.monotonic())
+            self._states.move_to_end(chat_id)
+
+    def pop(self, chat_id):
+        with self._lock:
+            state = self._states.pop(chat_id, None)
+        if state is None:
+            return None
+        step, args, saved_at = state
+        return step, args, time.monotonic() - saved_at > self.idle_timeout
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._states.pop(chat_id, None)
+
+    def sweep(self):
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        with self._lock:
+            while self._states:
+                chat_id, (_, _, saved_at) = next(iter(self._states.items()))
+                if saved_at > deadline:
+                    break
+                del self._states[chat_id]
+                expired.append(chat_id)
+        return expired
+
+    def count(self):
+        with self._lock:
+            return len(self._states)
+
+class PostgresConversationStore:
+    # State changes ride on the update's unit of work, but like the memory
+    # store they stand even when the step fails: after a rollback the last
+    # change per chat is applied again. Otherwise a step that hits a DB
+    # error would get its popped state back and swallow the next message.
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+
+    def save(self, chat_id, step, args):
+        query = """
+            INSERT INTO conversation_state (chat_id, step, args)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (chat_id) DO UPDATE
+            SET step = EXCLUDED.step, args = EXCLUDED.args, updated_at = now()
+        """
+        keep_on_rollback(('conversation_state', chat_id), query, (chat_id, step, args))
+        run_statement(query, (chat_id, step, args))
+
+    def pop(self, chat_id):
+        self._keep_deleted(chat_id)
+        return run_statement("""
+            DELETE FROM conversation_state WHERE chat_id = %s
+            RETURNING step, args, updated_at <= now() - make_interval(secs => %s)
+        """, (chat_id, self.idle_timeout), fetch="one")
+
+    def delete(self, chat_id):
+        self._keep_deleted(chat_id)
+        run_statement("DELETE FROM conversation_state WHERE chat_id = %s", (chat_id,))
+
+    def _keep_deleted(self, chat_id):
+        keep_on_rollback(('conversation_state', chat_id), "DELETE FROM conversation_state WHERE chat_id = %s", (chat_id,))
+
+    def sweep(self):
+        rows = run_statement("""
+            DELETE FROM conversation_state
+            WHERE updated_at <= now() - make_interval(secs => %s)
+            RETURNING chat_id
+        """, (self.idle_timeout,), fetch="all")
+        return [row[0] for row in rows or []]
+
+    def count(self):
+        row = run_statement("SELECT COUNT(*) FROM conversation_state", (), fetch="one")
+        return row[0] if row else 0
+
+CONVERSATION_STORES = {
+    'memory': MemoryConversationStore,
+    'postgres': PostgresConversationStore,
+}
+
+conversations = CONVERSATION_STORES[CONVERSATION_STORE](CONVERSATION_IDLE_TIMEOUT)
+
+def set_next_step(chat_id, step, *args):
+    if conversation_steps.get(step.__name__) is not step:
+        raise ValueError(f"{step.__name__} is not a registered conversation step")
+    conversations.save(chat_id, step.__name__, dump_step_args(args))
+
+def clear_next_step(chat_id):
+    conversations.delete(chat_id)
+
+def resume_conversation(message):
+    state = conversations.pop(message.chat.id)
+    if state is None:
+        return False
+
+    step_name, args, expired = state
+    if expired:
+        # The message itself is still handled as if no wizard had been
+        # open, so a menu button or command does not have to be resent.
+        notify_conversation_expired(message.chat.id)
+        return False
+    name_handler(step_name)
+
+    step = conversation_steps.get(step_name)
+    if step is None:
+        print(f"Dropping conversation state for unknown step {step_name}")
+        return False
+    with span('dispatch', handler=step_name):
+        step(message, *load_step_args(args))
+    return True
+
+def notify_conversation_expired(chat_id):
+    bot.send_message(chat_id, "عملیات قبلی به دلیل عدم فعالیت لغو شد.", reply_markup=main_menu())
+
+def pending_conversations():
+    return conversations.count()
+
+def sweep_conversations():
+    # Abandoned wizards are cleared even if the chat never writes again,
+    # and the chat is told so instead of finding out on its next message.
+    while True:
+        time.sleep(CONVERSATION_SWEEP_INTERVAL)
+        try:
+            for chat_id in conversations.sweep():
+                notify_conversation_expired(chat_id)
+        except Exception as e:
+            print(f"Error sweeping conversations: {e}")
+
+def start_conversation_sweeper():
+    thread = threading.Thread(target=sweep_conversations, name='conversation-sweeper', daemon=True)
+    thread.start()
+    return thread
+
+# endregion
+
+# region --------------------------- Sessions ---------------------------
+
+# A session ends ttl seconds after login, or idle_timeout seconds after the
+# chat last did anything. The memory store also holds at most max_entries
+# sessions, evicting the least recently used; the Postgres store shares
+# logins between bot workers. It only writes last_seen once it is more than
+# touch_interval old, so most updates check the session with a read and the
+# idle timeout can run out up to touch_interval early.
+
+class MemorySessionStore:
+    def __init__(self, ttl, idle_timeout, max_entries, touch_interval):
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'logins': 0, 'expired': 0, 'evicted': 0}
+
+    def _expired(self, session, now):
+        created_at, last_seen = session
+        return now - created_at > self.ttl or now - last_seen > self.idle_timeout
+
+    def touch(self, chat_id):
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is None:
+                return False
+            if self._expired(session, now):
+                del self._sessions[chat_id]
+                self._stats['expired'] += 1
+                return False
+            self._sessions[chat_id] = (session[0], now)
+            self._sessions.move_to_end(chat_id)
+            return True
+
+    def create(self, chat_id):
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[chat_id] = (now, now)
+            self._sessions.move_to_end(chat_id)
+            self._stats['logins'] += 1
+            # The oldest entries are the idlest, so expired ones go first.
+            while self._sessions:
+                oldest_id, oldest = next(iter(self._sessions.items()))
+                if self._expired(oldest, now):
+                    self._stats['expired'] += 1
+                elif len(self._sessions) > self.max_entries:
+                    self._stats['evicted'] += 1
+                else:
+                    break
+                del self._sessions[oldest_id]
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._sessions.pop(chat_id, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['active'] = len(self._sessions)
+        return stats
+
+class PostgresSessionStore:
+    def __init__(self, ttl, idle_timeout, max_entries, touch_interval):
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self.touch_interval = touch_interval
+
+    def touch(self, chat_id):
+        row = run_statement("""
+            WITH live AS (
+                SELECT chat_id, last_seen FROM user_session
+                WHERE chat_id = %s
+                  AND created_at > now() - make_interval(secs => %s)
+                  AND last_seen > now() - make_interval(secs => %s)
+            ), touched AS (
+                UPDATE user_session SET last_seen = now()
+                WHERE chat_id IN (
+                    SELECT chat_id FROM live
+                    WHERE last_seen <= now() - make_interval(secs => %s)
+                )
+            )
+            SELECT chat_id FROM live
+        """, (chat_id, self.ttl, self.idle_timeout, self.touch_interval), fetch="one")
+        return row is not None
+
+    def create(self, chat_id):
+        run_statement("""
+            DELETE FROM user_session
+            WHERE last_seen <= now() - make_interval(secs => %s)
+               OR created_at <= now() - make_interval(secs => %s)
+        """, (self.idle_timeout, self.ttl))
+        run_statement("""
+            INSERT INTO user_session (chat_id) VALUES (%s)
+            ON CONFLICT (chat_id) DO UPDATE SET created_at = now(), last_seen = now()
+        """, (chat_id,))
+
+    def delete(self, chat_id):
+        run_statement("DELETE FROM user_session WHERE chat_id = %s", (chat_id,))
+
+    def stats(self):
+        row = run_statement("SELECT COUNT(*) FROM user_session", (), fetch="one")
+        return {'active': row[0] if row else None}
+
+SESSION_STORES = {
+    'memory': MemorySessionStore,
+    'postgres': PostgresSessionStore,
+}
+
+sessions = SESSION_STORES[SESSION_STORE](SESSION_TTL, SESSION_IDLE_TIMEOUT, SESSION_MAX_ENTRIES, SESSION_TOUCH_INTERVAL)
+
+# endregion
+
+# region ----------------------- Schema Migrations ----------------------
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_LOCK_ID = 7305118
+
+def load_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.match(r'^(\d+)_(\w+)\.(sql|py)$', filename)
+        if not match:
+            continue
+        path = os.path.join(MIGRATIONS_DIR, filename)
+        with open(path, encoding='utf-8') as f:
+            sql = f.read()
+        migrations.append({
+            'version': int(match.group(1)),
+            'name': match.group(2),
+            'path': path,
+            'kind': match.group(3),
+            'sql': sql,
+            'checksum': hashlib.sha256(sql.encode('utf-8')).hexdigest(),
+            'transactional': '-- migrate:no-transaction' not in sql,
+            'requires': re.findall(r'^-- migrate:requires-extension (\w+)$', sql, re.MULTILINE),
+        })
+    return migrations
+
+def get_applied_migrations(cursor):
+    try:
+        cursor.execute("SELECT version, checksum FROM schema_version")
+        return dict(cursor.fetchall())
+    except psycopg2.errors.UndefinedTable:
         return None
 
+def check_migration_checksums(migrations, applied):
+    ok = True
+    for migration in migrations:
+        checksum = applied.get(migration['version'])
+        if checksum is not None and checksum != migration['checksum']:
+            print(f"Migration {migration['version']:04d}_{migration['name']} was changed after it was applied.")
+            ok = False
+    return ok
+
+def missing_extensions(cursor, migration):
+    if not migration['requires']:
+        return []
+    cursor.execute("SELECT extname FROM pg_extension WHERE extname = ANY(%s)", (migration['requires'],))
+    installed = {row[0] for row in cursor.fetchall()}
+    return [name for name in migration['requires'] if name not in installed]
+
+def drop_invalid_index(cursor, statement):
+    # An interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind,
+    # which IF NOT EXISTS would then happily skip.
+    match = re.search(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)', statement, re.IGNORECASE)
+    if not match:
+        return
+    cursor.execute(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+        (match.group(1),)
+    )
+    row = cursor.fetchone()
+    if row and row[0]:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+
+def apply_migration(connection, cursor, migration):
+    if migration['kind'] == 'py':
+        # Python migrations get the bot's own helpers instead of importing
+        # this module, which would start a second bot.
+        namespace = runpy.run_path(migration['path'], init_globals={
+            'normalize_search_key': normalize_search_key,
+            'normalize_skeleton_key': normalize_skeleton_key,
+        })
+        namespace['migrate'](cursor)
+    elif migration['transactional']:
+        cursor.execute(migration['sql'])
+    else:
+        # Statements such as CREATE INDEX CONCURRENTLY refuse to run in a
+        # transaction block, so these files run one statement at a time.
+        connection.autocommit = True
+        try:
+            for statement in re.split(r';\s*$', migration['sql'], flags=re.MULTILINE):
+                if not re.sub(r'--.*$', '', statement, flags=re.MULTILINE).strip():
+                    continue
+                drop_invalid_index(cursor, statement)
+                cursor.execute(statement)
+        finally:
+            connection.autocommit = False
+
+    cursor.execute(
+        "INSERT INTO schema_version (version, name, checksum) VALUES (%s, %s, %s)",
+        (migration['version'], migration['name'], migration['checksum'])
+    )
+    connection.commit()
+    print(f"Applied migration {migration['version']:04d}_{migration['name']}.")
+
+def migrate():
+    migrations = load_migrations()
+    connection = get_db_connection()
+    if connection is None:
+        return False
     try:
         cursor = connection.cursor()
-        cursor.execute(
-            "SELECT name FROM gym WHERE gym_id = %s;",
-            (gym_id,)
-        )
-        row = cursor.fetchone()
-        return row[0] if row else None
+
+        # Fast path: a current schema costs this one query and no DDL.
+        applied = get_applied_migrations(cursor)
+        connection.rollback()
+        if applied is not None:
+            if not check_migration_checksums(migrations, applied):
+                return False
+            pending = [migration for migration in migrations if migration['version'] not in applied]
+            # Migrations waiting on an extension the database lacks are
+            # retried on every start, but do not defeat the fast path.
+            if all(missing_extensions(cursor, migration) for migration in pending):
+                connection.rollback()
+                return True
+            connection.rollback()
+
+        # Serialize concurrent bot processes, then re-read under the lock.
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        connection.commit()
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version integer PRIMARY KEY,
+                    name varchar NOT NULL,
+                    checksum char(64) NOT NULL,
+                    applied_at timestamp NOT NULL DEFAULT now()
+                );
+            """)
+            connection.commit()
+            applied = get_applied_migrations(cursor)
+            connection.rollback()
+            if not check_migration_checksums(migrations, applied):
+                return False
+
+            for migration in migrations:
+                if migration['version'] in applied:
+                    continue
+                missing = missing_extensions(cursor, migration)
+                connection.rollback()
+                if missing:
+                    print(f"Skipping migration {migration['version']:04d}_{migration['name']}: missing extension {', '.join(missing)}.")
+                    continue
+                apply_migration(connection, cursor, migration)
+        finally:
+            # A failed migration leaves the transaction aborted; roll it back
+            # first so the unlock can run and the original error surfaces.
+            try:
+                connection.rollback()
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                connection.commit()
+            except Error as e:
+                # Closing the session is the only other way to release the
+                # lock, so the connection is not handed back to the pool.
+                print(f"Error releasing the migration lock: {e}")
+                connection.discard()
+
+        print("Database schema is up to date.")
+        cursor.close()
+        return True
     except Error as e:
-        print(f"DB error: {e}")
-        return None
+        print(f"Error migrating database: {e}")
+        return False
     finally:
-        cursor.close() # type: ignore
-        connection.close()
+        if connection:
+            connection.close()
+
+# endregion
+
+# region ------------------------- Entity Cache -------------------------
+
+class EntityCache:
+    # Bounded LRU of rows by id, each entry living at most ttl seconds.
+    # Handlers that change a row invalidate it once they have committed;
+    # the generation counter keeps a read that raced with that write from
+    # putting the old row back afterwards. Other bot processes learn of the
+    # change from the entity_change triggers (migration 0015) through the
+    # name index listener.
+    def __init__(self, name, max_size, ttl):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get_or_load(self, key, load):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return dict(entry[1])
+            if entry is not None:
+                del self._entries[key]
+            self._stats['misses'] += 1
+            generation = self._generation
+
+        # Misses (None) are not cached, so a freshly added row shows up at once.
+        value = load(key)
+        if value is None or self.max_size <= 0:
+            return value
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, dict(value))
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            self._stats['invalidations'] += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._stats['invalidations'] += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+fighter_cache = EntityCache('fighter', ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+gym_cache = EntityCache('gym', ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+trainer_cache = EntityCache('trainer', ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+event_cache = EntityCache('event', ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+
+def entity_cache_stats():
+    return {cache.name: cache.stats() for cache in (fighter_cache, gym_cache, trainer_cache, event_cache)}
+
+def clear_entity_caches():
+    for cache in (fighter_cache, gym_cache, trainer_cache, event_cache):
+        cache.clear()
+
+def apply_entity_change(payload):
+    # The same invalidations the handlers do after their own writes.
+    try:
+        change = json.loads(payload)
+        table, row_id = change['table'], change['id']
+        if table == 'fighter':
+            fighter_cache.invalidate(row_id)
+            # Event rows carry the fighters' names.
+            event_cache.clear()
+        elif table == 'gym':
+            gym_cache.invalidate(row_id)
+            # Fighter and trainer rows carry the gym's name.
+            fighter_cache.clear()
+            trainer_cache.clear()
+        elif table == 'trainer':
+            trainer_cache.invalidate(row_id)
+        elif table in ('match_event', 'participants'):
+            event_cache.invalidate(row_id)
+        else:
+            raise KeyError(table)
+    except (ValueError, KeyError) as e:
+        print(f"Ignoring malformed entity change {payload!r}: {e}")
+
+# endregion
+
+# region ----------------------- Helper Functions -----------------------
 
-def get_fighter_id_by_name(fighter_name):
+GYM_NAME_BY_ID = prepared_query('gym_name_by_id', "SELECT name FROM gym WHERE gym_id = %s")
+
+@traced
+def get_gym_name_by_id(gym_id):
     connection = get_db_connection()
     if not connection:
         return None
 
     try:
         cursor = connection.cursor()
-        cursor.execute(
-            "SELECT fighter_id FROM fighter WHERE name = %s;",
-            (fighter_name,)
-        )
+        execute_prepared(cursor, GYM_NAME_BY_ID, (gym_id,))
         row = cursor.fetchone()
         return row[0] if row else None
     except Error as e:
@@ -193,19 +2383,29 @@ def get_fighter_id_by_name(fighter_name):
         cursor.close() # type: ignore
         connection.close()
 
+@traced
 def get_fighter_by_id(fighter_id):
+    return fighter_cache.get_or_load(fighter_id, load_fighter_by_id)
+
+# Prepared statements keep the result columns they were planned with, so
+# these list their columns instead of selecting f.* (which also carries
+# search_key since migration 0005).
+FIGHTER_BY_ID = prepared_query('fighter_by_id', """
+    SELECT f.fighter_id, f.name, f.nickname, f.weight_class, f.age,
+           f.nationality, f.status, f.gym_id, g.name as gym_name
+    FROM fighter f
+    LEFT JOIN gym g ON f.gym_id = g.gym_id
+    WHERE f.fighter_id = %s
+""")
+
+def load_fighter_by_id(fighter_id):
     connection = get_db_connection()
     if not connection:
         return None
     
     try:
         cursor = connection.cursor()
-        cursor.execute("""
-            SELECT f.*, g.name as gym_name 
-            FROM fighter f 
-            LEFT JOIN gym g ON f.gym_id = g.gym_id 
-            WHERE f.fighter_id = %s
-        """, (fighter_id,))
+        execute_prepared(cursor, FIGHTER_BY_ID, (fighter_id,))
         row = cursor.fetchone()
         if row:
             return {
@@ -227,14 +2427,24 @@ def get_fighter_by_id(fighter_id):
         cursor.close() # type: ignore
         connection.close()
 
+@traced
 def get_gym_by_id(gym_id):
+    return gym_cache.get_or_load(gym_id, load_gym_by_id)
+
+GYM_BY_ID = prepared_query('gym_by_id', """
+    SELECT gym_id, name, location, owner, reputation_score
+    FROM gym
+    WHERE gym_id = %s
+""")
+
+def load_gym_by_id(gym_id):
     connection = get_db_connection()
     if not connection:
         return None
     
     try:
         cursor = connection.cursor()
-        cursor.execute("SELECT * FROM gym WHERE gym_id = %s", (gym_id,))
+        execute_prepared(cursor, GYM_BY_ID, (gym_id,))
         row = cursor.fetchone()
         if row:
             return {
@@ -252,19 +2462,25 @@ def get_gym_by_id(gym_id):
         cursor.close() # type: ignore
         connection.close()
 
+@traced
 def get_trainer_by_id(trainer_id):
+    return trainer_cache.get_or_load(trainer_id, load_trainer_by_id)
+
+TRAINER_BY_ID = prepared_query('trainer_by_id', """
+    SELECT t.trainer_id, t.name, t.specialty, t.gym_id, g.name as gym_name
+    FROM trainer t
+    LEFT JOIN gym g ON t.gym_id = g.gym_id
+    WHERE t.trainer_id = %s
+""")
+
+def load_trainer_by_id(trainer_id):
     connection = get_db_connection()
     if not connection:
         return None
     
     try:
         cursor = connection.cursor()
-        cursor.execute("""
-            SELECT t.*, g.name as gym_name 
-            FROM trainer t 
-            LEFT JOIN gym g ON t.gym_id = g.gym_id 
-            WHERE t.trainer_id = %s
-        """, (trainer_id,))
+        execute_prepared(cursor, TRAINER_BY_ID, (trainer_id,))
         row = cursor.fetchone()
         if row:
             return {
@@ -282,25 +2498,32 @@ def get_trainer_by_id(trainer_id):
         cursor.close() # type: ignore
         connection.close()
 
+@traced
 def get_event_by_id(event_id):
+    return event_cache.get_or_load(event_id, load_event_by_id)
+
+EVENT_BY_ID = prepared_query('event_by_id', """
+    SELECT me.match_id, me.start_date, me.end_date, me.location,
+           f1.name as fighter1_name, f2.name as fighter2_name,
+           p1.result as fighter1_result, p2.result as fighter2_result,
+           p1.fighter_id as fighter1_id, p2.fighter_id as fighter2_id
+    FROM match_event me
+    JOIN participants p1 ON me.match_id = p1.match_id
+    JOIN participants p2 ON me.match_id = p2.match_id
+    JOIN fighter f1 ON p1.fighter_id = f1.fighter_id
+    JOIN fighter f2 ON p2.fighter_id = f2.fighter_id
+    WHERE me.match_id = %s AND p1.fighter_id != p2.fighter_id
+    LIMIT 1
+""")
+
+def load_event_by_id(event_id):
     connection = get_db_connection()
     if not connection:
         return None
     
     try:
         cursor = connection.cursor()
-        cursor.execute("""
-            SELECT me.*, 
-                   f1.name as fighter1_name, f2.name as fighter2_name,
-                   p1.result as fighter1_result, p2.result as fighter2_result
-            FROM match_event me
-            JOIN participants p1 ON me.match_id = p1.match_id
-            JOIN participants p2 ON me.match_id = p2.match_id
-            JOIN fighter f1 ON p1.fighter_id = f1.fighter_id
-            JOIN fighter f2 ON p2.fighter_id = f2.fighter_id
-            WHERE me.match_id = %s AND p1.fighter_id != p2.fighter_id
-            LIMIT 1
-        """, (event_id,))
+        execute_prepared(cursor, EVENT_BY_ID, (event_id,))
         row = cursor.fetchone()
         if row:
             return {
@@ -311,7 +2534,9 @@ def get_event_by_id(event_id):
                 'fighter1_name': row[4],
                 'fighter2_name': row[5],
                 'fighter1_result': row[6],
-                'fighter2_result': row[7]
+                'fighter2_result': row[7],
+                'fighter1_id': row[8],
+                'fighter2_id': row[9]
             }
         return None
     except Error as e:
@@ -321,8 +2546,254 @@ def get_event_by_id(event_id):
         cursor.close() # type: ignore
         connection.close()
 
+# Folds the Arabic code points and joiners that Persian keyboards mix in,
+# and pins the letters unidecode transliterates badly for names (ک -> kh,
+# ض -> D, ...), so both scripts land on the same Latin spelling.
+PERSIAN_FOLDING = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی', 'ك': 'ک', 'ة': 'ه', 'ۀ': 'ه',
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ؤ': 'و',
+    '\u200c': '', '\u200d': '', '\u0640': '',
+    **{chr(code): '' for code in range(0x064B, 0x0653)}, '\u0670': '',
+    'ک': 'k', 'گ': 'g', 'ژ': 'zh', 'ض': 'z', 'ظ': 'z', 'ذ': 'z',
+    'ص': 's', 'ث': 's', 'ط': 't', 'ح': 'h', 'ق': 'gh', 'ع': '', 'ء': '',
+})
+
+def normalize_search_key(*values):
+    # The folded transliteration: "Ali", "علی" and "علي" all give "ali".
+    text = " ".join(value for value in values if value)
+    text = unidecode(text.translate(PERSIAN_FOLDING)).lower()
+    text = re.sub(r'[^a-z0-9\s]+', '', text)
+    return " ".join(text.split())
+
+def normalize_skeleton_key(*values):
+    # Persian script drops short vowels, so "Mohammad" and "محمد" only meet
+    # as consonant skeletons ("mhmd"). Many names share a short skeleton,
+    # which is why this key is matched last and only for longer terms.
+    text = normalize_search_key(*values)
+    text = text.replace('ph', 'f').replace('c', 'k').replace('q', 'gh').replace('x', 'ks')
+    text = re.sub(r'[aeiouwy]', '', text)
+    text = re.sub(r'(.)\1+', r'\1', text)
+    return " ".join(text.split())
+
+trigram_search = None
+
+def has_trigram_search(cursor):
+    global trigram_search
+    if trigram_search is None:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        trigram_search = cursor.fetchone()[0] # type: ignore
+    return trigram_search
+
+def build_search_filter(cursor, columns, search_term, key_column=None, skeleton_column=None):
+    # Returns the WHERE condition, an ORDER BY prefix and the named params.
+    # With pg_trgm the substring match is served by the GIN trigram indexes
+    # and results are ranked by similarity; without it, plain ILIKE. The
+    # key_column holds normalize_search_key() of the row's name, which is
+    # what makes a Latin search find a Persian name and vice versa. Rows
+    # that only match on skeleton_column (normalize_skeleton_key()) come
+    # after all the others.
+    search_key = normalize_search_key(search_term)
+    skeleton = normalize_skeleton_key(search_term)
+    params = {
+        'term': search_term,
+        'pattern': f'%{search_term}%',
+        'key': search_key,
+        'key_prefix': f'{search_key}%',
+        'key_word': f'% {search_key}%',
+        'skeleton_prefix': f'{skeleton}%',
+        'skeleton_word': f'% {skeleton}%',
+    }
+    trigram = has_trigram_search(cursor)
+
+    conditions = []
+    similarities = []
+    for column in columns:
+        conditions.append(f"{column} ILIKE %(pattern)s")
+        if trigram:
+            conditions.append(f"{column} %% %(term)s")
+            similarities.append(f"similarity(COALESCE({column}, ''), %(term)s)")
+    if key_column and search_key:
+        conditions.append(f"{key_column} LIKE %(key_prefix)s OR {key_column} LIKE %(key_word)s")
+        if trigram:
+            conditions.append(f"{key_column} %% %(key)s")
+            similarities.append(f"similarity(COALESCE({key_column}, ''), %(key)s)")
+
+    where = " OR ".join(conditions)
+    rank = f"GREATEST({', '.join(similarities)}) DESC, " if similarities else ""
+    if skeleton_column and len(skeleton.replace(" ", "")) >= SEARCH_SKELETON_MIN_LENGTH:
+        # Skeletons are short, so they only match at word starts.
+        rank = f"CASE WHEN {where} THEN 0 ELSE 1 END, " + rank
+        where += f" OR {skeleton_column} LIKE %(skeleton_prefix)s OR {skeleton_column} LIKE %(skeleton_word)s"
+    return where, rank, params
+
 #endregion
 
+# region ---------------------- Name Lookup Index -----------------------
+
+# Must fold exactly like the name_lookup_key() SQL function (migration 0008).
+NAME_FOLDING = str.maketrans({'ي': 'ی', 'ى': 'ی', 'ك': 'ک', '\u200c': ''})
+
+def name_lookup_key(name):
+    return " ".join(name.translate(NAME_FOLDING).split()).lower()
+
+class NameIndex:
+    # In-memory name -> ids map for one table. The listener thread loads it
+    # and then applies the name_lookup notifications the 0008 triggers send
+    # on every insert, rename and delete. Until it is ready, lookups go to
+    # the database through the name_lookup_key() expression index.
+    def __init__(self, table, id_column):
+        self.table = table
+        self.id_column = id_column
+        self.ready = False
+        self._ids_by_key = {}
+        self._key_by_id = {}
+        self._lock = threading.Lock()
+
+    def load(self, cursor):
+        cursor.execute(f"SELECT {self.id_column}, name FROM {self.table}")
+        ids_by_key = {}
+        key_by_id = {}
+        for row_id, name in cursor.fetchall():
+            key = name_lookup_key(name)
+            ids_by_key.setdefault(key, set()).add(row_id)
+            key_by_id[row_id] = key
+        with self._lock:
+            self._ids_by_key = ids_by_key
+            self._key_by_id = key_by_id
+            self.ready = True
+
+    def reset(self):
+        with self._lock:
+            self.ready = False
+            self._ids_by_key = {}
+            self._key_by_id = {}
+
+    def apply(self, row_id, name):
+        with self._lock:
+            old_key = self._key_by_id.pop(row_id, None)
+            if old_key is not None:
+                ids = self._ids_by_key[old_key]
+                ids.discard(row_id)
+                if not ids:
+                    del self._ids_by_key[old_key]
+            if name is not None:
+                key = name_lookup_key(name)
+                self._ids_by_key.setdefault(key, set()).add(row_id)
+                self._key_by_id[row_id] = key
+
+    def find(self, name):
+        with self._lock:
+            if self.ready:
+                return sorted(self._ids_by_key.get(name_lookup_key(name), ()))
+        return self.find_in_database(name)
+
+    def find_in_database(self, name):
+        connection = get_db_connection()
+        if not connection:
+            return []
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                f"SELECT {self.id_column} FROM {self.table} WHERE name_lookup_key(name) = name_lookup_key(%s) ORDER BY {self.id_column};",
+                (name,)
+            )
+            return [row[0] for row in cursor.fetchall()]
+        except Error as e:
+            print(f"DB error: {e}")
+            return []
+        finally:
+            cursor.close() # type: ignore
+            connection.close()
+
+name_indexes = {
+    'fighter': NameIndex('fighter', 'fighter_id'),
+    'gym': NameIndex('gym', 'gym_id'),
+}
+
+def apply_name_change(payload):
+    try:
+        change = json.loads(payload)
+        index = name_indexes[change['table']]
+        index.apply(change['id'], change['name'])
+    except (ValueError, KeyError) as e:
+        print(f"Ignoring malformed name change {payload!r}: {e}")
+
+def listen_for_name_changes():
+    # LISTEN needs a connection of its own for as long as the bot runs, so
+    # this one does not come from the pool. It also carries the entity
+    # cache invalidations; while it is down, rows changed by other bot
+    # processes can be served stale for up to ENTITY_CACHE_TTL.
+    while True:
+        connection = None
+        try:
+            connection = psycopg2.connect(DB_URI)
+            connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute("LISTEN name_lookup")
+            cursor.execute("LISTEN entity_change")
+            # Loading after LISTEN means no change can slip in between.
+            for index in name_indexes.values():
+                index.load(cursor)
+            clear_entity_caches()
+
+            while True:
+                if select.select([connection], [], [], NAME_INDEX_KEEPALIVE) == ([], [], []):
+                    cursor.execute("SELECT 1")
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    if notify.channel == 'entity_change':
+                        apply_entity_change(notify.payload)
+                    else:
+                        apply_name_change(notify.payload)
+        except Error as e:
+            print(f"Name index listener error: {e}")
+        finally:
+            for index in name_indexes.values():
+                index.reset()
+            if connection is not None:
+                connection.close()
+        time.sleep(NAME_INDEX_RETRY_DELAY)
+
+def start_name_index_listener():
+    thread = threading.Thread(target=listen_for_name_changes, name='name-index-listener', daemon=True)
+    thread.start()
+    return thread
+
+# A bare number is taken as the row's id, which is how the user settles a
+# name that matches more than one row.
+@traced
+def find_gym_ids_by_name(gym_name):
+    if gym_name.isdigit():
+        return [int(gym_name)] if get_gym_by_id(int(gym_name)) else []
+    return name_indexes['gym'].find(gym_name)
+
+@traced
+def find_fighter_ids_by_name(fighter_name):
+    if fighter_name.isdigit():
+        return [int(fighter_name)] if get_fighter_by_id(int(fighter_name)) else []
+    return name_indexes['fighter'].find(fighter_name)
+
+def ambiguous_gym_text(gym_name, gym_ids):
+    response = ResponseBuilder(f"چند باشگاه با نام '{gym_name}' ثبت شده است. لطفاً شناسه باشگاه مورد نظر را وارد کنید:\n\n")
+    for gym_id in gym_ids:
+        gym = get_gym_by_id(gym_id)
+        if gym and not response.add(f"شناسه {gym_id}: {gym['name']} - {gym['location']}\n"):
+            break
+    return response.text()
+
+def ambiguous_fighter_text(fighter_name, fighter_ids):
+    response = ResponseBuilder(f"چند مبارز با نام '{fighter_name}' ثبت شده است. لطفاً شناسه مبارز مورد نظر را وارد کنید:\n\n")
+    for fighter_id in fighter_ids:
+        fighter = get_fighter_by_id(fighter_id)
+        if fighter and not response.add(f"شناسه {fighter_id}: {fighter['name']} ({fighter['nickname'] or 'بدون نام مستعار'}) - {fighter['gym_name'] or 'بدون باشگاه'}\n"):
+            break
+    return response.text()
+
+# endregion
+
 # region --------------------------- Buttons ----------------------------
 
 def login_menu():
@@ -391,7 +2862,7 @@ def delete_menu():
 
 # region ------------------------ Start Handlers ------------------------
 
-@bot.message_handler(commands=['start', 'login'])
+@router.command('start', 'login')
 def start_command(message):
     chat_id = message.chat.id
     
@@ -405,48 +2876,42 @@ def start_command(message):
 """
     bot.send_message(chat_id, welcome_text, reply_markup=login_menu())
 
-@bot.message_handler(func=lambda message: message.text == 'ورود به سیستم')
+@router.text('ورود به سیستم')
 def ask_for_username(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "نام کاربری خود را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
-    bot.register_next_step_handler(msg, process_username)
+    bot.send_message(chat_id, "نام کاربری خود را وارد کنید:", reply_markup=types.ReplyKeyboardRemove())
+    set_next_step(chat_id, process_username)
 
+@conversation_step
 def process_username(message):
     chat_id = message.chat.id
     username = message.text.strip()
     
-    if 'temp_data' not in user_sessions:
-        user_sessions['temp_data'] = {}
-    user_sessions['temp_data'][chat_id] = {'username': username}
-    
-    msg = bot.send_message(chat_id, "رمز عبور را وارد کنید:")
-    bot.register_next_step_handler(msg, process_password, username)
+    bot.send_message(chat_id, "رمز عبور را وارد کنید:")
+    set_next_step(chat_id, process_password, username)
 
+@conversation_step
 def process_password(message, username):
     chat_id = message.chat.id
     password = message.text.strip()
     
     if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
-        user_sessions[chat_id] = True
+        sessions.create(chat_id)
         bot.send_message(chat_id, "ورود موفقیت‌آمیز بود!")
         send_welcome(message)
     else:
         bot.send_message(chat_id, "نام کاربری یا رمز عبور اشتباه است.")
         ask_for_username(message)
 
-@bot.message_handler(func=lambda message: message.text == 'خروج از سیستم')
+@router.text('خروج از سیستم')
 @login_required
 def logout_command(message):
     chat_id = message.chat.id
-    if chat_id in user_sessions:
-        del user_sessions[chat_id]
-    
-    if 'temp_data' in user_sessions and chat_id in user_sessions['temp_data']:
-        del user_sessions['temp_data'][chat_id]
+    sessions.delete(chat_id)
     
     bot.send_message(chat_id, "خروج موفقیت‌آمیز بود!", reply_markup=login_menu())
 
-@bot.message_handler(commands=['menu', 'help'])
+@router.command('menu', 'help')
 @login_required
 def send_welcome(message):
     chat_id = message.chat.id
@@ -456,229 +2921,441 @@ def send_welcome(message):
 """
     bot.send_message(chat_id, welcome_text, reply_markup=main_menu())
 
-@bot.message_handler(func=lambda m: m.text == "لغو عملیات")
+@router.text("لغو عملیات")
 def cancel_process(message):
     chat_id = message.chat.id
 
-    bot.clear_step_handler_by_chat_id(chat_id)
+    clear_next_step(chat_id)
     bot.send_message(chat_id, "عملیات لغو شد.", reply_markup=main_menu())
 
-@bot.message_handler(func=lambda message: message.text == 'بازگشت به منوی اصلی')
+@router.text('بازگشت به منوی اصلی')
 @login_required
 def back_to_main_menu(message):
     send_welcome(message)
 
 # endregion
 
+# region ----------------------- Response Builder -----------------------
+
+# Telegram rejects messages over 4096 characters. Replies are rendered row
+# by row into a ResponseBuilder, which only ever breaks between rows, so a
+# record is never cut in half and the Markdown in it stays balanced.
+TELEGRAM_MESSAGE_LIMIT = 4096
+ROW_SEPARATOR = "-" * 40 + "\n"
+
+class ResponseBuilder:
+    def __init__(self, header="", limit=TELEGRAM_MESSAGE_LIMIT):
+        self.limit = limit
+        self.rows = 0
+        self._parts = [header] if header else []
+        self._length = len(header)
+
+    def add(self, row):
+        # Returns False when the row does not fit. The first row of a
+        # message is cut to fit instead, so a page always makes progress.
+        if self._length + len(row) > self.limit:
+            if self.rows:
+                return False
+            row = row[:max(0, self.limit - self._length - 1)] + "…"
+        self._parts.append(row)
+        self._length += len(row)
+        self.rows += 1
+        return True
+
+    def text(self):
+        return "".join(self._parts)
+
+    def take(self):
+        text = self.text()
+        self._parts = []
+        self._length = 0
+        self.rows = 0
+        return text
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    # Splits on line boundaries; a line longer than a whole message is cut.
+    chunks = []
+    current = []
+    length = 0
+    for line in text.splitlines(keepends=True):
+        for start in range(0, len(line), limit):
+            piece = line[start:start + limit]
+            if length + len(piece) > limit:
+                chunks.append("".join(current))
+                current = []
+                length = 0
+            current.append(piece)
+            length += len(piece)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def send_response(chat_id, text, parse_mode=None, reply_markup=None):
+    # The single send pipeline for rendered replies: chunks go out in order
+    # and only the last one carries the keyboard.
+    chunks = split_message(text) or [text]
+    for index, chunk in enumerate(chunks):
+        markup = reply_markup if index == len(chunks) - 1 else None
+        bot.send_message(chat_id, chunk, parse_mode=parse_mode, reply_markup=markup)
+
+class ResponseStream:
+    # For replies with no natural page size: each message is sent as soon
+    # as it is full, so only one message worth of text is held at a time.
+    def __init__(self, chat_id, header="", parse_mode=None, reply_markup=None):
+        self.chat_id = chat_id
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self._builder = ResponseBuilder(header)
+
+    def add(self, row):
+        for piece in split_message(row):
+            if not self._builder.add(piece):
+                send_response(self.chat_id, self._builder.take(), self.parse_mode)
+                self._builder.add(piece)
+
+    def close(self):
+        send_response(self.chat_id, self._builder.take(), self.parse_mode, self.reply_markup)
+
+def stream_cursor(conn, name):
+    # A server-side cursor for replies fed into a ResponseStream: rows come
+    # over STREAM_ITERSIZE at a time as the loop asks for them, instead of
+    # the whole result landing in memory at execute().
+    cur = conn.cursor(name=name)
+    cur.itersize = STREAM_ITERSIZE
+    return cur
+
+# endregion
+
 # region ----------------------- Display Handlers -----------------------
 
-@bot.message_handler(func=lambda message: message.text == 'نمایش مبارزین')
-@login_required
-def show_fighters(message):
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(message.chat.id, "خطا در اتصال به پایگاه داده.")
-        return
-    
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT f.fighter_id, f.name, f.nickname, f.weight_class, f.age, 
-                   f.nationality, f.status, g.name as gym_name
-            FROM fighter f
-            LEFT JOIN gym g ON f.gym_id = g.gym_id
-            ORDER BY f.name
-            LIMIT 50
-        """)
-        fighters = cur.fetchall()
-        
-        if not fighters:
-            bot.send_message(message.chat.id, "هیچ مبارزی در باشگاه ثبت نشده است.")
-            return
+# Listings are keyset-paginated: each page is one indexed range query that
+# starts after the last row of the previous page, never an OFFSET scan. The
+# callback data carries that row's whole sort key, (name, id) or
+# (start_date, match_id), so the next page still works after the row itself
+# is deleted. Callback data is capped at 64 bytes; a name too long for it is
+# kept server side under a short token instead. A page that reaches the
+# message limit before LIST_PAGE_SIZE rows simply ends early, and the next
+# one continues from its last rendered row.
+
+CALLBACK_DATA_LIMIT = 64
+
+list_page_keys = OrderedDict()
+list_page_keys_lock = threading.Lock()
+
+def next_page_key(last, more):
+    # Every listing selects its id first and its sort column second.
+    if more:
+        return (last[1], last[0])
+    return None
+
+def page_callback_data(view, key):
+    sort_value, row_id = key
+    text = sort_value.isoformat() if isinstance(sort_value, datetime) else sort_value
+    data = f"page:{view}:{row_id}:={text}"
+    if len(data.encode('utf-8')) <= CALLBACK_DATA_LIMIT:
+        return data
+    token = secrets.token_urlsafe(6)
+    with list_page_keys_lock:
+        list_page_keys[token] = text
+        while len(list_page_keys) > SEARCH_CONTINUATIONS_MAX:
+            list_page_keys.popitem(last=False)
+    return f"page:{view}:{row_id}:~{token}"
+
+def parse_page_key(view, row_id, raw):
+    # Returns the (sort value, id) key, or None if it is malformed or its
+    # token has been evicted.
+    if not row_id.isdigit():
+        return None
+    if raw.startswith('='):
+        text = raw[1:]
+    elif raw.startswith('~'):
+        with list_page_keys_lock:
+            text = list_page_keys.get(raw[1:])
+        if text is None:
+            return None
+    else:
+        return None
+    if view == 'events':
+        try:
+            return (datetime.fromisoformat(text), int(row_id))
+        except ValueError:
+            return None
+    return (text, int(row_id))
+
+def list_page_query(name, sql, after_filter):
+    # The first page and the pages after it are two different statements,
+    # each prepared on its own.
+    prepared_query(name, sql.replace('{after}', ''))
+    prepared_query(f"{name}_after", sql.replace('{after}', after_filter))
+    return name
+
+def execute_list_page(cur, name, after):
+    if after:
+        execute_prepared(cur, f"{name}_after", (*after, LIST_PAGE_SIZE + 1))
+    else:
+        execute_prepared(cur, name, (LIST_PAGE_SIZE + 1,))
+
+FIGHTERS_PAGE = list_page_query('fighters_page', """
+    SELECT f.fighter_id, f.name, f.nickname, f.weight_class, f.age, 
+           f.nationality, f.status, g.name as gym_name
+    FROM fighter f
+    LEFT JOIN gym g ON f.gym_id = g.gym_id
+    {after}
+    ORDER BY f.name, f.fighter_id
+    LIMIT %s
+""",
+    "WHERE (f.name, f.fighter_id) > (%s, %s)")
+
+def render_fighters_page(cur, after):
+    execute_list_page(cur, FIGHTERS_PAGE, after)
+    status_dict = {'active': 'فعال', 'retired': 'بازنشسته', 'suspended': 'تعلیق شده'}
+
+    page = ResponseBuilder("لیست مبارزین:\n\n")
+    last, more = None, False
+    for fighter in cur:
+        if page.rows == LIST_PAGE_SIZE:
+            more = True
+            break
+        if not page.add(
+            f"{fighter[1]}\n"
+            f"شناسه مبارز: {fighter[0]}\n"
+            f"نام مستعار: {fighter[2] or 'ثبت نشده'}\n"
+            f"رده وزنی: {fighter[3]}\n"
+            f"سن: {fighter[4]}\n"
+            f"ملیت: {fighter[5]}\n"
+            f"وضعیت: {status_dict.get(fighter[6], 'نامشخص')}\n"
+            f"باشگاه: {fighter[7] or 'ثبت نشده'}\n"
+            + ROW_SEPARATOR
+        ):
+            more = True
+            break
+        last = fighter
+    if last is None:
+        return None, None
+    return page.text(), next_page_key(last, more)
+
+GYMS_PAGE = list_page_query('gyms_page', """
+    SELECT g.gym_id, g.name, g.location, g.owner, g.reputation_score,
+           fc.fighter_count, tc.trainer_count
+    FROM gym g
+    CROSS JOIN LATERAL (SELECT COUNT(*) AS fighter_count FROM fighter f WHERE f.gym_id = g.gym_id) fc
+    CROSS JOIN LATERAL (SELECT COUNT(*) AS trainer_count FROM trainer t WHERE t.gym_id = g.gym_id) tc
+    {after}
+    ORDER BY g.name, g.gym_id
+    LIMIT %s
+""",
+    "WHERE (g.name, g.gym_id) > (%s, %s)")
+
+def render_gyms_page(cur, after):
+    execute_list_page(cur, GYMS_PAGE, after)
+    page = ResponseBuilder("لیست باشگاه‌ها:\n\n")
+    last, more = None, False
+    for gym in cur:
+        if page.rows == LIST_PAGE_SIZE:
+            more = True
+            break
+        if not page.add(
+            f"{gym[1]}\n"
+            f"شناسه باشگاه: {gym[0]}\n"
+            f"مکان: {gym[2]}\n"
+            f"مالک: {gym[3]}\n"
+            f"امتیاز شهرت: {gym[4]}\n"
+            f"تعداد مبارزین: {gym[5]}\n"
+            f"تعداد مربیان: {gym[6]}\n"
+            + ROW_SEPARATOR
+        ):
+            more = True
+            break
+        last = gym
+    if last is None:
+        return None, None
+    return page.text(), next_page_key(last, more)
+
+TRAINERS_PAGE = list_page_query('trainers_page', """
+    SELECT t.trainer_id, t.name as trainer_name, t.specialty, g.name as gym_name,
+           sc.active_count, sc.past_count
+    FROM trainer t
+    LEFT JOIN gym g ON t.gym_id = g.gym_id
+    CROSS JOIN LATERAL (
+        SELECT COUNT(*) FILTER (WHERE ft.end_date IS NULL) AS active_count,
+               COUNT(*) FILTER (WHERE ft.end_date IS NOT NULL) AS past_count
+        FROM fighter_trainer ft
+        WHERE ft.trainer_id = t.trainer_id
+    ) sc
+    {after}
+    ORDER BY t.name, t.trainer_id
+    LIMIT %s
+""",
+    "WHERE (t.name, t.trainer_id) > (%s, %s)")
+
+def render_trainers_page(cur, after):
+    execute_list_page(cur, TRAINERS_PAGE, after)
+    page = ResponseBuilder("لیست مربی‌ها:\n\n")
+    last, more = None, False
+    for trainer in cur:
+        if page.rows == LIST_PAGE_SIZE:
+            more = True
+            break
+        if not page.add(
+            f"{trainer[1]}\n"
+            f"شناسه مربی: {trainer[0]}\n"
+            f"تخصص: {trainer[2]}\n"
+            f"باشگاه: {trainer[3] or 'ثبت نشده'}\n"
+            f"تعداد شاگردان: {trainer[4] + trainer[5]}\n"
+            f"شاگردان فعال: {trainer[4]}\n"
+            f"شاگردان گذشته: {trainer[5]}\n"
+            + ROW_SEPARATOR
+        ):
+            more = True
+            break
+        last = trainer
+    if last is None:
+        return None, None
+    return page.text(), next_page_key(last, more)
+
+EVENTS_PAGE = list_page_query('events_page', """
+    SELECT me.match_id, me.start_date, me.end_date,me.location,f1.name as fighter1_name,f2.name as fighter2_name,p1.result as fighter1_result,p2.result as fighter2_result
+    FROM match_event me
+    JOIN participants p1 ON me.match_id = p1.match_id
+    JOIN participants p2 ON me.match_id = p2.match_id
+    JOIN fighter f1 ON p1.fighter_id = f1.fighter_id
+    JOIN fighter f2 ON p2.fighter_id = f2.fighter_id
+    WHERE p1.fighter_id < p2.fighter_id
+    {after}
+    ORDER BY me.start_date DESC, me.match_id DESC
+    LIMIT %s
+""",
+    "AND (me.start_date, me.match_id) < (%s, %s)")
+
+def render_events_page(cur, after):
+    execute_list_page(cur, EVENTS_PAGE, after)
+    page = ResponseBuilder("آخرین رویدادها:\n\n")
+    last, more = None, False
+    for event in cur:
+        if page.rows == LIST_PAGE_SIZE:
+            more = True
+            break
+        match_id, start_date, end_date, location, fighter1_name, fighter2_name, fighter1_result, fighter2_result = event
         
-        status_dict = {'active': 'فعال', 'retired': 'بازنشسته', 'suspended': 'تعلیق شده'}
-
-        response = "لیست مبارزین:\n\n"
-        for fighter in fighters:
-            response += f"{fighter[1]}\n"
-            response += f"شناسه مبارز: {fighter[0]}\n"
-            response += f"نام مستعار: {fighter[2] or 'ثبت نشده'}\n"
-            response += f"رده وزنی: {fighter[3]}\n"
-            response += f"سن: {fighter[4]}\n"
-            response += f"ملیت: {fighter[5]}\n"
-            response += f"وضعیت: {status_dict.get(fighter[6], 'نامشخص')}\n"
-            response += f"باشگاه: {fighter[7] or 'ثبت نشده'}\n"
-            response += "-" * 40 + "\n"
-
-        bot.send_message(message.chat.id, response, parse_mode='Markdown')
-        cur.close()
-    except Error as e:
-        bot.send_message(message.chat.id, f"خطا در دریافت اطلاعات: {e}")
-    finally:
-        if conn:
-            conn.close()
+        if fighter1_result == 'win':
+            result_text = f"پیروزی {fighter1_name}"
+        elif fighter2_result == 'win':
+            result_text = f"پیروزی {fighter2_name}"
+        elif fighter1_result == 'draw':
+            result_text = "تساوی"
+        elif fighter1_result == 'no contest':
+            result_text = "نامعلوم"
+        else:
+            result_text = "ثبت نشده"
+        
+        end_time = end_date.strftime('%H:%M') if end_date else "ثبت نشده"
+        
+        if not page.add(
+            f"رویداد {match_id}\n"
+            f"تاریخ: {start_date.strftime('%Y-%m-%d')}\n"
+            f"ساعت شروع: {start_date.strftime('%H:%M')}\n"
+            f"ساعت پایان: {end_time}\n"
+            f"مکان: {location}\n"
+            f"مبارزین: {fighter1_name} و {fighter2_name}\n"
+            f"نتیجه: {result_text}\n"
+            + ROW_SEPARATOR
+        ):
+            more = True
+            break
+        last = event
+    if last is None:
+        return None, None
+    return page.text(), next_page_key(last, more)
+
+LIST_VIEWS = {
+    'fighters': (render_fighters_page, "هیچ مبارزی در باشگاه ثبت نشده است."),
+    'gyms': (render_gyms_page, "هیچ باشگاهی ثبت نشده است."),
+    'trainers': (render_trainers_page, "هیچ مربی‌ای ثبت نشده است."),
+    'events': (render_events_page, "هیچ رویدادی ثبت نشده است."),
+}
+
+def list_page_markup(view, after, next_key):
+    buttons = []
+    if after:
+        buttons.append(types.InlineKeyboardButton("صفحه اول", callback_data=f"page:{view}:0"))
+    if next_key:
+        buttons.append(types.InlineKeyboardButton("صفحه بعد", callback_data=page_callback_data(view, next_key)))
+    if not buttons:
+        return None
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(*buttons)
+    return markup
+
+def send_list_page(chat_id, view, after=None, message_id=None):
+    render_page, empty_text = LIST_VIEWS[view]
 
-@bot.message_handler(func=lambda message: message.text == 'نمایش باشگاه‌ها')
-@login_required
-def show_gyms(message):
     conn = get_db_connection()
     if conn is None:
-        bot.send_message(message.chat.id, "خطا در اتصال به پایگاه داده.")
+        bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
         return
     
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT gym_id, name, location, owner, reputation_score
-            FROM gym
-            ORDER BY name
-            LIMIT 50
-        """)
-        gyms = cur.fetchall()
-        
-        if not gyms:
-            bot.send_message(message.chat.id, "هیچ باشگاهی ثبت نشده است.")
+        response, next_key = render_page(cur, after)
+        cur.close()
+
+        if response is None:
+            if message_id is None:
+                bot.send_message(chat_id, empty_text)
             return
-        
-        response = "لیست باشگاه‌ها:\n\n"
-        for gym in gyms:
-            response += f"{gym[1]}\n"
-            response += f"شناسه باشگاه: {gym[0]}\n"
-            response += f"مکان: {gym[2]}\n"
-            response += f"مالک: {gym[3]}\n"
-            response += f"امتیاز شهرت: {gym[4]}\n"
 
-            cur.execute("""
-                SELECT COUNT(*) FROM fighter WHERE gym_id = %s
-            """, (gym[0],))
-            fighter_count = cur.fetchone()[0] # type: ignore
-            
-            cur.execute("""
-                SELECT COUNT(*) FROM trainer WHERE gym_id = %s
-            """, (gym[0],))
-            trainer_count = cur.fetchone()[0] # type: ignore
-            
-            response += f"تعداد مبارزین: {fighter_count}\n"
-            response += f"تعداد مربیان: {trainer_count}\n"
-            response += "-" * 40 + "\n"
-        
-        bot.send_message(message.chat.id, response, parse_mode='Markdown')
-        cur.close()
+        markup = list_page_markup(view, after, next_key)
+        if message_id is None:
+            bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+        else:
+            bot.edit_message_text(response, chat_id, message_id, parse_mode='Markdown', reply_markup=markup)
     except Error as e:
-        bot.send_message(message.chat.id, f"خطا در دریافت اطلاعات: {e}")
+        bot.send_message(chat_id, f"خطا در دریافت اطلاعات: {e}")
     finally:
         if conn:
             conn.close()
 
-@bot.message_handler(func=lambda message: message.text == 'نمایش مربی‌ها')
+@router.text('نمایش مبارزین')
 @login_required
-def show_trainers(message):
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(message.chat.id, "خطا در اتصال به پایگاه داده.")
-        return
-    
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT t.trainer_id, t.name as trainer_name, t.specialty, g.name as gym_name
-            FROM trainer t
-            LEFT JOIN gym g ON t.gym_id = g.gym_id
-            ORDER BY t.name
-            LIMIT 50
-        """)
-        trainers = cur.fetchall()
-        
-        if not trainers:
-            bot.send_message(message.chat.id, "هیچ مربی‌ای ثبت نشده است.")
-            return
+def show_fighters(message):
+    send_list_page(message.chat.id, 'fighters')
 
-        response = "لیست مربی‌ها:\n\n"
-        for trainer in trainers:
-            response += f"{trainer[1]}\n"
-            response += f"شناسه مربی: {trainer[0]}\n"
-            response += f"تخصص: {trainer[2]}\n"
-            response += f"باشگاه: {trainer[3] or 'ثبت نشده'}\n"
+@router.text('نمایش باشگاه‌ها')
+@login_required
+def show_gyms(message):
+    send_list_page(message.chat.id, 'gyms')
 
-            cur.execute("""
-                SELECT COUNT(*) FROM fighter_trainer WHERE trainer_id = %s
-            """, (trainer[0],))
-            fighter_count = cur.fetchone()[0] # type: ignore
-            
-            response += f"تعداد شاگردان: {fighter_count}\n"
-            response += "-" * 40 + "\n"
-        
-        bot.send_message(message.chat.id, response, parse_mode='Markdown')
-        cur.close()
-    except Error as e:
-        bot.send_message(message.chat.id, f"خطا در دریافت اطلاعات: {e}")
-    finally:
-        if conn:
-            conn.close()
+@router.text('نمایش مربی‌ها')
+@login_required
+def show_trainers(message):
+    send_list_page(message.chat.id, 'trainers')
 
-@bot.message_handler(func=lambda message: message.text == 'نمایش رویدادها')
+@router.text('نمایش رویدادها')
 @login_required
 def show_events(message):
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(message.chat.id, "خطا در اتصال به پایگاه داده.")
+    send_list_page(message.chat.id, 'events')
+
+@router.callback('page')
+def list_page_callback(call):
+    chat_id = call.message.chat.id
+    if not check_login(chat_id):
+        bot.answer_callback_query(call.id, "Please log in first.")
         return
-    
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT me.match_id, me.start_date, me.end_date,me.location,f1.name as fighter1_name,f2.name as fighter2_name,p1.result as fighter1_result,p2.result as fighter2_result
-            FROM match_event me
-            JOIN participants p1 ON me.match_id = p1.match_id
-            JOIN participants p2 ON me.match_id = p2.match_id
-            JOIN fighter f1 ON p1.fighter_id = f1.fighter_id
-            JOIN fighter f2 ON p2.fighter_id = f2.fighter_id
-            WHERE p1.fighter_id < p2.fighter_id
-            ORDER BY me.start_date DESC
-            LIMIT 50
-        """)
-        events = cur.fetchall()
-        
-        if not events:
-            bot.send_message(message.chat.id, "هیچ رویدادی ثبت نشده است.")
-            return
 
-        response = "آخرین رویدادها:\n\n"
-        for event in events:
-            match_id, start_date, end_date, location, fighter1_name, fighter2_name, fighter1_result, fighter2_result = event
-            
-            if fighter1_result == 'win':
-                result_text = f"پیروزی {fighter1_name}"
-            elif fighter2_result == 'win':
-                result_text = f"پیروزی {fighter2_name}"
-            elif fighter1_result == 'draw':
-                result_text = "تساوی"
-            elif fighter1_result == 'no contest':
-                result_text = "نامعلوم"
-            else:
-                result_text = "ثبت نشده"
-            
-            response += f"رویداد {match_id}\n"
-            response += f"تاریخ: {start_date.strftime('%Y-%m-%d')}\n"
-            response += f"ساعت شروع: {start_date.strftime('%H:%M')}\n"
-            
-            if end_date:
-                response += f"ساعت پایان: {end_date.strftime('%H:%M')}\n"
-            else:
-                response += f"ساعت پایان: ثبت نشده\n"
-            
-            response += f"مکان: {location}\n"
-            response += f"مبارزین: {fighter1_name} و {fighter2_name}\n"
-            response += f"نتیجه: {result_text}\n"
-            response += "-" * 40 + "\n"
-        
-        bot.send_message(message.chat.id, response, parse_mode='Markdown')
-        cur.close()
-    except Error as e:
-        bot.send_message(message.chat.id, f"خطا در دریافت اطلاعات: {e}")
-    finally:
-        if conn:
-            conn.close()
+    parts = call.data.split(':', 3)
+    view = parts[1] if len(parts) > 1 else None
+    if view not in LIST_VIEWS:
+        bot.answer_callback_query(call.id)
+        return
+
+    after = None
+    if len(parts) == 4:
+        after = parse_page_key(view, parts[2], parts[3])
+        if after is None:
+            bot.answer_callback_query(call.id, "این صفحه منقضی شده است. لطفاً فهرست را دوباره باز کنید.")
+            return
+    send_list_page(chat_id, view, after, call.message.message_id)
+    bot.answer_callback_query(call.id)
 
 # endregion
 
@@ -686,13 +3363,14 @@ def show_events(message):
 
 # region ----------- Add Fighter Handler -----------
 
-@bot.message_handler(func=lambda message: message.text == 'اضافه کردن مبارز')
+@router.text('اضافه کردن مبارز')
 @login_required
 def add_fighter_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً نام مبارز جدید را وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_fighter_name)
+    bot.send_message(chat_id, "لطفاً نام مبارز جدید را وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_fighter_name)
 
+@conversation_step
 def process_fighter_name(message):
     chat_id = message.chat.id
     full_name = message.text.strip()
@@ -702,13 +3380,14 @@ def process_fighter_name(message):
         return
     
     if not full_name or len(full_name) < 2:
-        msg = bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
-        bot.register_next_step_handler(msg, process_gym_name)
+        bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
+        set_next_step(chat_id, process_gym_name)
         return
     
-    msg = bot.send_message(chat_id, "لطفاً نام مستعار مبارز را وارد کنید (اختیاری):")
-    bot.register_next_step_handler(msg, process_fighter_nickname, full_name)
+    bot.send_message(chat_id, "لطفاً نام مستعار مبارز را وارد کنید (اختیاری):")
+    set_next_step(chat_id, process_fighter_nickname, full_name)
 
+@conversation_step
 def process_fighter_nickname(message, full_name):
     chat_id = message.chat.id
     nickname = message.text.strip() if message.text else None
@@ -720,9 +3399,10 @@ def process_fighter_nickname(message, full_name):
     if nickname == "اختیاری" or nickname == "ندارد" or nickname == "خالی":
         nickname = None
 
-    msg = bot.send_message(chat_id, "لطفاً رده وزنی مبارز را وارد کنید:")
-    bot.register_next_step_handler(msg, process_fighter_weight_class, full_name, nickname)
+    bot.send_message(chat_id, "لطفاً رده وزنی مبارز را وارد کنید:")
+    set_next_step(chat_id, process_fighter_weight_class, full_name, nickname)
 
+@conversation_step
 def process_fighter_weight_class(message, full_name, nickname):
     chat_id = message.chat.id
     weight_class = message.text.strip()
@@ -732,13 +3412,14 @@ def process_fighter_weight_class(message, full_name, nickname):
         return
 
     if not weight_class:
-        msg = bot.send_message(chat_id, "رده وزنی وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
-        bot.register_next_step_handler(msg, process_gym_location, full_name, nickname)
+        bot.send_message(chat_id, "رده وزنی وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
+        set_next_step(chat_id, process_gym_location, full_name, nickname)
         return
 
-    msg = bot.send_message(chat_id, "لطفاً سن مبارز را وارد کنید:")
-    bot.register_next_step_handler(msg, process_fighter_age, full_name, nickname, weight_class)
+    bot.send_message(chat_id, "لطفاً سن مبارز را وارد کنید:")
+    set_next_step(chat_id, process_fighter_age, full_name, nickname, weight_class)
 
+@conversation_step
 def process_fighter_age(message, full_name, nickname, weight_class):
     chat_id = message.chat.id
     age_str = message.text.strip()
@@ -749,18 +3430,19 @@ def process_fighter_age(message, full_name, nickname, weight_class):
         return
 
     if not age_str.isdigit() or age <= 0 or not age:
-        msg = bot.send_message(chat_id, "سن وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
-        bot.register_next_step_handler(msg, process_gym_owner, full_name, nickname, weight_class)
+        bot.send_message(chat_id, "سن وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
+        set_next_step(chat_id, process_gym_owner, full_name, nickname, weight_class)
         return
     
     if age < 18:
-        msg = bot.send_message(chat_id, "سن مبارز باید حداقل 18 سال باشد.")
-        bot.register_next_step_handler(msg, process_fighter_age, full_name, nickname, weight_class)
+        bot.send_message(chat_id, "سن مبارز باید حداقل 18 سال باشد.")
+        set_next_step(chat_id, process_fighter_age, full_name, nickname, weight_class)
         return
 
-    msg = bot.send_message(chat_id, "لطفاً ملیت مبارز را وارد کنید:")
-    bot.register_next_step_handler(msg, process_fighter_nationality, full_name, nickname, weight_class, age)
+    bot.send_message(chat_id, "لطفاً ملیت مبارز را وارد کنید:")
+    set_next_step(chat_id, process_fighter_nationality, full_name, nickname, weight_class, age)
 
+@conversation_step
 def process_fighter_nationality(message, full_name, nickname, weight_class, age):
     chat_id = message.chat.id
     nationality = message.text.strip() if message.text else None
@@ -769,9 +3451,10 @@ def process_fighter_nationality(message, full_name, nickname, weight_class, age)
         cancel_process(message)
         return
 
-    msg = bot.send_message(chat_id, "لطفاً نام باشگاه مبارز را وارد کنید:")
-    bot.register_next_step_handler(msg, process_fighter_gym, full_name, nickname, weight_class, age, nationality)
+    bot.send_message(chat_id, "لطفاً نام باشگاه مبارز را وارد کنید:")
+    set_next_step(chat_id, process_fighter_gym, full_name, nickname, weight_class, age, nationality)
 
+@conversation_step
 def process_fighter_gym(message, full_name, nickname, weight_class, age, nationality):
     chat_id = message.chat.id
     gym_name = message.text.strip() if message.text else None
@@ -781,19 +3464,24 @@ def process_fighter_gym(message, full_name, nickname, weight_class, age, nationa
         return
 
     if not gym_name:
-        msg = bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید:")
+        bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید:")
         reply_markup = cancel_menu()
-        bot.register_next_step_handler(msg, process_fighter_gym, full_name, nickname, weight_class, age, nationality)
+        set_next_step(chat_id, process_fighter_gym, full_name, nickname, weight_class, age, nationality)
         return
     
-    gym_id = get_gym_id_by_name(gym_name)
+    gym_ids = find_gym_ids_by_name(gym_name)
 
-    if gym_id is None:
-        msg = bot.send_message(chat_id, "چنین باشگاهی ثبت نشده است. لطفاً نام باشگاه را مجدداً وارد کنید:")
+    if not gym_ids:
+        bot.send_message(chat_id, "چنین باشگاهی ثبت نشده است. لطفاً نام باشگاه را مجدداً وارد کنید:")
         reply_markup = cancel_menu()
-        bot.register_next_step_handler(msg, process_fighter_gym, full_name, nickname, weight_class, age, nationality)
+        set_next_step(chat_id, process_fighter_gym, full_name, nickname, weight_class, age, nationality)
+        return
+    elif len(gym_ids) > 1:
+        bot.send_message(chat_id, ambiguous_gym_text(gym_name, gym_ids))
+        set_next_step(chat_id, process_fighter_gym, full_name, nickname, weight_class, age, nationality)
         return
     else:
+        gym_id = gym_ids[0]
         conn = get_db_connection()
         if conn is None:
             bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
@@ -802,10 +3490,11 @@ def process_fighter_gym(message, full_name, nickname, weight_class, age, nationa
         try:
             cur = conn.cursor()
             cur.execute("""
-                INSERT INTO fighter (name, nickname, weight_class, age, nationality, gym_id)
-                VALUES (%s, %s, %s, %s, %s, %s)
+                INSERT INTO fighter (name, nickname, weight_class, age, nationality, gym_id, search_key, search_skeleton)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                 RETURNING fighter_id
-            """, (full_name, nickname, weight_class, age, nationality, gym_id))
+            """, (full_name, nickname, weight_class, age, nationality, gym_id,
+                  normalize_search_key(full_name, nickname), normalize_skeleton_key(full_name, nickname)))
 
             fighter_id = cur.fetchone()[0] # type: ignore
             conn.commit()
@@ -822,13 +3511,14 @@ def process_fighter_gym(message, full_name, nickname, weight_class, age, nationa
 
 # region ------------- Add Gym Handler -------------
 
-@bot.message_handler(func=lambda message: message.text == 'اضافه کردن باشگاه')
+@router.text('اضافه کردن باشگاه')
 @login_required
 def add_gym_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً نام باشگاه را وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_gym_name)
+    bot.send_message(chat_id, "لطفاً نام باشگاه را وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_gym_name)
 
+@conversation_step
 def process_gym_name(message):
     chat_id = message.chat.id
     full_name = message.text.strip()
@@ -838,13 +3528,14 @@ def process_gym_name(message):
         return
     
     if not full_name or len(full_name) < 2:
-        msg = bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
-        bot.register_next_step_handler(msg, process_gym_name)
+        bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
+        set_next_step(chat_id, process_gym_name)
         return
 
-    msg = bot.send_message(chat_id, "لطفاً مکان باشگاه را وارد کنید:")
-    bot.register_next_step_handler(msg, process_gym_location, full_name)
+    bot.send_message(chat_id, "لطفاً مکان باشگاه را وارد کنید:")
+    set_next_step(chat_id, process_gym_location, full_name)
 
+@conversation_step
 def process_gym_location(message, full_name):
     chat_id = message.chat.id
     location = message.text.strip()
@@ -854,13 +3545,14 @@ def process_gym_location(message, full_name):
         return
 
     if not location:
-        msg = bot.send_message(chat_id, "مکان وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
-        bot.register_next_step_handler(msg, process_gym_location, full_name)
+        bot.send_message(chat_id, "مکان وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
+        set_next_step(chat_id, process_gym_location, full_name)
         return
 
-    msg = bot.send_message(chat_id, "لطفاً نام صاحب باشگاه را وارد کنید:")
-    bot.register_next_step_handler(msg, process_gym_owner, full_name, location)
+    bot.send_message(chat_id, "لطفاً نام صاحب باشگاه را وارد کنید:")
+    set_next_step(chat_id, process_gym_owner, full_name, location)
 
+@conversation_step
 def process_gym_owner(message, full_name, location):
     chat_id = message.chat.id
     owner = message.text.strip()
@@ -870,8 +3562,8 @@ def process_gym_owner(message, full_name, location):
         return
     
     if not owner or len(owner) < 2:
-        msg = bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
-        bot.register_next_step_handler(msg, process_gym_name)
+        bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
+        set_next_step(chat_id, process_gym_name)
         return
 
     conn = get_db_connection()
@@ -882,10 +3574,10 @@ def process_gym_owner(message, full_name, location):
     try:
         cur = conn.cursor()
         cur.execute("""
-            INSERT INTO gym (name, location, owner)
-            VALUES (%s, %s, %s)
+            INSERT INTO gym (name, location, owner, search_key, search_skeleton)
+            VALUES (%s, %s, %s, %s, %s)
             RETURNING gym_id
-        """, (full_name, location, owner))
+        """, (full_name, location, owner, normalize_search_key(full_name), normalize_skeleton_key(full_name)))
 
         gym_id = cur.fetchone()[0] # type: ignore
         conn.commit()
@@ -902,13 +3594,14 @@ def process_gym_owner(message, full_name, location):
 
 # region ----------- Add Trainer Handler -----------
 
-@bot.message_handler(func=lambda message: message.text == 'اضافه کردن مربی')
+@router.text('اضافه کردن مربی')
 @login_required
 def add_trainer_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً نام مربی را وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_trainer_name)
+    bot.send_message(chat_id, "لطفاً نام مربی را وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_trainer_name)
 
+@conversation_step
 def process_trainer_name(message):
     chat_id = message.chat.id
     full_name = message.text.strip()
@@ -918,13 +3611,14 @@ def process_trainer_name(message):
         return
     
     if not full_name or len(full_name) < 2:
-        msg = bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
-        bot.register_next_step_handler(msg, process_trainer_name)
+        bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
+        set_next_step(chat_id, process_trainer_name)
         return
 
-    msg = bot.send_message(chat_id, "لطفاً تخصص مربی را وارد کنید:")
-    bot.register_next_step_handler(msg, process_trainer_specialty, full_name)
+    bot.send_message(chat_id, "لطفاً تخصص مربی را وارد کنید:")
+    set_next_step(chat_id, process_trainer_specialty, full_name)
 
+@conversation_step
 def process_trainer_specialty(message, full_name):
     chat_id = message.chat.id
     specialty = message.text.strip()
@@ -934,13 +3628,14 @@ def process_trainer_specialty(message, full_name):
         return
 
     if not specialty:
-        msg = bot.send_message(chat_id, "تخصص وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
-        bot.register_next_step_handler(msg, process_trainer_specialty, full_name)
+        bot.send_message(chat_id, "تخصص وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
+        set_next_step(chat_id, process_trainer_specialty, full_name)
         return
 
-    msg = bot.send_message(chat_id, "لطفاً نام باشگاه مربی را وارد کنید:")
-    bot.register_next_step_handler(msg, process_trainer_gym, full_name, specialty)
+    bot.send_message(chat_id, "لطفاً نام باشگاه مربی را وارد کنید:")
+    set_next_step(chat_id, process_trainer_gym, full_name, specialty)
 
+@conversation_step
 def process_trainer_gym(message, full_name, specialty):
     chat_id = message.chat.id
     gym_name = message.text.strip() if message.text else None
@@ -950,19 +3645,24 @@ def process_trainer_gym(message, full_name, specialty):
         return
 
     if not gym_name:
-        msg = bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید:")
+        bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید:")
         reply_markup = cancel_menu()
-        bot.register_next_step_handler(msg, process_trainer_gym, full_name, specialty)
+        set_next_step(chat_id, process_trainer_gym, full_name, specialty)
         return
     
-    gym_id = get_gym_id_by_name(gym_name)
+    gym_ids = find_gym_ids_by_name(gym_name)
 
-    if gym_id is None:
-        msg = bot.send_message(chat_id, "چنین باشگاهی ثبت نشده است. لطفاً نام باشگاه را مجدداً وارد کنید:")
+    if not gym_ids:
+        bot.send_message(chat_id, "چنین باشگاهی ثبت نشده است. لطفاً نام باشگاه را مجدداً وارد کنید:")
         reply_markup = cancel_menu()
-        bot.register_next_step_handler(msg, process_trainer_gym, full_name, specialty)
+        set_next_step(chat_id, process_trainer_gym, full_name, specialty)
+        return
+    elif len(gym_ids) > 1:
+        bot.send_message(chat_id, ambiguous_gym_text(gym_name, gym_ids))
+        set_next_step(chat_id, process_trainer_gym, full_name, specialty)
         return
     else:
+        gym_id = gym_ids[0]
         conn = get_db_connection()
         if conn is None:
             bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
@@ -971,10 +3671,10 @@ def process_trainer_gym(message, full_name, specialty):
         try:
             cur = conn.cursor()
             cur.execute("""
-                INSERT INTO trainer (name, specialty, gym_id)
-                VALUES (%s, %s, %s)
+                INSERT INTO trainer (name, specialty, gym_id, search_key, search_skeleton)
+                VALUES (%s, %s, %s, %s, %s)
                 RETURNING trainer_id
-            """, (full_name, specialty, gym_id))
+            """, (full_name, specialty, gym_id, normalize_search_key(full_name), normalize_skeleton_key(full_name)))
 
             trainer_id = cur.fetchone()[0] # type: ignore
             conn.commit()
@@ -991,13 +3691,14 @@ def process_trainer_gym(message, full_name, specialty):
 
 # region ------------ Add Event Handler ------------
 
-@bot.message_handler(func=lambda message: message.text == 'اضافه کردن رویداد')
+@router.text('اضافه کردن رویداد')
 @login_required
 def add_event_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً تاریخ و زمان شروع رویداد را وارد کنید (فرمت: YYYY-MM-DD HH:MM):", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_event_start_date)
+    bot.send_message(chat_id, "لطفاً تاریخ و زمان شروع رویداد را وارد کنید (فرمت: YYYY-MM-DD HH:MM):", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_event_start_date)
 
+@conversation_step
 def process_event_start_date(message):
     chat_id = message.chat.id
     start_date_str = message.text.strip()
@@ -1009,12 +3710,13 @@ def process_event_start_date(message):
     try:
         start_date = datetime.strptime(start_date_str, "%Y-%m-%d %H:%M")
         
-        msg = bot.send_message(chat_id, "لطفاً تاریخ و زمان پایان رویداد را وارد کنید (فرمت: YYYY-MM-DD HH:MM):", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_event_end_date, start_date)
+        bot.send_message(chat_id, "لطفاً تاریخ و زمان پایان رویداد را وارد کنید (فرمت: YYYY-MM-DD HH:MM):", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_event_end_date, start_date)
     except ValueError:
-        msg = bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
-        bot.register_next_step_handler(msg, process_event_start_date)
+        bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
+        set_next_step(chat_id, process_event_start_date)
     
+@conversation_step
 def process_event_end_date(message, start_date):
     chat_id = message.chat.id
     end_date_str = message.text.strip()
@@ -1025,24 +3727,25 @@ def process_event_end_date(message, start_date):
     
     if end_date_str in ["نامعلوم", "نامشخص", "ندارد", "خالی"]:
         end_date = None
-        msg = bot.send_message(chat_id, "لطفاً مکان رویداد را وارد کنید:")
-        bot.register_next_step_handler(msg, process_event_location, start_date, end_date)
+        bot.send_message(chat_id, "لطفاً مکان رویداد را وارد کنید:")
+        set_next_step(chat_id, process_event_location, start_date, end_date)
         return
     
     try:
         end_date = datetime.strptime(end_date_str, "%Y-%m-%d %H:%M")
         
         if end_date <= start_date:
-            msg = bot.send_message(chat_id, "تاریخ پایان باید بعد از تاریخ شروع باشد. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
-            bot.register_next_step_handler(msg, process_event_end_date, start_date)
+            bot.send_message(chat_id, "تاریخ پایان باید بعد از تاریخ شروع باشد. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
+            set_next_step(chat_id, process_event_end_date, start_date)
             return
         
-        msg = bot.send_message(chat_id, "لطفاً مکان رویداد را وارد کنید:")
-        bot.register_next_step_handler(msg, process_event_location, start_date, end_date)
+        bot.send_message(chat_id, "لطفاً مکان رویداد را وارد کنید:")
+        set_next_step(chat_id, process_event_location, start_date, end_date)
     except ValueError:
-        msg = bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
-        bot.register_next_step_handler(msg, process_event_end_date, start_date)
+        bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
+        set_next_step(chat_id, process_event_end_date, start_date)
 
+@conversation_step
 def process_event_location(message, start_date, end_date):
     chat_id = message.chat.id
     location = message.text.strip()
@@ -1052,13 +3755,14 @@ def process_event_location(message, start_date, end_date):
         return
     
     if not location:
-        msg = bot.send_message(chat_id, "مکان وارد شده معتبر نیست. لطفاً مجدداً وارد کنید:")
-        bot.register_next_step_handler(msg, process_event_location)
+        bot.send_message(chat_id, "مکان وارد شده معتبر نیست. لطفاً مجدداً وارد کنید:")
+        set_next_step(chat_id, process_event_location)
         return
     
-    msg = bot.send_message(chat_id, "لطفاً نام مبارز اول را وارد کنید:")
-    bot.register_next_step_handler(msg, process_event_fighter1, start_date, end_date, location)
+    bot.send_message(chat_id, "لطفاً نام مبارز اول را وارد کنید:")
+    set_next_step(chat_id, process_event_fighter1, start_date, end_date, location)
 
+@conversation_step
 def process_event_fighter1(message, start_date, end_date, location):
     chat_id = message.chat.id
     fighter1_name = message.text.strip()
@@ -1067,16 +3771,24 @@ def process_event_fighter1(message, start_date, end_date, location):
         cancel_process(message)
         return
     
-    fighter1_id = get_fighter_id_by_name(fighter1_name)
+    fighter1_ids = find_fighter_ids_by_name(fighter1_name)
+    
+    if not fighter1_ids:
+        bot.send_message(chat_id, "مبارز یافت نشد. لطفاً نام را مجدداً وارد کنید:")
+        set_next_step(chat_id, process_event_fighter1, start_date, end_date, location)
+        return
     
-    if fighter1_id is None:
-        msg = bot.send_message(chat_id, "مبارز یافت نشد. لطفاً نام را مجدداً وارد کنید:")
-        bot.register_next_step_handler(msg, process_event_fighter1, start_date, end_date, location)
+    if len(fighter1_ids) > 1:
+        bot.send_message(chat_id, ambiguous_fighter_text(fighter1_name, fighter1_ids))
+        set_next_step(chat_id, process_event_fighter1, start_date, end_date, location)
         return
     
-    msg = bot.send_message(chat_id, "لطفاً نام مبارز دوم را وارد کنید:")
-    bot.register_next_step_handler(msg, process_event_fighter2, start_date, end_date, location, fighter1_id, fighter1_name)
+    fighter1_id = fighter1_ids[0]
+    
+    bot.send_message(chat_id, "لطفاً نام مبارز دوم را وارد کنید:")
+    set_next_step(chat_id, process_event_fighter2, start_date, end_date, location, fighter1_id, fighter1_name)
 
+@conversation_step
 def process_event_fighter2(message, start_date, end_date, location, fighter1_id, fighter1_name):
     chat_id = message.chat.id
     fighter2_name = message.text.strip()
@@ -1085,16 +3797,23 @@ def process_event_fighter2(message, start_date, end_date, location, fighter1_id,
         cancel_process(message)
         return
     
-    fighter2_id = get_fighter_id_by_name(fighter2_name)
+    fighter2_ids = find_fighter_ids_by_name(fighter2_name)
+    
+    if not fighter2_ids:
+        bot.send_message(chat_id, "مبارز یافت نشد. لطفاً نام را مجدداً وارد کنید:")
+        set_next_step(chat_id, process_event_fighter2, start_date, end_date, location, fighter1_id, fighter1_name)
+        return
     
-    if fighter2_id is None:
-        msg = bot.send_message(chat_id, "مبارز یافت نشد. لطفاً نام را مجدداً وارد کنید:")
-        bot.register_next_step_handler(msg, process_event_fighter2, start_date, end_date, location, fighter1_id, fighter1_name)
+    if len(fighter2_ids) > 1:
+        bot.send_message(chat_id, ambiguous_fighter_text(fighter2_name, fighter2_ids))
+        set_next_step(chat_id, process_event_fighter2, start_date, end_date, location, fighter1_id, fighter1_name)
         return
     
+    fighter2_id = fighter2_ids[0]
+    
     if fighter2_id == fighter1_id:
-        msg = bot.send_message(chat_id, "یک مبارز نمی‌تواند با خودش مبارزه کند! لطفاً مبارز دیگری را وارد کنید:")
-        bot.register_next_step_handler(msg, process_event_fighter2, start_date, end_date, location, fighter1_id, fighter1_name)
+        bot.send_message(chat_id, "یک مبارز نمی‌تواند با خودش مبارزه کند! لطفاً مبارز دیگری را وارد کنید:")
+        set_next_step(chat_id, process_event_fighter2, start_date, end_date, location, fighter1_id, fighter1_name)
         return
     
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -1105,9 +3824,10 @@ def process_event_fighter2(message, start_date, end_date, location, fighter1_id,
                types.KeyboardButton("نامعلوم"),
                types.KeyboardButton("لغو عملیات"))
     
-    msg = bot.send_message(chat_id, "نتیجه مبارزه را انتخاب کنید:", reply_markup=markup)
-    bot.register_next_step_handler(msg, process_event_result, start_date, end_date, location, fighter1_id, fighter1_name, fighter2_id, fighter2_name)
+    bot.send_message(chat_id, "نتیجه مبارزه را انتخاب کنید:", reply_markup=markup)
+    set_next_step(chat_id, process_event_result, start_date, end_date, location, fighter1_id, fighter1_name, fighter2_id, fighter2_name)
 
+@conversation_step
 def process_event_result(message, start_date, end_date, location, fighter1_id, fighter1_name, fighter2_id, fighter2_name):
     chat_id = message.chat.id
     result_text = message.text.strip()
@@ -1125,8 +3845,8 @@ def process_event_result(message, start_date, end_date, location, fighter1_id, f
     }
     
     if result_text not in result_map:
-        msg = bot.send_message(chat_id, "نتیجه نامعتبر است. لطفاً از گزینه‌ها انتخاب کنید:")
-        bot.register_next_step_handler(msg, process_event_result)
+        bot.send_message(chat_id, "نتیجه نامعتبر است. لطفاً از گزینه‌ها انتخاب کنید:")
+        set_next_step(chat_id, process_event_result)
         return
     
     result = result_map[result_text]
@@ -1209,23 +3929,38 @@ def process_event_result(message, start_date, end_date, location, fighter1_id, f
 
 # region ------------------------ Search Handlers -----------------------
 
-# region ---------- Search Fighter Handler ---------
+# region ------------- Search Result Pages ---------
 
-@bot.message_handler(func=lambda message: message.text == 'جست‌وجوی مبارز')
-@login_required
-def search_fighter_menu(message):
-    chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً نام مبارز را برای جست‌وجو وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_fighter_search)
+# Searches return the top SEARCH_PAGE_SIZE matches by relevance and never
+# pull more than one page (plus one look-ahead row) into the bot per
+# request. A "more results" button continues the same search, up to
+# SEARCH_MAX_RESULTS in total. The search term is kept server side under a
+# short token because callback data is capped at 64 bytes.
 
-def process_fighter_search(message):
-    chat_id = message.chat.id
-    search_term = message.text.strip()
-    
-    if search_term == "لغو عملیات":
-        cancel_process(message)
+search_continuations = OrderedDict()
+search_continuations_lock = threading.Lock()
+
+def save_search_continuation(view, search_term):
+    token = secrets.token_urlsafe(6)
+    with search_continuations_lock:
+        search_continuations[token] = (view, search_term)
+        while len(search_continuations) > SEARCH_CONTINUATIONS_MAX:
+            search_continuations.popitem(last=False)
+    return token
+
+def get_search_continuation(token):
+    with search_continuations_lock:
+        return search_continuations.get(token)
+
+def search_page_size(offset):
+    return max(0, min(SEARCH_PAGE_SIZE, SEARCH_MAX_RESULTS - offset))
+
+def send_search_page(chat_id, view, search_term, offset=0, message_id=None, token=None):
+    render_page, empty_text = SEARCH_VIEWS[view]
+    page_size = search_page_size(offset)
+    if page_size == 0:
         return
-    
+
     conn = get_db_connection()
     if conn is None:
         bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
@@ -1233,54 +3968,123 @@ def process_fighter_search(message):
     
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT f.fighter_id, f.name, f.nickname, f.weight_class, f.age, 
-                   f.nationality, f.status, g.name as gym_name
-            FROM fighter f
-            LEFT JOIN gym g ON f.gym_id = g.gym_id
-            WHERE f.name ILIKE %s OR f.nickname ILIKE %s
-            ORDER BY f.name
-        """, (f'%{search_term}%', f'%{search_term}%'))
-        
-        fighters = cur.fetchall()
-        
-        if not fighters:
-            bot.send_message(chat_id, f"هیچ مبارزی با نام یا نام مستعار '{search_term}' یافت نشد.", reply_markup=main_menu())
-            return
-        
-        status_dict = {'active': 'فعال', 'retired': 'بازنشسته', 'suspended': 'تعلیق شده'}
-        
-        response = f"نتایج جست‌وجو برای '{search_term}':\n\n"
-        for fighter in fighters:
-            response += f"**{fighter[1]}**\n"
-            response += f"شناسه مبارز: {fighter[0]}\n"
-            response += f"نام مستعار: {fighter[2] or 'ثبت نشده'}\n"
-            response += f"رده وزنی: {fighter[3]}\n"
-            response += f"سن: {fighter[4]}\n"
-            response += f"ملیت: {fighter[5]}\n"
-            response += f"وضعیت: {status_dict.get(fighter[6], 'نامشخص')}\n"
-            response += f"باشگاه: {fighter[7] or 'ثبت نشده'}\n"
-            response += "-" * 40 + "\n"
-        
-        bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=main_menu())
+        response, next_offset = render_page(cur, search_term, offset, page_size)
         cur.close()
+
+        if response is None:
+            if message_id is None:
+                bot.send_message(chat_id, empty_text.format(search_term), reply_markup=main_menu())
+            return
+
+        markup = None
+        if next_offset is not None and search_page_size(next_offset) > 0:
+            token = token or save_search_continuation(view, search_term)
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("نتایج بیشتر", callback_data=f"search:{token}:{next_offset}"))
+
+        if message_id is not None:
+            bot.edit_message_text(response, chat_id, message_id, parse_mode='Markdown', reply_markup=markup)
+        elif markup is None:
+            bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=main_menu())
+        else:
+            bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+            bot.send_message(chat_id, "برای دیدن نتایج بیشتر، دکمه «نتایج بیشتر» را بزنید.", reply_markup=main_menu())
     except Error as e:
         bot.send_message(chat_id, f"خطا در جست‌وجو: {e}", reply_markup=main_menu())
     finally:
         if conn:
             conn.close()
 
+@router.callback('search')
+def search_page_callback(call):
+    chat_id = call.message.chat.id
+    if not check_login(chat_id):
+        bot.answer_callback_query(call.id, "Please log in first.")
+        return
+
+    _, token, offset = call.data.split(':')
+    continuation = get_search_continuation(token)
+    if continuation is None or not offset.isdigit():
+        bot.answer_callback_query(call.id, "این جست‌وجو منقضی شده است. لطفاً دوباره جست‌وجو کنید.")
+        return
+
+    view, search_term = continuation
+    send_search_page(chat_id, view, search_term, int(offset), call.message.message_id, token)
+    bot.answer_callback_query(call.id)
+
+# endregion
+
+# region ---------- Search Fighter Handler ---------
+
+@router.text('جست‌وجوی مبارز')
+@login_required
+def search_fighter_menu(message):
+    chat_id = message.chat.id
+    bot.send_message(chat_id, "لطفاً نام مبارز را برای جست‌وجو وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_fighter_search)
+
+@conversation_step
+def process_fighter_search(message):
+    chat_id = message.chat.id
+    search_term = message.text.strip()
+    
+    if search_term == "لغو عملیات":
+        cancel_process(message)
+        return
+    
+    send_search_page(chat_id, 'fighters', search_term)
+
+def render_fighter_search_page(cur, search_term, offset, page_size):
+    where, rank, params = build_search_filter(cur, ['f.name', 'f.nickname'], search_term, 'f.search_key', 'f.search_skeleton')
+    cur.execute(f"""
+        SELECT f.fighter_id, f.name, f.nickname, f.weight_class, f.age, 
+               f.nationality, f.status, g.name as gym_name
+        FROM fighter f
+        LEFT JOIN gym g ON f.gym_id = g.gym_id
+        WHERE {where}
+        ORDER BY {rank}f.name, f.fighter_id
+        LIMIT %(limit)s OFFSET %(offset)s
+    """, {**params, 'limit': page_size + 1, 'offset': offset})
+    
+    status_dict = {'active': 'فعال', 'retired': 'بازنشسته', 'suspended': 'تعلیق شده'}
+    
+    page = ResponseBuilder(f"نتایج جست‌وجو برای '{search_term}':\n\n")
+    last, more = None, False
+    for fighter in cur:
+        if page.rows == page_size:
+            more = True
+            break
+        if not page.add(
+            f"**{fighter[1]}**\n"
+            f"شناسه مبارز: {fighter[0]}\n"
+            f"نام مستعار: {fighter[2] or 'ثبت نشده'}\n"
+            f"رده وزنی: {fighter[3]}\n"
+            f"سن: {fighter[4]}\n"
+            f"ملیت: {fighter[5]}\n"
+            f"وضعیت: {status_dict.get(fighter[6], 'نامشخص')}\n"
+            f"باشگاه: {fighter[7] or 'ثبت نشده'}\n"
+            + ROW_SEPARATOR
+        ):
+            more = True
+            break
+        last = fighter
+    if last is None:
+        return None, None
+    next_offset = offset + page.rows if more else None
+    return page.text(), next_offset
+
 # endregion
 
 # region ------------ Search Gym Handler -----------
 
-@bot.message_handler(func=lambda message: message.text == 'جست‌وجوی باشگاه')
+@router.text('جست‌وجوی باشگاه')
 @login_required
 def search_gym_menu(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً نام باشگاه یا مکان باشگاه یا نام مالک را برای جست‌وجو وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_gym_search)
+    bot.send_message(chat_id, "لطفاً نام باشگاه یا مکان باشگاه یا نام مالک را برای جست‌وجو وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_gym_search)
 
+@conversation_step
 def process_gym_search(message):
     chat_id = message.chat.id
     search_term = message.text.strip()
@@ -1289,67 +4093,57 @@ def process_gym_search(message):
         cancel_process(message)
         return
     
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
-        return
-    
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT gym_id, name, location, owner, reputation_score
-            FROM gym
-            WHERE name ILIKE %s OR location ILIKE %s OR owner ILIKE %s
-            ORDER BY name
-        """, (f'%{search_term}%', f'%{search_term}%', f'%{search_term}%'))
-        
-        gyms = cur.fetchall()
-        
-        if not gyms:
-            bot.send_message(chat_id, f"هیچ باشگاهی با این نام یا این مکان یا این مالک '{search_term}' یافت نشد.", reply_markup=main_menu())
-            return
-        
-        response = f"نتایج جست‌وجو برای '{search_term}':\n\n"
-        for gym in gyms:
-            response += f"**{gym[1]}**\n"
-            response += f"شناسه باشگاه: {gym[0]}\n"
-            response += f"مکان: {gym[2]}\n"
-            response += f"مالک: {gym[3]}\n"
-            response += f"امتیاز شهرت: {gym[4]}\n"
-            
-            cur.execute("""
-                SELECT COUNT(*) FROM fighter WHERE gym_id = %s
-            """, (gym[0],))
-            fighter_count = cur.fetchone()[0] # type: ignore
-            
-            cur.execute("""
-                SELECT COUNT(*) FROM trainer WHERE gym_id = %s
-            """, (gym[0],))
-            trainer_count = cur.fetchone()[0] # type: ignore
-            
-            response += f"تعداد مبارزین: {fighter_count}\n"
-            response += f"تعداد مربیان: {trainer_count}\n"
-            response += "-" * 40 + "\n"
-        
-        bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=main_menu())
-        cur.close()
-    except Error as e:
-        bot.send_message(chat_id, f"خطا در جست‌وجو: {e}", reply_markup=main_menu())
-    finally:
-        if conn:
-            conn.close()
+    send_search_page(chat_id, 'gyms', search_term)
+
+def render_gym_search_page(cur, search_term, offset, page_size):
+    where, rank, params = build_search_filter(cur, ['g.name', 'g.location', 'g.owner'], search_term, 'g.search_key', 'g.search_skeleton')
+    cur.execute(f"""
+        SELECT g.gym_id, g.name, g.location, g.owner, g.reputation_score,
+               fc.fighter_count, tc.trainer_count
+        FROM gym g
+        CROSS JOIN LATERAL (SELECT COUNT(*) AS fighter_count FROM fighter f WHERE f.gym_id = g.gym_id) fc
+        CROSS JOIN LATERAL (SELECT COUNT(*) AS trainer_count FROM trainer t WHERE t.gym_id = g.gym_id) tc
+        WHERE {where}
+        ORDER BY {rank}g.name, g.gym_id
+        LIMIT %(limit)s OFFSET %(offset)s
+    """, {**params, 'limit': page_size + 1, 'offset': offset})
+    
+    page = ResponseBuilder(f"نتایج جست‌وجو برای '{search_term}':\n\n")
+    last, more = None, False
+    for gym in cur:
+        if page.rows == page_size:
+            more = True
+            break
+        if not page.add(
+            f"**{gym[1]}**\n"
+            f"شناسه باشگاه: {gym[0]}\n"
+            f"مکان: {gym[2]}\n"
+            f"مالک: {gym[3]}\n"
+            f"امتیاز شهرت: {gym[4]}\n"
+            f"تعداد مبارزین: {gym[5]}\n"
+            f"تعداد مربیان: {gym[6]}\n"
+            + ROW_SEPARATOR
+        ):
+            more = True
+            break
+        last = gym
+    if last is None:
+        return None, None
+    next_offset = offset + page.rows if more else None
+    return page.text(), next_offset
 
 # endregion
 
 # region ---------- Search Trainer Handler ---------
 
-@bot.message_handler(func=lambda message: message.text == 'جست‌وجوی مربی')
+@router.text('جست‌وجوی مربی')
 @login_required
 def search_trainer_menu(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً نام مربی یا نام تخصص را برای جست‌وجو وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_trainer_search)
+    bot.send_message(chat_id, "لطفاً نام مربی یا نام تخصص را برای جست‌وجو وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_trainer_search)
 
+@conversation_step
 def process_trainer_search(message):
     chat_id = message.chat.id
     search_term = message.text.strip()
@@ -1358,65 +4152,72 @@ def process_trainer_search(message):
         cancel_process(message)
         return
     
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
-        return
-    
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT t.trainer_id, t.name, t.specialty, g.name as gym_name
-            FROM trainer t
-            LEFT JOIN gym g ON t.gym_id = g.gym_id
-            WHERE t.name ILIKE %s OR t.specialty ILIKE %s
-            ORDER BY t.name
-        """, (f'%{search_term}%', f'%{search_term}%'))
-        
-        trainers = cur.fetchall()
-        
-        if not trainers:
-            bot.send_message(chat_id, f"هیچ مربی‌ای با این نام یا این تخصص '{search_term}' یافت نشد.", reply_markup=main_menu())
-            return
-        
-        response = f"نتایج جست‌وجو برای '{search_term}':\n\n"
-        for trainer in trainers:
-            response += f"**{trainer[1]}**\n"
-            response += f"شناسه مربی: {trainer[0]}\n"
-            response += f"تخصص: {trainer[2]}\n"
-            response += f"باشگاه: {trainer[3] or 'ثبت نشده'}\n"
-            
-            cur.execute("""
-                SELECT COUNT(*) FROM fighter_trainer WHERE trainer_id = %s
-            """, (trainer[0],))
-            fighter_count = cur.fetchone()[0] # type: ignore
-            
-            response += f"تعداد شاگردان: {fighter_count}\n"
-            response += "-" * 40 + "\n"
-        
-        bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=main_menu())
-        cur.close()
-    except Error as e:
-        bot.send_message(chat_id, f"خطا در جست‌وجو: {e}", reply_markup=main_menu())
-    finally:
-        if conn:
-            conn.close()
+    send_search_page(chat_id, 'trainers', search_term)
+
+def render_trainer_search_page(cur, search_term, offset, page_size):
+    where, rank, params = build_search_filter(cur, ['t.name', 't.specialty'], search_term, 't.search_key', 't.search_skeleton')
+    cur.execute(f"""
+        SELECT t.trainer_id, t.name, t.specialty, g.name as gym_name,
+               sc.active_count, sc.past_count
+        FROM trainer t
+        LEFT JOIN gym g ON t.gym_id = g.gym_id
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) FILTER (WHERE ft.end_date IS NULL) AS active_count,
+                   COUNT(*) FILTER (WHERE ft.end_date IS NOT NULL) AS past_count
+            FROM fighter_trainer ft
+            WHERE ft.trainer_id = t.trainer_id
+        ) sc
+        WHERE {where}
+        ORDER BY {rank}t.name, t.trainer_id
+        LIMIT %(limit)s OFFSET %(offset)s
+    """, {**params, 'limit': page_size + 1, 'offset': offset})
+    
+    page = ResponseBuilder(f"نتایج جست‌وجو برای '{search_term}':\n\n")
+    last, more = None, False
+    for trainer in cur:
+        if page.rows == page_size:
+            more = True
+            break
+        if not page.add(
+            f"**{trainer[1]}**\n"
+            f"شناسه مربی: {trainer[0]}\n"
+            f"تخصص: {trainer[2]}\n"
+            f"باشگاه: {trainer[3] or 'ثبت نشده'}\n"
+            f"تعداد شاگردان: {trainer[4] + trainer[5]}\n"
+            f"شاگردان فعال: {trainer[4]}\n"
+            f"شاگردان گذشته: {trainer[5]}\n"
+            + ROW_SEPARATOR
+        ):
+            more = True
+            break
+        last = trainer
+    if last is None:
+        return None, None
+    next_offset = offset + page.rows if more else None
+    return page.text(), next_offset
 
 # endregion
 
+SEARCH_VIEWS = {
+    'fighters': (render_fighter_search_page, "هیچ مبارزی با نام یا نام مستعار '{}' یافت نشد."),
+    'gyms': (render_gym_search_page, "هیچ باشگاهی با این نام یا این مکان یا این مالک '{}' یافت نشد."),
+    'trainers': (render_trainer_search_page, "هیچ مربی‌ای با این نام یا این تخصص '{}' یافت نشد."),
+}
+
 # endregion
 
 # region ----------------------- Editing Handlers -----------------------
 
 # region ---------- Edit Fighter Handler -----------
 
-@bot.message_handler(func=lambda message: message.text == 'ویرایش مبارز')
+@router.text('ویرایش مبارز')
 @login_required
 def edit_fighter_menu(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه مبارز را برای ویرایش وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_edit_fighter_id)
+    bot.send_message(chat_id, "لطفاً شناسه مبارز را برای ویرایش وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_edit_fighter_id)
 
+@conversation_step
 def process_edit_fighter_id(message):
     chat_id = message.chat.id
     fighter_id_str = message.text.strip()
@@ -1426,8 +4227,8 @@ def process_edit_fighter_id(message):
         return
     
     if not fighter_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_edit_fighter_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_edit_fighter_id)
         return
     
     fighter_id = int(fighter_id_str)
@@ -1460,9 +4261,10 @@ def process_edit_fighter_id(message):
                types.KeyboardButton("باشگاه"),
                types.KeyboardButton("لغو عملیات"))
     
-    msg = bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
-    bot.register_next_step_handler(msg, process_edit_fighter_field, fighter_id)
+    bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+    set_next_step(chat_id, process_edit_fighter_field, fighter_id)
 
+@conversation_step
 def process_edit_fighter_field(message, fighter_id):
     chat_id = message.chat.id
     field = message.text.strip()
@@ -1493,30 +4295,31 @@ def process_edit_fighter_field(message, fighter_id):
                    types.KeyboardButton("retired"),
                    types.KeyboardButton("suspended"),
                    types.KeyboardButton("لغو عملیات"))
-        msg = bot.send_message(chat_id, "لطفاً وضعیت جدید را انتخاب کنید (active, retired, suspended):", reply_markup=markup)
-        bot.register_next_step_handler(msg, process_edit_fighter_value, fighter_id, field_name)
+        bot.send_message(chat_id, "لطفاً وضعیت جدید را انتخاب کنید (active, retired, suspended):", reply_markup=markup)
+        set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
     elif field == "باشگاه":
-        msg = bot.send_message(chat_id, "لطفاً نام باشگاه جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_fighter_value, fighter_id, field_name)
+        bot.send_message(chat_id, "لطفاً نام باشگاه جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
     elif field == "سن":
-        msg = bot.send_message(chat_id, "لطفاً سن جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_fighter_value, fighter_id, field_name)
+        bot.send_message(chat_id, "لطفاً سن جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
     elif field == "نام مستعار":
-        msg = bot.send_message(chat_id, "لطفاً نام مستعار جدید را وارد کنید (یا 'خالی' برای حذف نام مستعار):", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_fighter_value, fighter_id, field_name)
+        bot.send_message(chat_id, "لطفاً نام مستعار جدید را وارد کنید (یا 'خالی' برای حذف نام مستعار):", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
     elif field == "ملیت":
-        msg = bot.send_message(chat_id, "لطفاً ملیت جدید را وارد کنید (یا 'خالی' برای حذف ملیت):", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_fighter_value, fighter_id, field_name)
+        bot.send_message(chat_id, "لطفاً ملیت جدید را وارد کنید (یا 'خالی' برای حذف ملیت):", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
     elif field == "رده وزنی":
-        msg = bot.send_message(chat_id, "لطفاً رده وزنی جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_fighter_value, fighter_id, field_name)
+        bot.send_message(chat_id, "لطفاً رده وزنی جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
     elif field == "نام":
-        msg = bot.send_message(chat_id, "لطفاً نام جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_fighter_value, fighter_id, field_name)
+        bot.send_message(chat_id, "لطفاً نام جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
     else:
-        msg = bot.send_message(chat_id, f"لطفاً مقدار جدید برای فیلد '{field}' را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_fighter_value, fighter_id, field_name)
+        bot.send_message(chat_id, f"لطفاً مقدار جدید برای فیلد '{field}' را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
 
+@conversation_step
 def process_edit_fighter_value(message, fighter_id, field_name):
     chat_id = message.chat.id
     new_value = message.text.strip()
@@ -1526,12 +4329,16 @@ def process_edit_fighter_value(message, fighter_id, field_name):
         return
     
     if field_name == "gym_id":
-        gym_id = get_gym_id_by_name(new_value)
-        if gym_id is None:
-            msg = bot.send_message(chat_id, "چنین باشگاهی یافت نشد. لطفاً مجدداً وارد کنید:")
-            bot.register_next_step_handler(msg, process_edit_fighter_value, fighter_id, field_name)
+        gym_ids = find_gym_ids_by_name(new_value)
+        if not gym_ids:
+            bot.send_message(chat_id, "چنین باشگاهی یافت نشد. لطفاً مجدداً وارد کنید:")
+            set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
+            return
+        if len(gym_ids) > 1:
+            bot.send_message(chat_id, ambiguous_gym_text(new_value, gym_ids))
+            set_next_step(chat_id, process_edit_fighter_value, fighter_id, field_name)
             return
-        new_value = gym_id
+        new_value = gym_ids[0]
     elif field_name == "nickname" and new_value in ["خالی", "ندارد", "حذف"]:
         new_value = None
     elif field_name == "nationality" and new_value in ["خالی", "ندارد", "حذف"]:
@@ -1550,9 +4357,10 @@ def confirm_update_fighter(message, fighter_id, field_name, new_value):
     markup.add(types.KeyboardButton("بله، ویرایش کن"),
                types.KeyboardButton("خیر، لغو کن"))
     
-    msg = bot.send_message(chat_id, response, reply_markup=markup)
-    bot.register_next_step_handler(msg, process_fighter_update_confirmation, fighter_id, field_name, new_value)
+    bot.send_message(chat_id, response, reply_markup=markup)
+    set_next_step(chat_id, process_fighter_update_confirmation, fighter_id, field_name, new_value)
 
+@conversation_step
 def process_fighter_update_confirmation(message, fighter_id, field_name, new_value):
     chat_id = message.chat.id
     confirmation = message.text.strip()
@@ -1580,9 +4388,20 @@ def process_fighter_update_confirmation(message, fighter_id, field_name, new_val
             UPDATE fighter 
             SET {field_name} = %s 
             WHERE fighter_id = %s
+            RETURNING name, nickname
         """, (new_value, fighter_id))
+        row = cur.fetchone()
+
+        if field_name in ("name", "nickname") and row:
+            cur.execute(
+                "UPDATE fighter SET search_key = %s, search_skeleton = %s WHERE fighter_id = %s",
+                (normalize_search_key(*row), normalize_skeleton_key(*row), fighter_id)
+            )
         
         conn.commit()
+        fighter_cache.invalidate(fighter_id)
+        if field_name == "name":
+            event_cache.clear()
         
         bot.send_message(chat_id, "اطلاعات مبارز با موفقیت ویرایش شد.", reply_markup=main_menu())
         cur.close()
@@ -1596,13 +4415,14 @@ def process_fighter_update_confirmation(message, fighter_id, field_name, new_val
 
 # region ------------ Edit Gym Handler -------------
 
-@bot.message_handler(func=lambda message: message.text == 'ویرایش باشگاه')
+@router.text('ویرایش باشگاه')
 @login_required
 def edit_gym_menu(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه باشگاه را برای ویرایش وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_edit_gym_id)
+    bot.send_message(chat_id, "لطفاً شناسه باشگاه را برای ویرایش وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_edit_gym_id)
 
+@conversation_step
 def process_edit_gym_id(message):
     chat_id = message.chat.id
     gym_id_str = message.text.strip()
@@ -1612,8 +4432,8 @@ def process_edit_gym_id(message):
         return
     
     if not gym_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_edit_gym_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_edit_gym_id)
         return
     
     gym_id = int(gym_id_str)
@@ -1640,9 +4460,10 @@ def process_edit_gym_id(message):
                types.KeyboardButton("امتیاز شهرت"),
                types.KeyboardButton("لغو عملیات"))
     
-    msg = bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
-    bot.register_next_step_handler(msg, process_edit_gym_field, gym_id)
+    bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+    set_next_step(chat_id, process_edit_gym_field, gym_id)
 
+@conversation_step
 def process_edit_gym_field(message, gym_id):
     chat_id = message.chat.id
     field = message.text.strip()
@@ -1665,21 +4486,22 @@ def process_edit_gym_field(message, gym_id):
     field_name = field_mapping[field]
     
     if field_name == 'reputation_score':
-        msg = bot.send_message(chat_id, "لطفاً امتیاز شهرت جدید را وارد کنید (۰ تا ۱۰۰):", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_gym_value, gym_id, field_name)
+        bot.send_message(chat_id, "لطفاً امتیاز شهرت جدید را وارد کنید (۰ تا ۱۰۰):", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_gym_value, gym_id, field_name)
     elif field == "نام":
-        msg = bot.send_message(chat_id, "لطفاً نام جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_gym_value, gym_id, field_name)
+        bot.send_message(chat_id, "لطفاً نام جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_gym_value, gym_id, field_name)
     elif field == "مکان":
-        msg = bot.send_message(chat_id, "لطفاً مکان جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_gym_value, gym_id, field_name)
+        bot.send_message(chat_id, "لطفاً مکان جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_gym_value, gym_id, field_name)
     elif field == "مالک":
-        msg = bot.send_message(chat_id, "لطفاً نام مالک جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_gym_value, gym_id, field_name)
+        bot.send_message(chat_id, "لطفاً نام مالک جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_gym_value, gym_id, field_name)
     else:
-        msg = bot.send_message(chat_id, f"لطفاً مقدار جدید برای '{field}' وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_gym_value, gym_id, field_name)
+        bot.send_message(chat_id, f"لطفاً مقدار جدید برای '{field}' وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_gym_value, gym_id, field_name)
 
+@conversation_step
 def process_edit_gym_value(message, gym_id, field_name):
     chat_id = message.chat.id
     new_value = message.text.strip()
@@ -1690,14 +4512,14 @@ def process_edit_gym_value(message, gym_id, field_name):
     
     if field_name == 'reputation_score':
         if not new_value.isdigit():
-            msg = bot.send_message(chat_id, "امتیاز باید عدد بین ۰ تا ۱۰۰ باشد. لطفاً مجدداً وارد کنید:")
-            bot.register_next_step_handler(msg, process_edit_gym_value, gym_id, field_name)
+            bot.send_message(chat_id, "امتیاز باید عدد بین ۰ تا ۱۰۰ باشد. لطفاً مجدداً وارد کنید:")
+            set_next_step(chat_id, process_edit_gym_value, gym_id, field_name)
             return
         
         score = int(new_value)
         if score < 0 or score > 100:
-            msg = bot.send_message(chat_id, "امتیاز باید بین ۰ تا ۱۰۰ باشد. لطفاً مجدداً وارد کنید:")
-            bot.register_next_step_handler(msg, process_edit_gym_value, gym_id, field_name)
+            bot.send_message(chat_id, "امتیاز باید بین ۰ تا ۱۰۰ باشد. لطفاً مجدداً وارد کنید:")
+            set_next_step(chat_id, process_edit_gym_value, gym_id, field_name)
             return
     
     response = f"""
@@ -1708,9 +4530,10 @@ def process_edit_gym_value(message, gym_id, field_name):
     markup.add(types.KeyboardButton("بله، ویرایش کن"),
                types.KeyboardButton("خیر، لغو کن"))
     
-    msg = bot.send_message(chat_id, response, reply_markup=markup)
-    bot.register_next_step_handler(msg, process_gym_update_confirmation, gym_id, field_name, new_value)
+    bot.send_message(chat_id, response, reply_markup=markup)
+    set_next_step(chat_id, process_gym_update_confirmation, gym_id, field_name, new_value)
 
+@conversation_step
 def process_gym_update_confirmation(message, gym_id, field_name, new_value):
     chat_id = message.chat.id
     confirmation = message.text.strip()
@@ -1739,8 +4562,19 @@ def process_gym_update_confirmation(message, gym_id, field_name, new_value):
             SET {field_name} = %s 
             WHERE gym_id = %s
         """, (new_value, gym_id))
+
+        if field_name == "name":
+            cur.execute(
+                "UPDATE gym SET search_key = %s, search_skeleton = %s WHERE gym_id = %s",
+                (normalize_search_key(new_value), normalize_skeleton_key(new_value), gym_id)
+            )
         
         conn.commit()
+        gym_cache.invalidate(gym_id)
+        if field_name == "name":
+            # Fighter and trainer rows carry the gym's name.
+            fighter_cache.clear()
+            trainer_cache.clear()
         
         bot.send_message(chat_id, "اطلاعات باشگاه با موفقیت ویرایش شد.", reply_markup=main_menu())
         cur.close()
@@ -1754,13 +4588,14 @@ def process_gym_update_confirmation(message, gym_id, field_name, new_value):
 
 # region ---------- Edit Trainer Handler -----------
 
-@bot.message_handler(func=lambda message: message.text == 'ویرایش مربی')
+@router.text('ویرایش مربی')
 @login_required
 def edit_trainer_menu(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه مربی را برای ویرایش وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_edit_trainer_id)
+    bot.send_message(chat_id, "لطفاً شناسه مربی را برای ویرایش وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_edit_trainer_id)
 
+@conversation_step
 def process_edit_trainer_id(message):
     chat_id = message.chat.id
     trainer_id_str = message.text.strip()
@@ -1770,8 +4605,8 @@ def process_edit_trainer_id(message):
         return
     
     if not trainer_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_edit_trainer_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_edit_trainer_id)
         return
     
     trainer_id = int(trainer_id_str)
@@ -1796,9 +4631,10 @@ def process_edit_trainer_id(message):
                types.KeyboardButton("باشگاه"),
                types.KeyboardButton("لغو عملیات"))
     
-    msg = bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
-    bot.register_next_step_handler(msg, process_edit_trainer_field, trainer_id)
+    bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+    set_next_step(chat_id, process_edit_trainer_field, trainer_id)
 
+@conversation_step
 def process_edit_trainer_field(message, trainer_id):
     chat_id = message.chat.id
     field = message.text.strip()
@@ -1820,18 +4656,19 @@ def process_edit_trainer_field(message, trainer_id):
     field_name = field_mapping[field]
     
     if field == "باشگاه":
-        msg = bot.send_message(chat_id, "لطفاً نام باشگاه جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_trainer_value, trainer_id, field_name)
+        bot.send_message(chat_id, "لطفاً نام باشگاه جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_trainer_value, trainer_id, field_name)
     elif field == "تخصص":
-        msg = bot.send_message(chat_id, "لطفاً تخصص جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_trainer_value, trainer_id, field_name)
+        bot.send_message(chat_id, "لطفاً تخصص جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_trainer_value, trainer_id, field_name)
     elif field == "نام":
-        msg = bot.send_message(chat_id, "لطفاً نام جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_trainer_value, trainer_id, field_name)
+        bot.send_message(chat_id, "لطفاً نام جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_trainer_value, trainer_id, field_name)
     else:
-        msg = bot.send_message(chat_id, f"لطفاً مقدار جدید برای '{field}' وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_trainer_value, trainer_id, field_name)
+        bot.send_message(chat_id, f"لطفاً مقدار جدید برای '{field}' وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_trainer_value, trainer_id, field_name)
 
+@conversation_step
 def process_edit_trainer_value(message, trainer_id, field_name):
     chat_id = message.chat.id
     new_value = message.text.strip()
@@ -1841,16 +4678,20 @@ def process_edit_trainer_value(message, trainer_id, field_name):
         return
     
     if field_name == "gym_id":
-        gym_id = get_gym_id_by_name(new_value)
-        if gym_id is None:
-            msg = bot.send_message(chat_id, "چنین باشگاهی یافت نشد. لطفاً مجدداً وارد کنید:")
-            bot.register_next_step_handler(msg, process_edit_trainer_value, trainer_id, field_name)
+        gym_ids = find_gym_ids_by_name(new_value)
+        if not gym_ids:
+            bot.send_message(chat_id, "چنین باشگاهی یافت نشد. لطفاً مجدداً وارد کنید:")
+            set_next_step(chat_id, process_edit_trainer_value, trainer_id, field_name)
             return
-        new_value = gym_id
+        if len(gym_ids) > 1:
+            bot.send_message(chat_id, ambiguous_gym_text(new_value, gym_ids))
+            set_next_step(chat_id, process_edit_trainer_value, trainer_id, field_name)
+            return
+        new_value = gym_ids[0]
     
     if field_name == "name" and len(new_value) <= 1:
-        msg = bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
-        bot.register_next_step_handler(msg, process_edit_trainer_value, trainer_id, field_name)
+        bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً مجدداً تلاش کنید.")
+        set_next_step(chat_id, process_edit_trainer_value, trainer_id, field_name)
         return
     
     confirm_update_trainer(message, trainer_id, field_name, new_value)
@@ -1867,9 +4708,10 @@ def confirm_update_trainer(message, trainer_id, field_name, new_value):
                types.KeyboardButton("خیر، لغو کن"),
                types.KeyboardButton("لغو عملیات"))
     
-    msg = bot.send_message(chat_id, response, reply_markup=markup)
-    bot.register_next_step_handler(msg, process_trainer_update_confirmation, trainer_id, field_name, new_value)
+    bot.send_message(chat_id, response, reply_markup=markup)
+    set_next_step(chat_id, process_trainer_update_confirmation, trainer_id, field_name, new_value)
 
+@conversation_step
 def process_trainer_update_confirmation(message, trainer_id, field_name, new_value):
     chat_id = message.chat.id
     confirmation = message.text.strip()
@@ -1895,8 +4737,15 @@ def process_trainer_update_confirmation(message, trainer_id, field_name, new_val
             SET {field_name} = %s 
             WHERE trainer_id = %s
         """, (new_value, trainer_id))
+
+        if field_name == "name":
+            cur.execute(
+                "UPDATE trainer SET search_key = %s, search_skeleton = %s WHERE trainer_id = %s",
+                (normalize_search_key(new_value), normalize_skeleton_key(new_value), trainer_id)
+            )
         
         conn.commit()
+        trainer_cache.invalidate(trainer_id)
         
         bot.send_message(chat_id, "اطلاعات مربی با موفقیت ویرایش شد.", reply_markup=main_menu())
         cur.close()
@@ -1910,13 +4759,14 @@ def process_trainer_update_confirmation(message, trainer_id, field_name, new_val
 
 # region ----------- Edit Event Handler ------------
 
-@bot.message_handler(func=lambda message: message.text == 'ویرایش رویداد')
+@router.text('ویرایش رویداد')
 @login_required
 def edit_event_menu(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه رویداد را برای ویرایش وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_edit_event_id)
+    bot.send_message(chat_id, "لطفاً شناسه رویداد را برای ویرایش وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_edit_event_id)
 
+@conversation_step
 def process_edit_event_id(message):
     chat_id = message.chat.id
     event_id_str = message.text.strip()
@@ -1926,8 +4776,8 @@ def process_edit_event_id(message):
         return
     
     if not event_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_edit_event_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_edit_event_id)
         return
     
     event_id = int(event_id_str)
@@ -1954,9 +4804,10 @@ def process_edit_event_id(message):
                types.KeyboardButton("نتیجه"),
                types.KeyboardButton("لغو عملیات"))
     
-    msg = bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
-    bot.register_next_step_handler(msg, process_edit_event_field, event_id)
+    bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+    set_next_step(chat_id, process_edit_event_field, event_id)
 
+@conversation_step
 def process_edit_event_field(message, event_id):
     chat_id = message.chat.id
     field = message.text.strip()
@@ -1979,14 +4830,14 @@ def process_edit_event_field(message, event_id):
     field_name = field_mapping[field]
     
     if field == "تاریخ شروع":
-        msg = bot.send_message(chat_id, "لطفاً تاریخ و زمان جدید را وارد کنید (فرمت: YYYY-MM-DD HH:MM):", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_event_start_date, event_id, field_name)
+        bot.send_message(chat_id, "لطفاً تاریخ و زمان جدید را وارد کنید (فرمت: YYYY-MM-DD HH:MM):", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_event_start_date, event_id, field_name)
     elif field == "تاریخ پایان":
-        msg = bot.send_message(chat_id, "لطفاً تاریخ و زمان جدید را وارد کنید (فرمت: YYYY-MM-DD HH:MM):", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_event_end_date, event_id, field_name)
+        bot.send_message(chat_id, "لطفاً تاریخ و زمان جدید را وارد کنید (فرمت: YYYY-MM-DD HH:MM):", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_event_end_date, event_id, field_name)
     elif field == "مکان":
-        msg = bot.send_message(chat_id, "لطفاً نام مکان جدید را وارد کنید:", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_edit_event_location, event_id, field_name)
+        bot.send_message(chat_id, "لطفاً نام مکان جدید را وارد کنید:", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_edit_event_location, event_id, field_name)
     elif field == "نتیجه":
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
         markup.add(types.KeyboardButton("برد مبارز اول"),
@@ -1995,11 +4846,12 @@ def process_edit_event_field(message, event_id):
                    types.KeyboardButton("لغو شده"),
                    types.KeyboardButton("لغو عملیات"))
         
-        msg = bot.send_message(chat_id, "نتیجه جدید را انتخاب کنید:", reply_markup=markup)
-        bot.register_next_step_handler(msg, process_edit_event_result, event_id, field_name)
+        bot.send_message(chat_id, "نتیجه جدید را انتخاب کنید:", reply_markup=markup)
+        set_next_step(chat_id, process_edit_event_result, event_id, field_name)
     else:
         bot.send_message(chat_id, "فیلد نامعتبر است.", reply_markup=main_menu())
 
+@conversation_step
 def process_edit_event_start_date(message, event_id, field_name):
     chat_id = message.chat.id
     new_date_str = message.text.strip()
@@ -2012,9 +4864,10 @@ def process_edit_event_start_date(message, event_id, field_name):
         new_date = datetime.strptime(new_date_str, "%Y-%m-%d %H:%M")
         confirm_update_event(message, event_id, field_name, new_date)
     except ValueError:
-        msg = bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
-        bot.register_next_step_handler(msg, process_edit_event_start_date, event_id, field_name)
+        bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
+        set_next_step(chat_id, process_edit_event_start_date, event_id, field_name)
 
+@conversation_step
 def process_edit_event_end_date(message, event_id, field_name):
     chat_id = message.chat.id
     new_date_str = message.text.strip()
@@ -2028,9 +4881,10 @@ def process_edit_event_end_date(message, event_id, field_name):
         
         confirm_update_event(message, event_id, field_name, new_date)
     except ValueError:
-        msg = bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
-        bot.register_next_step_handler(msg, process_edit_event_end_date, event_id, field_name)
+        bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD HH:MM):")
+        set_next_step(chat_id, process_edit_event_end_date, event_id, field_name)
 
+@conversation_step
 def process_edit_event_location(message, event_id, field_name):
     chat_id = message.chat.id
     new_location = message.text.strip()
@@ -2040,12 +4894,13 @@ def process_edit_event_location(message, event_id, field_name):
         return
     
     if not new_location:
-        msg = bot.send_message(chat_id, "مکان وارد شده معتبر نیست. لطفاً مجدداً وارد کنید:")
-        bot.register_next_step_handler(msg, process_edit_event_location)
+        bot.send_message(chat_id, "مکان وارد شده معتبر نیست. لطفاً مجدداً وارد کنید:")
+        set_next_step(chat_id, process_edit_event_location)
         return
     
     confirm_update_event(message, event_id, field_name, new_location)
 
+@conversation_step
 def process_edit_event_result(message, event_id, field_name):
     chat_id = message.chat.id
     result_text = message.text.strip()
@@ -2062,8 +4917,8 @@ def process_edit_event_result(message, event_id, field_name):
     }
     
     if result_text not in result_map:
-        msg = bot.send_message(chat_id, "نتیجه نامعتبر است. لطفاً از گزینه‌ها انتخاب کنید:")
-        bot.register_next_step_handler(msg, process_edit_event_result)
+        bot.send_message(chat_id, "نتیجه نامعتبر است. لطفاً از گزینه‌ها انتخاب کنید:")
+        set_next_step(chat_id, process_edit_event_result)
         return
         
     confirm_update_event(message, event_id, field_name, result_text)
@@ -2079,9 +4934,10 @@ def confirm_update_event(message, event_id, field_name, new_value):
     markup.add(types.KeyboardButton("بله، ویرایش کن"),
                types.KeyboardButton("خیر، لغو کن"))
     
-    msg = bot.send_message(chat_id, response, reply_markup=markup)
-    bot.register_next_step_handler(msg, process_event_update_confirmation, event_id, field_name, new_value)
+    bot.send_message(chat_id, response, reply_markup=markup)
+    set_next_step(chat_id, process_event_update_confirmation, event_id, field_name, new_value)
 
+@conversation_step
 def process_event_update_confirmation(message, event_id, field_name, new_value):
     chat_id = message.chat.id
     confirmation = message.text.strip()
@@ -2133,8 +4989,8 @@ def process_event_update_confirmation(message, event_id, field_name, new_value):
                 fighter1_result = result
                 fighter2_result = result
             
-            fighter1_id = get_fighter_id_by_name(event['fighter1_name']) # type: ignore
-            fighter2_id = get_fighter_id_by_name(event['fighter2_name']) # type: ignore
+            fighter1_id = event['fighter1_id'] # type: ignore
+            fighter2_id = event['fighter2_id'] # type: ignore
             
             cur.execute("""
                 UPDATE participants 
@@ -2149,6 +5005,7 @@ def process_event_update_confirmation(message, event_id, field_name, new_value):
             """, (fighter2_result, event_id, fighter2_id))
         
         conn.commit()
+        event_cache.invalidate(event_id)
         
         bot.send_message(chat_id, "اطلاعات رویداد با موفقیت ویرایش شد.", reply_markup=main_menu())
         cur.close()
@@ -2166,13 +5023,14 @@ def process_event_update_confirmation(message, event_id, field_name, new_value):
 
 # region ------ Add Fighter to Trainer Handler ------
 
-@bot.message_handler(func=lambda message: message.text == 'اضافه کردن مربی به مبارز')
+@router.text('اضافه کردن مربی به مبارز')
 @login_required
 def assign_trainer_to_fighter_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه مبارز را وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_assign_fighter_id)
+    bot.send_message(chat_id, "لطفاً شناسه مبارز را وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_assign_fighter_id)
 
+@conversation_step
 def process_assign_fighter_id(message):
     chat_id = message.chat.id
     fighter_id_str = message.text.strip()
@@ -2182,21 +5040,22 @@ def process_assign_fighter_id(message):
         return
     
     if not fighter_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_assign_fighter_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_assign_fighter_id)
         return
     
     fighter_id = int(fighter_id_str)
     
     fighter = get_fighter_by_id(fighter_id)
     if not fighter:
-        msg = bot.send_message(chat_id, "مبارزی با این شناسه یافت نشد. لطفاً دوباره تلاش کنید:")
-        bot.register_next_step_handler(msg, process_assign_fighter_id)
+        bot.send_message(chat_id, "مبارزی با این شناسه یافت نشد. لطفاً دوباره تلاش کنید:")
+        set_next_step(chat_id, process_assign_fighter_id)
         return
     
-    msg = bot.send_message(chat_id, "لطفاً شناسه مربی را وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_assign_trainer_id, fighter_id, fighter['name'])
+    bot.send_message(chat_id, "لطفاً شناسه مربی را وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_assign_trainer_id, fighter_id, fighter['name'])
 
+@conversation_step
 def process_assign_trainer_id(message, fighter_id, fighter_name):
     chat_id = message.chat.id
     trainer_id_str = message.text.strip()
@@ -2206,16 +5065,16 @@ def process_assign_trainer_id(message, fighter_id, fighter_name):
         return
     
     if not trainer_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_assign_trainer_id, fighter_id, fighter_name)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_assign_trainer_id, fighter_id, fighter_name)
         return
     
     trainer_id = int(trainer_id_str)
     
     trainer = get_trainer_by_id(trainer_id)
     if not trainer:
-        msg = bot.send_message(chat_id, "مربی‌ای با این شناسه یافت نشد. لطفاً مجدداً وارد کنید:")
-        bot.register_next_step_handler(msg, process_assign_trainer_id, fighter_id, fighter_name)
+        bot.send_message(chat_id, "مربی‌ای با این شناسه یافت نشد. لطفاً مجدداً وارد کنید:")
+        set_next_step(chat_id, process_assign_trainer_id, fighter_id, fighter_name)
         return
     
     conn = get_db_connection()
@@ -2236,14 +5095,15 @@ def process_assign_trainer_id(message, fighter_id, fighter_name):
         
         cur.close()
         
-        msg = bot.send_message(chat_id, "تاریخ شروع همکاری را وارد کنید (فرمت: YYYY-MM-DD یا 'امروز' برای تاریخ امروز):", reply_markup=cancel_menu())
-        bot.register_next_step_handler(msg, process_assign_start_date, fighter_id, fighter_name, trainer_id, trainer['name'])
+        bot.send_message(chat_id, "تاریخ شروع همکاری را وارد کنید (فرمت: YYYY-MM-DD یا 'امروز' برای تاریخ امروز):", reply_markup=cancel_menu())
+        set_next_step(chat_id, process_assign_start_date, fighter_id, fighter_name, trainer_id, trainer['name'])
     except Error as e:
         bot.send_message(chat_id, f"خطا در بررسی اطلاعات: {e}", reply_markup=trainer_fighter_management_menu())
     finally:
         if conn:
             conn.close()
 
+@conversation_step
 def process_assign_start_date(message, fighter_id, fighter_name, trainer_id, trainer_name):
     chat_id = message.chat.id
     start_date_str = message.text.strip()
@@ -2258,8 +5118,8 @@ def process_assign_start_date(message, fighter_id, fighter_name, trainer_id, tra
         try:
             start_date = datetime.strptime(start_date_str, "%Y-%m-%d").date()
         except ValueError:
-            msg = bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD):")
-            bot.register_next_step_handler(msg, process_assign_start_date, fighter_id, fighter_name, trainer_id, trainer_name)
+            bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD):")
+            set_next_step(chat_id, process_assign_start_date, fighter_id, fighter_name, trainer_id, trainer_name)
             return
     
     conn = get_db_connection()
@@ -2275,6 +5135,8 @@ def process_assign_start_date(message, fighter_id, fighter_name, trainer_id, tra
         """, (fighter_id, trainer_id, start_date))
         
         conn.commit()
+        fighter_cache.invalidate(fighter_id)
+        trainer_cache.invalidate(trainer_id)
         
         response = f"""
 مربی با موفقیت به مبارز اختصاص داده شد:
@@ -2296,13 +5158,14 @@ def process_assign_start_date(message, fighter_id, fighter_name, trainer_id, tra
 
 # region ---- Remove Fighter from Trainer Handler ---
 
-@bot.message_handler(func=lambda message: message.text == 'حذف مربی از مبارز')
+@router.text('حذف مربی از مبارز')
 @login_required
 def remove_trainer_from_fighter_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه مبارز را وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_remove_fighter_id)
+    bot.send_message(chat_id, "لطفاً شناسه مبارز را وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_remove_fighter_id)
 
+@conversation_step
 def process_remove_fighter_id(message):
     chat_id = message.chat.id
     fighter_id_str = message.text.strip()
@@ -2312,8 +5175,8 @@ def process_remove_fighter_id(message):
         return
     
     if not fighter_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_remove_fighter_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_remove_fighter_id)
         return
     
     fighter_id = int(fighter_id_str)
@@ -2354,8 +5217,8 @@ def process_remove_fighter_id(message):
             markup.add(types.KeyboardButton(str(i+1)))
         markup.add(types.KeyboardButton("لغو عملیات"))
         
-        msg = bot.send_message(chat_id, response, reply_markup=markup)
-        bot.register_next_step_handler(msg, process_select_trainer_to_remove, fighter_id, trainer_dict)
+        bot.send_message(chat_id, response, reply_markup=markup)
+        set_next_step(chat_id, process_select_trainer_to_remove, fighter_id, trainer_dict)
         cur.close()
     except Error as e:
         bot.send_message(chat_id, f"خطا در دریافت اطلاعات: {e}", reply_markup=trainer_fighter_management_menu())
@@ -2363,6 +5226,7 @@ def process_remove_fighter_id(message):
         if conn:
             conn.close()
 
+@conversation_step
 def process_select_trainer_to_remove(message, fighter_id, trainer_dict):
     chat_id = message.chat.id
     choice = message.text.strip()
@@ -2372,15 +5236,16 @@ def process_select_trainer_to_remove(message, fighter_id, trainer_dict):
         return
     
     if choice not in trainer_dict:
-        msg = bot.send_message(chat_id, "انتخاب نامعتبر است. لطفاً مجدداً انتخاب کنید:")
-        bot.register_next_step_handler(msg, process_select_trainer_to_remove, fighter_id, trainer_dict)
+        bot.send_message(chat_id, "انتخاب نامعتبر است. لطفاً مجدداً انتخاب کنید:")
+        set_next_step(chat_id, process_select_trainer_to_remove, fighter_id, trainer_dict)
         return
     
     selected_trainer = trainer_dict[choice]
     
-    msg = bot.send_message(chat_id, "تاریخ پایان همکاری را وارد کنید (فرمت: YYYY-MM-DD یا 'امروز' برای تاریخ امروز):", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_remove_end_date, fighter_id, selected_trainer['trainer_id'], selected_trainer['trainer_name'])
+    bot.send_message(chat_id, "تاریخ پایان همکاری را وارد کنید (فرمت: YYYY-MM-DD یا 'امروز' برای تاریخ امروز):", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_remove_end_date, fighter_id, selected_trainer['trainer_id'], selected_trainer['trainer_name'])
 
+@conversation_step
 def process_remove_end_date(message, fighter_id, trainer_id, trainer_name):
     chat_id = message.chat.id
     end_date_str = message.text.strip()
@@ -2395,8 +5260,8 @@ def process_remove_end_date(message, fighter_id, trainer_id, trainer_name):
         try:
             end_date = datetime.strptime(end_date_str, "%Y-%m-%d").date()
         except ValueError:
-            msg = bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD):")
-            bot.register_next_step_handler(msg, process_remove_end_date, fighter_id, trainer_id, trainer_name)
+            bot.send_message(chat_id, "فرمت تاریخ اشتباه است. لطفاً مجدداً وارد کنید (فرمت: YYYY-MM-DD):")
+            set_next_step(chat_id, process_remove_end_date, fighter_id, trainer_id, trainer_name)
             return
     
     conn = get_db_connection()
@@ -2413,6 +5278,8 @@ def process_remove_end_date(message, fighter_id, trainer_id, trainer_name):
         """, (end_date, fighter_id, trainer_id))
         
         conn.commit()
+        fighter_cache.invalidate(fighter_id)
+        trainer_cache.invalidate(trainer_id)
         
         response = f"""
 مربی با موفقیت از مبارز حذف شد:
@@ -2434,13 +5301,14 @@ def process_remove_end_date(message, fighter_id, trainer_id, trainer_name):
 
 # region -------- Display Fighter's Trainers --------
 
-@bot.message_handler(func=lambda message: message.text == 'مشاهده مربیان یک مبارز')
+@router.text('مشاهده مربیان یک مبارز')
 @login_required
 def view_fighter_trainers_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه مبارز را وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_view_fighter_trainers)
+    bot.send_message(chat_id, "لطفاً شناسه مبارز را وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_view_fighter_trainers)
 
+@conversation_step
 def process_view_fighter_trainers(message):
     chat_id = message.chat.id
     fighter_id_str = message.text.strip()
@@ -2450,8 +5318,8 @@ def process_view_fighter_trainers(message):
         return
     
     if not fighter_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_view_fighter_trainers)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_view_fighter_trainers)
         return
     
     fighter_id = int(fighter_id_str)
@@ -2467,7 +5335,7 @@ def process_view_fighter_trainers(message):
         return
     
     try:
-        cur = conn.cursor()
+        cur = stream_cursor(conn, 'fighter_trainers')
         cur.execute("""
             SELECT t.trainer_id, t.name as trainer_name, t.specialty,
                    ft.start_date, ft.end_date,
@@ -2481,53 +5349,53 @@ def process_view_fighter_trainers(message):
             ORDER BY ft.end_date IS NULL DESC, ft.start_date DESC
         """, (fighter_id,))
         
-        trainers = cur.fetchall()
-        
-        if not trainers:
+        first = cur.fetchone()
+        if first is None:
             response = f"""
 مبارز: {fighter['name']}
 شناسه: {fighter_id}
 
 این مبارز در حال حاضر مربی ندارد.
             """
+            bot.send_message(chat_id, response, reply_markup=trainer_fighter_management_menu())
         else:
-            response = f"""
+            response = ResponseStream(chat_id, f"""
 مبارز: {fighter['name']}
 شناسه: {fighter_id}
 
 مربیان:
 {"="*30}
-            """
+            """, reply_markup=trainer_fighter_management_menu())
             
             active_count = 0
             inactive_count = 0
             
-            for trainer in trainers:
+            for trainer in chain((first,), cur):
                 trainer_id, trainer_name, specialty, start_date, end_date, status = trainer
                 
-                response += f"\n{trainer_name}"
-                response += f"\nتخصص: {specialty}"
-                response += f"\nشروع: {start_date}"
-            
                 if end_date:
-                    response += f"\nپایان: {end_date}"
-                    response += f"\nوضعیت: پایان یافته"
+                    end_text, status_text = end_date, "پایان یافته"
                     inactive_count += 1
                 else:
-                    response += f"\nپایان: -"
-                    response += f"\nوضعیت: فعال"
+                    end_text, status_text = "-", "فعال"
                     active_count += 1
                 
-                response += f"\nشناسه مربی: {trainer_id}"
-                response += f"\n{"-"*40}\n"
+                response.add(
+                    f"\n{trainer_name}"
+                    f"\nتخصص: {specialty}"
+                    f"\nشروع: {start_date}"
+                    f"\nپایان: {end_text}"
+                    f"\nوضعیت: {status_text}"
+                    f"\nشناسه مربی: {trainer_id}"
+                    f"\n{ROW_SEPARATOR}"
+                )
             
-            response += f"""
+            response.add(f"""
 آمار:
 مربیان فعال: {active_count}
 مربیان گذشته: {inactive_count}
-            """
-        
-        bot.send_message(chat_id, response, reply_markup=trainer_fighter_management_menu())
+            """)
+            response.close()
         cur.close()
     except Error as e:
         bot.send_message(chat_id, f"خطا در دریافت اطلاعات: {e}", reply_markup=trainer_fighter_management_menu())
@@ -2539,13 +5407,14 @@ def process_view_fighter_trainers(message):
 
 # region -------- Display Trainer's Fighters --------
 
-@bot.message_handler(func=lambda message: message.text == 'مشاهده شاگردان یک مربی')
+@router.text('مشاهده شاگردان یک مربی')
 @login_required
 def view_trainer_fighters_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه مربی را وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_view_trainer_fighters)
+    bot.send_message(chat_id, "لطفاً شناسه مربی را وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_view_trainer_fighters)
 
+@conversation_step
 def process_view_trainer_fighters(message):
     chat_id = message.chat.id
     trainer_id_str = message.text.strip()
@@ -2555,8 +5424,8 @@ def process_view_trainer_fighters(message):
         return
     
     if not trainer_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_view_trainer_fighters)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_view_trainer_fighters)
         return
     
     trainer_id = int(trainer_id_str)
@@ -2572,7 +5441,7 @@ def process_view_trainer_fighters(message):
         return
     
     try:
-        cur = conn.cursor()
+        cur = stream_cursor(conn, 'trainer_fighters')
         cur.execute("""
             SELECT f.fighter_id, f.name as fighter_name, f.weight_class,
                    f.status as fighter_status, ft.start_date, ft.end_date,
@@ -2586,9 +5455,8 @@ def process_view_trainer_fighters(message):
             ORDER BY ft.end_date IS NULL DESC, ft.start_date DESC
         """, (trainer_id,))
         
-        fighters = cur.fetchall()
-        
-        if not fighters:
+        first = cur.fetchone()
+        if first is None:
             response = f"""
 مربی: {trainer['name']}
 تخصص: {trainer['specialty']}
@@ -2596,46 +5464,47 @@ def process_view_trainer_fighters(message):
 
 این مربی در حال حاضر شاگردی ندارد.
             """
+            bot.send_message(chat_id, response, reply_markup=trainer_fighter_management_menu())
         else:
-            response = f"""
+            response = ResponseStream(chat_id, f"""
 مربی: {trainer['name']}
 تخصص: {trainer['specialty']}
 شناسه: {trainer_id}
 
 شاگردان:
 {"="*30}
-            """
+            """, reply_markup=trainer_fighter_management_menu())
             
             active_count = 0
             inactive_count = 0
             
-            for fighter in fighters:
+            for fighter in chain((first,), cur):
                 fighter_id, fighter_name, weight_class, fighter_status, start_date, end_date, training_status = fighter
                 
-                response += f"\n{fighter_name}"
-                response += f"\nرده وزنی: {weight_class}"
-                response += f"\nوضعیت مبارز: {fighter_status}"
-                response += f"\nشروع: {start_date}"
-                
                 if end_date:
-                    response += f"\nپایان: {end_date}"
-                    response += f"\nوضعیت آموزش: پایان یافته"
+                    end_text, status_text = end_date, "پایان یافته"
                     inactive_count += 1
                 else:
-                    response += f"\nپایان: -"
-                    response += f"\nوضعیت آموزش: فعال"
+                    end_text, status_text = "-", "فعال"
                     active_count += 1
                 
-                response += f"\nشناسه مبارز: {fighter_id}"
-                response += f"\n{"-"*40}\n"
+                response.add(
+                    f"\n{fighter_name}"
+                    f"\nرده وزنی: {weight_class}"
+                    f"\nوضعیت مبارز: {fighter_status}"
+                    f"\nشروع: {start_date}"
+                    f"\nپایان: {end_text}"
+                    f"\nوضعیت آموزش: {status_text}"
+                    f"\nشناسه مبارز: {fighter_id}"
+                    f"\n{ROW_SEPARATOR}"
+                )
             
-            response += f"""
+            response.add(f"""
 آمار:
 شاگردان فعال: {active_count}
 شاگردان گذشته: {inactive_count}
-"""
-        
-        bot.send_message(chat_id, response, reply_markup=trainer_fighter_management_menu())
+""")
+            response.close()
         cur.close()
     except Error as e:
         bot.send_message(chat_id, f"خطا در دریافت اطلاعات: {e}", reply_markup=trainer_fighter_management_menu())
@@ -2645,7 +5514,7 @@ def process_view_trainer_fighters(message):
 
 # endregion
 
-@bot.message_handler(func=lambda message: message.text == 'مدیریت تعلیمات')
+@router.text('مدیریت تعلیمات')
 @login_required
 def manage_trainer_fighters_menu(message):
     chat_id = message.chat.id
@@ -2659,20 +5528,21 @@ def manage_trainer_fighters_menu(message):
 
 # region --------------------- Delete Item Handlers ---------------------
 
-@bot.message_handler(func=lambda message: message.text == 'حذف آیتم')
+@router.text('حذف آیتم')
 @login_required
 def delete_item_menu(message):
     chat_id = message.chat.id
     response = "لطفاً نوع آیتمی که می‌خواهید حذف کنید را انتخاب کنید:"
     bot.send_message(chat_id, response, reply_markup=delete_menu())
 
-@bot.message_handler(func=lambda message: message.text == 'حذف مبارز')
+@router.text('حذف مبارز')
 @login_required
 def delete_fighter_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه مبارز را برای حذف وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_delete_fighter_id)
+    bot.send_message(chat_id, "لطفاً شناسه مبارز را برای حذف وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_delete_fighter_id)
 
+@conversation_step
 def process_delete_fighter_id(message):
     chat_id = message.chat.id
     fighter_id_str = message.text.strip()
@@ -2682,8 +5552,8 @@ def process_delete_fighter_id(message):
         return
     
     if not fighter_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_delete_fighter_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_delete_fighter_id)
         return
     
     fighter_id = int(fighter_id_str)
@@ -2707,9 +5577,10 @@ def process_delete_fighter_id(message):
     markup.add(types.KeyboardButton("بله، حذف کن"),
                types.KeyboardButton("خیر، لغو کن"))
     
-    msg = bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
-    bot.register_next_step_handler(msg, confirm_delete_fighter, fighter_id)
+    bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+    set_next_step(chat_id, confirm_delete_fighter, fighter_id)
 
+@conversation_step
 def confirm_delete_fighter(message, fighter_id):
     chat_id = message.chat.id
     confirmation = message.text.strip()
@@ -2731,6 +5602,8 @@ def confirm_delete_fighter(message, fighter_id):
         cur = conn.cursor()
         cur.execute("DELETE FROM fighter WHERE fighter_id = %s", (fighter_id,))
         conn.commit()
+        fighter_cache.invalidate(fighter_id)
+        event_cache.clear()
         bot.send_message(chat_id, f"مبارز با شناسه {fighter_id} با موفقیت حذف شد.", reply_markup=delete_menu())
         cur.close()
     except Error as e:
@@ -2739,13 +5612,14 @@ def confirm_delete_fighter(message, fighter_id):
         if conn:
             conn.close()
 
-@bot.message_handler(func=lambda message: message.text == 'حذف مربی')
+@router.text('حذف مربی')
 @login_required
 def delete_trainer_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه مربی را برای حذف وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_delete_trainer_id)
+    bot.send_message(chat_id, "لطفاً شناسه مربی را برای حذف وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_delete_trainer_id)
 
+@conversation_step
 def process_delete_trainer_id(message):
     chat_id = message.chat.id
     trainer_id_str = message.text.strip()
@@ -2755,8 +5629,8 @@ def process_delete_trainer_id(message):
         return
     
     if not trainer_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_delete_trainer_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_delete_trainer_id)
         return
     
     trainer_id = int(trainer_id_str)
@@ -2778,9 +5652,10 @@ def process_delete_trainer_id(message):
     markup.add(types.KeyboardButton("بله، حذف کن"),
                types.KeyboardButton("خیر، لغو کن"))
     
-    msg = bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
-    bot.register_next_step_handler(msg, confirm_delete_trainer, trainer_id)
+    bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+    set_next_step(chat_id, confirm_delete_trainer, trainer_id)
 
+@conversation_step
 def confirm_delete_trainer(message, trainer_id):
     chat_id = message.chat.id
     confirmation = message.text.strip()
@@ -2802,6 +5677,7 @@ def confirm_delete_trainer(message, trainer_id):
         cur = conn.cursor()
         cur.execute("DELETE FROM trainer WHERE trainer_id = %s", (trainer_id,))
         conn.commit()
+        trainer_cache.invalidate(trainer_id)
         bot.send_message(chat_id, f"مربی با شناسه {trainer_id} با موفقیت حذف شد.", reply_markup=delete_menu())
         cur.close()
     except Error as e:
@@ -2810,13 +5686,14 @@ def confirm_delete_trainer(message, trainer_id):
         if conn:
             conn.close()
 
-@bot.message_handler(func=lambda message: message.text == 'حذف باشگاه')
+@router.text('حذف باشگاه')
 @login_required
 def delete_gym_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه باشگاه را برای حذف وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_delete_gym_id)
+    bot.send_message(chat_id, "لطفاً شناسه باشگاه را برای حذف وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_delete_gym_id)
 
+@conversation_step
 def process_delete_gym_id(message):
     chat_id = message.chat.id
     gym_id_str = message.text.strip()
@@ -2826,8 +5703,8 @@ def process_delete_gym_id(message):
         return
     
     if not gym_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_delete_gym_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_delete_gym_id)
         return
     
     gym_id = int(gym_id_str)
@@ -2844,11 +5721,11 @@ def process_delete_gym_id(message):
     
     try:
         cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM fighter WHERE gym_id = %s", (gym_id,))
-        fighter_count = cur.fetchone()[0] # type: ignore
-        
-        cur.execute("SELECT COUNT(*) FROM trainer WHERE gym_id = %s", (gym_id,))
-        trainer_count = cur.fetchone()[0] # type: ignore
+        cur.execute("""
+            SELECT (SELECT COUNT(*) FROM fighter WHERE gym_id = %s),
+                   (SELECT COUNT(*) FROM trainer WHERE gym_id = %s)
+        """, (gym_id, gym_id))
+        fighter_count, trainer_count = cur.fetchone() # type: ignore
         
         response = f"""اطلاعات باشگاه مورد نظر:
         نام: {gym['name']}
@@ -2865,8 +5742,8 @@ def process_delete_gym_id(message):
         markup.add(types.KeyboardButton("بله، حذف کن"),
                    types.KeyboardButton("خیر، لغو کن"))
         
-        msg = bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
-        bot.register_next_step_handler(msg, confirm_delete_gym, gym_id, fighter_count, trainer_count)
+        bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+        set_next_step(chat_id, confirm_delete_gym, gym_id, fighter_count, trainer_count)
         cur.close()
     except Error as e:
         bot.send_message(chat_id, f"خطا در دریافت اطلاعات: {e}", reply_markup=delete_menu())
@@ -2874,6 +5751,7 @@ def process_delete_gym_id(message):
         if conn:
             conn.close()
 
+@conversation_step
 def confirm_delete_gym(message, gym_id, fighter_count, trainer_count):
     chat_id = message.chat.id
     confirmation = message.text.strip()
@@ -2902,6 +5780,9 @@ def confirm_delete_gym(message, gym_id, fighter_count, trainer_count):
         cur.execute("DELETE FROM gym WHERE gym_id = %s", (gym_id,))
         
         conn.commit()
+        gym_cache.invalidate(gym_id)
+        fighter_cache.clear()
+        trainer_cache.clear()
         
         response = f"""باشگاه با شناسه {gym_id} با موفقیت حذف شد.
         باشگاه {fighters_updated} مبارز روی NULL تنظیم شد.
@@ -2915,13 +5796,14 @@ def confirm_delete_gym(message, gym_id, fighter_count, trainer_count):
         if conn:
             conn.close()
 
-@bot.message_handler(func=lambda message: message.text == 'حذف رویداد')
+@router.text('حذف رویداد')
 @login_required
 def delete_event_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً شناسه رویداد را برای حذف وارد کنید:", reply_markup=cancel_menu())
-    bot.register_next_step_handler(msg, process_delete_event_id)
+    bot.send_message(chat_id, "لطفاً شناسه رویداد را برای حذف وارد کنید:", reply_markup=cancel_menu())
+    set_next_step(chat_id, process_delete_event_id)
 
+@conversation_step
 def process_delete_event_id(message):
     chat_id = message.chat.id
     event_id_str = message.text.strip()
@@ -2931,8 +5813,8 @@ def process_delete_event_id(message):
         return
     
     if not event_id_str.isdigit():
-        msg = bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
-        bot.register_next_step_handler(msg, process_delete_event_id)
+        bot.send_message(chat_id, "شناسه نامعتبر است. لطفاً عدد وارد کنید:")
+        set_next_step(chat_id, process_delete_event_id)
         return
     
     event_id = int(event_id_str)
@@ -2955,9 +5837,10 @@ def process_delete_event_id(message):
     markup.add(types.KeyboardButton("بله، حذف کن"),
                types.KeyboardButton("خیر، لغو کن"))
     
-    msg = bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
-    bot.register_next_step_handler(msg, confirm_delete_event, event_id)
+    bot.send_message(chat_id, response, parse_mode='Markdown', reply_markup=markup)
+    set_next_step(chat_id, confirm_delete_event, event_id)
 
+@conversation_step
 def confirm_delete_event(message, event_id):
     chat_id = message.chat.id
     confirmation = message.text.strip()
@@ -2983,6 +5866,7 @@ def confirm_delete_event(message, event_id):
         cur.execute("DELETE FROM match_event WHERE match_id = %s", (event_id,))
         
         conn.commit()
+        event_cache.invalidate(event_id)
         
         response = f"""رویداد با شناسه {event_id} با موفقیت حذف شد.
         اطلاعات شرکت {participants_deleted} مبارز در رویداد حذف شد."""
@@ -2997,8 +5881,231 @@ def confirm_delete_event(message, event_id):
 
 # endregion
 
+# region ------------------------ Metrics Endpoint ------------------------
+
+# Serves the handler, query and queue metrics in the Prometheus text format
+# on METRICS_HOST:METRICS_PORT (loopback by default; METRICS_PORT=0 turns
+# it off). Latencies are exported in seconds.
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_histogram(lines, metric, labels, snapshot):
+    label_text = ','.join(f'{key}="{prometheus_label(value)}"' for key, value in labels.items())
+    prefix = label_text + ',' if label_text else ''
+    cumulative = 0
+    for bound, count in snapshot['buckets'].items():
+        cumulative += count
+        le = '+Inf' if bound == 'inf' else f"{bound / 1000:g}"
+        lines.append(f'{metric}_bucket{{{prefix}le="{le}"}} {cumulative}')
+    lines.append(f'{metric}_sum{{{label_text}}} {snapshot["total_ms"] / 1000:.6f}')
+    lines.append(f'{metric}_count{{{label_text}}} {snapshot["count"]}')
+
+def render_metrics():
+    lines = []
+    handlers = handler_stats()
+
+    lines.append('# HELP fightclub_handler_updates_total Updates handled, by handler and outcome.')
+    lines.append('# TYPE fightclub_handler_updates_total counter')
+    for handler, kinds in sorted(handlers.items()):
+        duration = kinds['duration']
+        label = prometheus_label(handler)
+        lines.append(f'fightclub_handler_updates_total{{handler="{label}",outcome="ok"}} {duration["count"] - duration["errors"]}')
+        lines.append(f'fightclub_handler_updates_total{{handler="{label}",outcome="error"}} {duration["errors"]}')
+
+    for kind, metric, help_text in (
+        ('duration', 'fightclub_handler_duration_seconds', 'End-to-end handling time of an update, commit included.'),
+        ('db', 'fightclub_handler_db_seconds', 'Time an update spent in database queries.'),
+        ('send', 'fightclub_handler_send_seconds', 'Time from queueing a Telegram call to its completion.'),
+    ):
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} histogram')
+        for handler, kinds in sorted(handlers.items()):
+            prometheus_histogram(lines, metric, {'handler': handler}, kinds[kind])
+
+    queries = query_stats()
+    lines.append('# HELP fightclub_query_duration_seconds Execution time of a query, by query name.')
+    lines.append('# TYPE fightclub_query_duration_seconds histogram')
+    for name, snapshot in sorted(queries['queries'].items()):
+        prometheus_histogram(lines, 'fightclub_query_duration_seconds', {'query': name}, snapshot)
+    lines.append('# HELP fightclub_query_rows_total Rows returned or affected, by query name.')
+    lines.append('# TYPE fightclub_query_rows_total counter')
+    for name, snapshot in sorted(queries['queries'].items()):
+        lines.append(f'fightclub_query_rows_total{{query="{prometheus_label(name)}"}} {snapshot["rows"]}')
+    lines.append('# HELP fightclub_db_pool_wait_seconds Time spent waiting for a pooled connection.')
+    lines.append('# TYPE fightclub_db_pool_wait_seconds histogram')
+    prometheus_histogram(lines, 'fightclub_db_pool_wait_seconds', {}, queries['pool_wait'])
+
+    executor = update_executor.stats()
+    dispatcher = outbound.stats()
+    for metric, metric_type, help_text, value in (
+        ('fightclub_updates_pending', 'gauge', 'Updates waiting for a worker.', executor['pending']),
+        ('fightclub_updates_shed_total', 'counter', 'Updates turned away because the backlog was full.', executor['shed']),
+        ('fightclub_outbound_queue_depth', 'gauge', 'Telegram calls waiting to be sent.', dispatcher['depth']),
+        ('fightclub_outbound_failed_total', 'counter', 'Telegram calls given up on.', dispatcher['failed']),
+    ):
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {metric_type}')
+        lines.append(f'{metric} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    if METRICS_PORT <= 0:
+        return None
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+    except OSError as e:
+        print(f"Metrics endpoint disabled: {e}")
+        return None
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    print(f"Serving metrics on {METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+# endregion
+
+# region ------------------------- Webhook Mode -------------------------
+
+# With BOT_MODE=webhook, Telegram posts updates to a local HTTP server
+# instead of the bot long polling for them. The server only checks the
+# request and hands the update to telebot, whose handlers are queued on
+# the update executor, so each chat's updates still run in order on the
+# worker threads while different chats run in parallel. That ordering
+# relies on the webhook being registered with max_connections=1, which
+# run_webhook does when WEBHOOK_URL is set; register it the same way when
+# doing it by hand. The server speaks plain HTTP on loopback by default
+# and is meant to sit behind a TLS proxy; it will not start without
+# WEBHOOK_SECRET, since without one anyone who reaches the port could post
+# updates as any chat.
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not WEBHOOK_SECRET or not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            self.send_error(403)
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self.send_error(413 if length > 0 else 400)
+            return
+        try:
+            update = types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Rejected malformed update: {e}")
+            self.send_error(400)
+            return
+
+        bot.process_new_updates([update])
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def run_webhook():
+    # Telegram only accepts 1-256 of these characters as a secret token.
+    if not WEBHOOK_SECRET or not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+        raise SystemExit("Webhook mode needs WEBHOOK_SECRET (1-256 characters of A-Z, a-z, 0-9, _ and -).")
+    if WEBHOOK_URL:
+        # One connection at a time: Telegram then waits for each 200 before
+        # posting the next update, and the 200 is only sent once the update
+        # is queued on the executor. With more connections, two updates for
+        # one chat could race to submit() and run out of order. Handing an
+        # update over is cheap, so the single connection is not a bottleneck.
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=1)
+
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookRequestHandler)
+    print(f"Listening for updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+# endregion
+
+# region ------------------------- Asyncio Mode -------------------------
+
+# BOT_MODE=asyncio runs the whole bot on one event loop. Long polling and
+# every outbound send go through AsyncTeleBot, and each update runs as a
+# task whose handler talks to Postgres through the async pool (see Async
+# Postgres). Chats stay serialized by the update executor, but there are
+# no UPDATE_WORKERS threads: up to ASYNC_MAX_UPDATES updates are in flight
+# at once, and an update waiting on Postgres or Telegram holds no thread.
+# Needs greenlet, psycopg and psycopg-pool.
+
+async def poll_updates_async(api):
+    offset = None
+    while True:
+        try:
+            updates = await api.get_updates(offset=offset, timeout=ASYNC_POLL_TIMEOUT)
+        except Exception as e:
+            print(f"Error polling for updates: {e}")
+            await asyncio.sleep(ASYNC_POLL_RETRY_DELAY)
+            continue
+        if updates:
+            offset = updates[-1].update_id + 1
+            bot.process_new_updates(updates)
+
+async def run_async_engine():
+    # Imported here so the sync modes do not need aiohttp.
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+
+    global async_db_pool
+
+    if TELEGRAM_API_URL:
+        asyncio_helper.API_URL = telebot.apihelper.API_URL
+    api = AsyncTeleBot(BOT_TOKEN) # type: ignore
+    pool = await open_async_db_pool()
+    async_db_pool = AsyncPoolBridge(pool)
+    bot.async_api = api
+    try:
+        await asyncio.gather(
+            update_executor.run_async(ASYNC_MAX_UPDATES),
+            outbound.run_async(api),
+            poll_updates_async(api),
+        )
+    finally:
+        bot.async_api = None
+        async_db_pool = None
+        await pool.close()
+        await api.close_session()
+
+def run_asyncio():
+    if greenlet is None or psycopg is None or psycopg_pool is None:
+        raise SystemExit("BOT_MODE=asyncio needs the greenlet, psycopg and psycopg-pool packages")
+    asyncio.run(run_async_engine())
+
+# endregion
+
 if __name__ == '__main__':
-    create_tables()
+    migrate()
+    start_name_index_listener()
+    start_conversation_sweeper()
+    start_metrics_server()
     print("Running...")
 
-    bot.polling(none_stop=True)
\ No newline at end of file
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    elif BOT_MODE == 'asyncio':
+        run_asyncio()
+    else:
+        bot.polling(none_stop=True)
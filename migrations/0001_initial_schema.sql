@@ -0,0 +1,62 @@
+CREATE TABLE IF NOT EXISTS gym (
+    gym_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    name varchar NOT NULL,
+    location varchar NOT NULL,
+    owner varchar NOT NULL,
+    reputation_score integer DEFAULT 75 CHECK (reputation_score >= 0 AND reputation_score <= 100)
+);
+
+CREATE TABLE IF NOT EXISTS fighter (
+    fighter_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    name varchar NOT NULL,
+    nickname varchar,
+    weight_class varchar NOT NULL,
+    age integer NOT NULL CHECK (age > 0),
+    nationality varchar,
+    status varchar DEFAULT 'active' CHECK (status IN ('active', 'retired', 'suspended')),
+    gym_id integer REFERENCES gym(gym_id) ON DELETE SET NULL
+);
+
+CREATE TABLE IF NOT EXISTS trainer (
+    trainer_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    name varchar NOT NULL,
+    specialty varchar NOT NULL,
+    gym_id integer REFERENCES gym(gym_id) ON DELETE SET NULL
+);
+
+CREATE TABLE IF NOT EXISTS fighter_trainer (
+    ft_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    fighter_id integer REFERENCES fighter(fighter_id) ON DELETE CASCADE,
+    trainer_id integer REFERENCES trainer(trainer_id) ON DELETE CASCADE,
+    start_date date NOT NULL DEFAULT CURRENT_DATE,
+    end_date date,
+    UNIQUE NULLS NOT DISTINCT (fighter_id, trainer_id, end_date)
+);
+
+-- Databases created before migrations may already carry this constraint.
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conname = 'check_date_order' AND conrelid = 'fighter_trainer'::regclass
+    ) THEN
+        ALTER TABLE fighter_trainer
+        ADD CONSTRAINT check_date_order
+        CHECK (end_date IS NULL OR end_date >= start_date);
+    END IF;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS match_event (
+    match_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    start_date timestamp NOT NULL,
+    end_date timestamp,
+    location varchar NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS participants (
+    match_id integer REFERENCES match_event(match_id) ON DELETE CASCADE,
+    fighter_id integer REFERENCES fighter(fighter_id) ON DELETE CASCADE,
+    result varchar CHECK (result IN ('win', 'loss', 'draw', 'no contest')),
+    PRIMARY KEY (match_id, fighter_id)
+);
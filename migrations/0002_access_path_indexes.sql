@@ -0,0 +1,20 @@
+-- migrate:no-transaction
+-- Indexes matching the bot's query shapes. Postgres does not index foreign
+-- keys on its own; the PKs and the fighter_trainer unique constraint already
+-- cover the (match_id, ...) and (fighter_id, ...) lookups. The events list
+-- is ordered by start_date; 0007 indexes it together with its tiebreak.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fighter_gym_id
+    ON fighter (gym_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_trainer_gym_id
+    ON trainer (gym_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fighter_trainer_trainer_id
+    ON fighter_trainer (trainer_id, end_date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fighter_trainer_active
+    ON fighter_trainer (fighter_id, trainer_id) WHERE end_date IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_participants_fighter_id
+    ON participants (fighter_id, match_id);
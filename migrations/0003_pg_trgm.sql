@@ -0,0 +1,9 @@
+-- Trigram search needs pg_trgm. Managed databases may not allow creating
+-- it, in which case the search handlers fall back to plain ILIKE scans.
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm is not available: %', SQLERRM;
+END
+$$;
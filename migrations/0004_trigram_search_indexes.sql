@@ -0,0 +1,24 @@
+-- migrate:no-transaction
+-- migrate:requires-extension pg_trgm
+-- GIN trigram indexes behind the ILIKE '%term%' and similarity searches.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fighter_name_trgm
+    ON fighter USING gin (name gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fighter_nickname_trgm
+    ON fighter USING gin (nickname gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_gym_name_trgm
+    ON gym USING gin (name gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_gym_location_trgm
+    ON gym USING gin (location gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_gym_owner_trgm
+    ON gym USING gin (owner gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_trainer_name_trgm
+    ON trainer USING gin (name gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_trainer_specialty_trgm
+    ON trainer USING gin (specialty gin_trgm_ops);
@@ -0,0 +1,23 @@
+# Adds the transliteration-normalized search_key columns and fills them for
+# existing rows. The key comes from unidecode in the bot process, so it
+# cannot be a generated column; normalize_search_key is supplied by the
+# migration runner.
+
+from psycopg2.extras import execute_values
+
+TABLES = [
+    ('fighter', 'fighter_id', ['name', 'nickname']),
+    ('gym', 'gym_id', ['name']),
+    ('trainer', 'trainer_id', ['name']),
+]
+
+def migrate(cursor):
+    for table, key, columns in TABLES:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_key varchar")
+        cursor.execute(f"SELECT {key}, {', '.join(columns)} FROM {table}")
+        rows = [(row[0], normalize_search_key(*row[1:])) for row in cursor.fetchall()] # type: ignore
+        execute_values(cursor, f"""
+            UPDATE {table} SET search_key = v.search_key
+            FROM (VALUES %s) AS v (id, search_key)
+            WHERE {table}.{key} = v.id
+        """, rows, page_size=1000)
@@ -0,0 +1,16 @@
+-- migrate:no-transaction
+-- Keyset pagination walks (name, id) and (start_date, match_id), so each
+-- page is a single index range scan. The events index also serves every
+-- plain ORDER BY start_date DESC read.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fighter_name_id
+    ON fighter (name, fighter_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_gym_name_id
+    ON gym (name, gym_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_trainer_name_id
+    ON trainer (name, trainer_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_match_event_start_date_id
+    ON match_event (start_date DESC, match_id DESC);
@@ -0,0 +1,36 @@
+-- Name lookups in the wizards compare names after folding the Arabic
+-- yeh/kaf variants, dropping zero-width non-joiners, collapsing spaces and
+-- lowercasing. name_lookup_key() in bot.py must fold the same way.
+CREATE OR REPLACE FUNCTION name_lookup_key(name text) RETURNS text AS $$
+    SELECT lower(btrim(regexp_replace(replace(translate(name, 'يىك', 'ییک'), E'\u200c', ''), '\s+', ' ', 'g')))
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+-- The bot keeps an in-memory name -> id map per table and listens on the
+-- name_lookup channel to apply inserts, renames and deletes as they commit.
+CREATE OR REPLACE FUNCTION notify_name_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+    PERFORM pg_notify('name_lookup', json_build_object(
+        'table', TG_TABLE_NAME,
+        'id', (row_data ->> TG_ARGV[0])::integer,
+        'name', CASE WHEN TG_OP = 'DELETE' THEN NULL ELSE row_data ->> 'name' END
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS fighter_name_lookup ON fighter;
+CREATE TRIGGER fighter_name_lookup
+    AFTER INSERT OR DELETE OR UPDATE OF name ON fighter
+    FOR EACH ROW EXECUTE FUNCTION notify_name_change('fighter_id');
+
+DROP TRIGGER IF EXISTS gym_name_lookup ON gym;
+CREATE TRIGGER gym_name_lookup
+    AFTER INSERT OR DELETE OR UPDATE OF name ON gym
+    FOR EACH ROW EXECUTE FUNCTION notify_name_change('gym_id');
@@ -0,0 +1,9 @@
+-- migrate:no-transaction
+-- Backs the database fallback of the name lookups, used until the bot's
+-- in-memory name map has loaded or while its listener is reconnecting.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fighter_name_lookup
+    ON fighter (name_lookup_key(name));
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_gym_name_lookup
+    ON gym (name_lookup_key(name));
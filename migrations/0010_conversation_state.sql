@@ -0,0 +1,9 @@
+-- Wizard state per chat: the name of the step waiting for the chat's next
+-- message and its arguments as compact JSON. Keeping it here lets a
+-- restarted bot, or another bot worker, carry on the conversation.
+CREATE TABLE IF NOT EXISTS conversation_state (
+    chat_id bigint PRIMARY KEY,
+    step text NOT NULL,
+    args text NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
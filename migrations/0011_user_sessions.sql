@@ -0,0 +1,10 @@
+-- Logged-in chats, shared by every bot worker. A session ends SESSION_TTL
+-- after login or SESSION_IDLE_TIMEOUT after it was last used; the
+-- last_seen index serves the sweep of expired rows.
+CREATE TABLE IF NOT EXISTS user_session (
+    chat_id bigint PRIMARY KEY,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    last_seen timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_session_last_seen ON user_session (last_seen);
@@ -0,0 +1,2 @@
+-- The conversation sweeper deletes abandoned wizards by age.
+CREATE INDEX IF NOT EXISTS idx_conversation_state_updated_at ON conversation_state (updated_at);
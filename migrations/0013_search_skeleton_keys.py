@@ -0,0 +1,26 @@
+# Recomputes search_key, which no longer strips vowels, and adds the
+# search_skeleton column behind the lower-ranked vowel-insensitive match.
+# normalize_search_key and normalize_skeleton_key are supplied by the
+# migration runner.
+
+from psycopg2.extras import execute_values
+
+TABLES = [
+    ('fighter', 'fighter_id', ['name', 'nickname']),
+    ('gym', 'gym_id', ['name']),
+    ('trainer', 'trainer_id', ['name']),
+]
+
+def migrate(cursor):
+    for table, key, columns in TABLES:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_skeleton varchar")
+        cursor.execute(f"SELECT {key}, {', '.join(columns)} FROM {table}")
+        rows = [
+            (row[0], normalize_search_key(*row[1:]), normalize_skeleton_key(*row[1:])) # type: ignore
+            for row in cursor.fetchall()
+        ]
+        execute_values(cursor, f"""
+            UPDATE {table} SET search_key = v.search_key, search_skeleton = v.search_skeleton
+            FROM (VALUES %s) AS v (id, search_key, search_skeleton)
+            WHERE {table}.{key} = v.id
+        """, rows, page_size=1000)
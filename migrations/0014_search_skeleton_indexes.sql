@@ -0,0 +1,13 @@
+-- migrate:no-transaction
+-- migrate:requires-extension pg_trgm
+-- Trigram indexes behind the word-prefix matches on the consonant
+-- skeleton keys.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fighter_search_skeleton_trgm
+    ON fighter USING gin (search_skeleton gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_gym_search_skeleton_trgm
+    ON gym USING gin (search_skeleton gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_trainer_search_skeleton_trgm
+    ON trainer USING gin (search_skeleton gin_trgm_ops);
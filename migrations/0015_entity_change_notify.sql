@@ -0,0 +1,47 @@
+-- Every bot process caches rows by id (EntityCache in bot.py). Row changes
+-- are announced on the entity_change channel with the table and the id the
+-- cached row is keyed by, so each process drops its copy when the change
+-- commits, whichever process made it.
+CREATE OR REPLACE FUNCTION notify_entity_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+    PERFORM pg_notify('entity_change', json_build_object(
+        'table', TG_TABLE_NAME,
+        'id', (row_data ->> TG_ARGV[0])::integer
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Inserts cannot make a cached row stale, since misses are not cached,
+-- except for participants, which are part of the cached event row.
+DROP TRIGGER IF EXISTS fighter_entity_change ON fighter;
+CREATE TRIGGER fighter_entity_change
+    AFTER UPDATE OR DELETE ON fighter
+    FOR EACH ROW EXECUTE FUNCTION notify_entity_change('fighter_id');
+
+DROP TRIGGER IF EXISTS gym_entity_change ON gym;
+CREATE TRIGGER gym_entity_change
+    AFTER UPDATE OR DELETE ON gym
+    FOR EACH ROW EXECUTE FUNCTION notify_entity_change('gym_id');
+
+DROP TRIGGER IF EXISTS trainer_entity_change ON trainer;
+CREATE TRIGGER trainer_entity_change
+    AFTER UPDATE OR DELETE ON trainer
+    FOR EACH ROW EXECUTE FUNCTION notify_entity_change('trainer_id');
+
+DROP TRIGGER IF EXISTS match_event_entity_change ON match_event;
+CREATE TRIGGER match_event_entity_change
+    AFTER UPDATE OR DELETE ON match_event
+    FOR EACH ROW EXECUTE FUNCTION notify_entity_change('match_id');
+
+DROP TRIGGER IF EXISTS participants_entity_change ON participants;
+CREATE TRIGGER participants_entity_change
+    AFTER INSERT OR UPDATE OR DELETE ON participants
+    FOR EACH ROW EXECUTE FUNCTION notify_entity_change('match_id');
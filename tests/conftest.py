@@ -0,0 +1,11 @@
+import os
+import sys
+
+# bot.py reads its configuration at import time. The tests never reach
+# Telegram or Postgres: stores are kept in memory and the database calls
+# are replaced per test.
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("SESSION_STORE", "memory")
+os.environ.setdefault("CONVERSATION_STORE", "memory")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
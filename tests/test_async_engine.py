@@ -0,0 +1,85 @@
+import asyncio
+
+import psycopg
+import psycopg2
+import pytest
+
+import bot
+
+def test_await_only_runs_the_awaitable_on_the_loop():
+    def handler(value):
+        return bot.await_only(asyncio.sleep(0, result=value)) * 2
+
+    assert asyncio.run(bot.run_in_greenlet(handler, 21)) == 42
+
+def test_await_only_raises_the_awaitable_error_in_the_handler():
+    async def fail():
+        raise ValueError("boom")
+
+    def handler():
+        try:
+            bot.await_only(fail())
+        except ValueError as e:
+            return str(e)
+
+    assert asyncio.run(bot.run_in_greenlet(handler)) == "boom"
+
+def test_await_only_outside_an_update_is_refused():
+    with pytest.raises(RuntimeError):
+        bot.await_only(object())
+
+class FailingCursor:
+    async def execute(self, query, vars=None):
+        raise psycopg.errors.UniqueViolation("duplicate key")
+
+def test_driver_errors_surface_as_psycopg2_errors():
+    cursor = bot.AsyncCursorBridge(None, FailingCursor(), instrumented=False)
+
+    def handler():
+        with pytest.raises(psycopg2.errors.UniqueViolation):
+            cursor.execute("INSERT INTO gym (name) VALUES (%s)", ("x",))
+        return True
+
+    assert asyncio.run(bot.run_in_greenlet(handler))
+
+def test_update_local_is_separate_per_update():
+    state = bot.UpdateLocal('test_state')
+    seen = []
+
+    def handler(name):
+        state.name = name
+        bot.await_only(asyncio.sleep(0))
+        seen.append(state.name)
+
+    async def main():
+        await asyncio.gather(bot.run_in_greenlet(handler, 'a'), bot.run_in_greenlet(handler, 'b'))
+
+    asyncio.run(main())
+    assert sorted(seen) == ['a', 'b']
+
+def test_executor_keeps_chats_in_order_and_overlaps_them():
+    executor = bot.ChatSerialExecutor(workers=1, max_pending=100, max_chat_pending=100)
+    log = []
+
+    def task(chat_id, number):
+        log.append(('start', chat_id, number))
+        bot.await_only(asyncio.sleep(0.01))
+        log.append(('end', chat_id, number))
+
+    async def main():
+        runner = asyncio.create_task(executor.run_async(max_running=10))
+        await asyncio.sleep(0)
+        for number in range(3):
+            for chat_id in (1, 2):
+                assert executor.submit(chat_id, task, chat_id, number)
+        while executor.stats()['completed'] < 6:
+            await asyncio.sleep(0.01)
+        runner.cancel()
+
+    asyncio.run(main())
+    assert not executor._threads
+    for chat_id in (1, 2):
+        chat_log = [(event, number) for event, chat, number in log if chat == chat_id]
+        assert chat_log == [(event, number) for number in range(3) for event in ('start', 'end')]
+    # Chat 2 started before chat 1 finished its first task.
+    assert log.index(('start', 2, 0)) < log.index(('end', 1, 0))
@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+import psycopg2.extensions
+import pytest
+
+import bot
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, params=None):
+        self.connection.log.append(' '.join(query.split()[:2]))
+        if self.connection.fail_next:
+            self.connection.fail_next = False
+            self.connection.status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+            raise psycopg2.errors.UniqueViolation('duplicate key')
+        self.connection.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    def fetchone(self):
+        return ('process_gym_search', '[]', False)
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    closed = False
+
+    def __init__(self):
+        self.log = []
+        self.fail_next = False
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def commit(self):
+        self.log.append('COMMIT')
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.log.append('ROLLBACK')
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def getconn(self):
+        return self.connection
+
+    def putconn(self, connection):
+        pass
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(bot, 'get_db_pool', lambda: FakePool(connection))
+    return connection
+
+def test_popped_state_stays_popped_when_the_step_fails(connection):
+    store = bot.PostgresConversationStore(60)
+    with bot.unit_of_work():
+        assert store.pop(7) is not None
+        # The step's own write fails and it answers with an error message.
+        connection.fail_next = True
+        bot.run_statement("INSERT INTO gym VALUES (%s)", (1,))
+
+    assert connection.log == ['DELETE FROM', 'INSERT INTO', 'ROLLBACK', 'DELETE FROM', 'COMMIT']
+
+def test_only_the_last_change_per_chat_is_replayed(connection):
+    store = bot.PostgresConversationStore(60)
+    with pytest.raises(RuntimeError):
+        with bot.unit_of_work():
+            store.pop(7)
+            store.save(7, 'process_gym_search', '[]')
+            raise RuntimeError('step crashed')
+
+    assert connection.log == ['DELETE FROM', 'INSERT INTO', 'ROLLBACK', 'INSERT INTO', 'COMMIT']
+
+def test_memory_store_pop_is_not_undone_by_a_failed_step():
+    store = bot.MemoryConversationStore(60)
+    store.save(7, 'process_gym_search', '[]')
+    with pytest.raises(RuntimeError):
+        with bot.unit_of_work():
+            store.pop(7)
+            raise RuntimeError('step crashed')
+    assert store.pop(7) is None
+
+def test_expired_conversation_still_dispatches_the_message(monkeypatch):
+    sent = []
+    handled = []
+    monkeypatch.setattr(bot.outbound, 'enqueue', lambda chat_id, method, text, kwargs: sent.append(text))
+    monkeypatch.setattr(bot, 'conversations', bot.MemoryConversationStore(-1))
+    router = bot.UpdateRouter()
+    router.text('نمایش باشگاه‌ها')(handled.append)
+
+    bot.set_next_step(7, bot.process_gym_search)
+    message = SimpleNamespace(chat=SimpleNamespace(id=7), text='نمایش باشگاه‌ها')
+    router.dispatch_message(message)
+
+    assert sent == ["عملیات قبلی به دلیل عدم فعالیت لغو شد."]
+    assert handled == [message]
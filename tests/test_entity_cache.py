@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+import bot
+
+@pytest.fixture(autouse=True)
+def caches():
+    bot.clear_entity_caches()
+    for cache, key in ((bot.fighter_cache, 1), (bot.gym_cache, 2), (bot.trainer_cache, 3), (bot.event_cache, 4)):
+        cache.get_or_load(key, lambda key: {'id': key})
+    yield
+    bot.clear_entity_caches()
+
+def change(table, row_id):
+    bot.apply_entity_change(json.dumps({'table': table, 'id': row_id}))
+
+def cached(cache):
+    return cache.stats()['size']
+
+def test_trainer_change_drops_only_that_trainer():
+    change('trainer', 3)
+
+    assert cached(bot.trainer_cache) == 0
+    assert cached(bot.fighter_cache) == cached(bot.gym_cache) == cached(bot.event_cache) == 1
+
+def test_gym_change_drops_rows_carrying_its_name():
+    change('gym', 2)
+
+    assert cached(bot.gym_cache) == cached(bot.fighter_cache) == cached(bot.trainer_cache) == 0
+    assert cached(bot.event_cache) == 1
+
+def test_participant_change_drops_its_event():
+    change('participants', 4)
+
+    assert cached(bot.event_cache) == 0
+    assert cached(bot.fighter_cache) == 1
+
+def test_unknown_table_is_ignored():
+    change('conversation_state', 4)
+
+    assert cached(bot.event_cache) == cached(bot.fighter_cache) == 1
@@ -0,0 +1,57 @@
+from datetime import datetime
+
+import bot
+
+def round_trip(view, key):
+    data = bot.page_callback_data(view, key)
+    assert len(data.encode('utf-8')) <= bot.CALLBACK_DATA_LIMIT
+    _, parsed_view, row_id, raw = data.split(':', 3)
+    return bot.parse_page_key(parsed_view, row_id, raw)
+
+def test_page_key_travels_in_callback_data():
+    assert round_trip('fighters', ('Ali Karimi', 17)) == ('Ali Karimi', 17)
+
+def test_long_name_falls_back_to_a_token():
+    name = 'محمدرضا ' * 10
+    assert bot.page_callback_data('gyms', (name, 3)).split(':')[3].startswith('~')
+    assert round_trip('gyms', (name, 3)) == (name, 3)
+
+def test_event_key_keeps_its_timestamp():
+    start = datetime(2024, 5, 1, 18, 30)
+    assert round_trip('events', (start, 9)) == (start, 9)
+
+def test_malformed_keys_are_rejected():
+    assert bot.parse_page_key('fighters', 'x', '=Ali') is None
+    assert bot.parse_page_key('fighters', '3', '~missing') is None
+    assert bot.parse_page_key('events', '3', '=not a date') is None
+
+class RowCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.connection = None
+        self.read = 0
+
+    def execute(self, query, params=None):
+        pass
+
+    def __iter__(self):
+        for row in self.rows:
+            self.read += 1
+            yield row
+
+def gym_rows(count):
+    return [(number, f'Gym {number:03d}', 'Tehran', 'Reza', 75, 0, 0) for number in range(1, count + 1)]
+
+def test_page_streams_rows_and_stops_at_the_look_ahead_row():
+    cursor = RowCursor(gym_rows(bot.LIST_PAGE_SIZE + 1))
+    text, next_key = bot.render_gyms_page(cursor, None)
+
+    last = bot.LIST_PAGE_SIZE
+    assert next_key == (f'Gym {last:03d}', last)
+    assert f'Gym {last + 1:03d}' not in text
+    assert cursor.read == bot.LIST_PAGE_SIZE + 1
+
+def test_last_page_has_no_next_key():
+    text, next_key = bot.render_gyms_page(RowCursor(gym_rows(2)), None)
+    assert 'Gym 002' in text and next_key is None
+    assert bot.render_gyms_page(RowCursor([]), None) == (None, None)
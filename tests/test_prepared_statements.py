@@ -0,0 +1,67 @@
+import pytest
+
+import bot
+
+class SessionCursor:
+    # Each transaction runs on server_sessions[n], the way a pooler would
+    # hand them out; PREPARE stores the name in whichever session it ran on.
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = None
+
+    def execute(self, query, params=None):
+        session = self.connection.session()
+        self.connection.log.append(query.split()[0])
+        words = query.split()
+        if words[0] == 'PREPARE':
+            session.add(words[1])
+        elif words[0] == 'DEALLOCATE':
+            session.discard(words[1])
+        elif words[0] == 'SELECT':
+            self.result = (params[0] in session,)
+
+    def fetchone(self):
+        return self.result
+
+    def close(self):
+        pass
+
+class SessionConnection:
+    def __init__(self, server_sessions):
+        self.server_sessions = server_sessions
+        self.transactions = 0
+        self.log = []
+
+    def session(self):
+        return self.server_sessions[self.transactions % len(self.server_sessions)]
+
+    def cursor(self):
+        return SessionCursor(self)
+
+    def commit(self):
+        self.transactions += 1
+
+@pytest.fixture(autouse=True)
+def prepared_state(monkeypatch):
+    monkeypatch.setitem(bot.prepared_state, 'enabled', True)
+
+def test_probe_keeps_prepared_statements_on_a_pinned_session():
+    session = set()
+    bot.probe_prepared_statements(SessionConnection([session]))
+
+    assert bot.prepared_state['enabled']
+    assert session == set()
+
+def test_probe_disables_prepared_statements_when_sessions_are_swapped():
+    connection = SessionConnection([set(), set()])
+    bot.probe_prepared_statements(connection)
+
+    assert not bot.prepared_state['enabled']
+    assert 'DEALLOCATE' not in connection.log
+
+def test_probe_is_skipped_when_prepared_statements_are_off(monkeypatch):
+    monkeypatch.setitem(bot.prepared_state, 'enabled', False)
+    connection = SessionConnection([set()])
+    bot.probe_prepared_statements(connection)
+
+    assert connection.log == []
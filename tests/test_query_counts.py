@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+CHAT_ID = 4242
+
+GYM_ROWS = [
+    (1, 'Alpha Gym', 'Tehran', 'Reza', 80, 12, 3),
+    (2, 'Beta Gym', 'Shiraz', 'Sara', 75, 4, 1),
+]
+
+class CountingCursor:
+    def __init__(self, rows, queries):
+        self.rows = rows
+        self.queries = queries
+        self.connection = SimpleNamespace()
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+        self._pending = list(self.rows)
+        self.rowcount = len(self._pending)
+
+    def fetchone(self):
+        return self._pending.pop(0) if self._pending else None
+
+    def fetchmany(self, size=1):
+        batch, self._pending = self._pending[:size], self._pending[size:]
+        return batch
+
+    def fetchall(self):
+        batch, self._pending = self._pending, []
+        return batch
+
+    def __iter__(self):
+        while self._pending:
+            yield self._pending.pop(0)
+
+    def close(self):
+        pass
+
+class CountingConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self.rows, self.queries)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def database(monkeypatch):
+    connection = CountingConnection(GYM_ROWS)
+    monkeypatch.setattr(bot, 'get_db_connection', lambda: connection)
+    # Whether pg_trgm is installed is looked up once per process; it is not
+    # part of any view's cost.
+    monkeypatch.setattr(bot, 'trigram_search', True)
+    return connection
+
+@pytest.fixture
+def sent(monkeypatch):
+    messages = []
+    monkeypatch.setattr(bot.outbound, 'enqueue', lambda chat_id, method, text, kwargs: messages.append(text))
+    bot.sessions.create(CHAT_ID)
+    yield messages
+    bot.sessions.delete(CHAT_ID)
+
+def message(text):
+    return SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID), text=text)
+
+def test_show_gyms_runs_one_query(database, sent):
+    bot.show_gyms(message('نمایش باشگاه‌ها'))
+
+    assert len(database.queries) == 1
+    assert 'Alpha Gym' in sent[-1] and 'Beta Gym' in sent[-1]
+
+def test_gym_search_runs_one_query(database, sent):
+    bot.process_gym_search(message('gym'))
+
+    assert len(database.queries) == 1
+    assert 'Alpha Gym' in sent[-1] and 'Beta Gym' in sent[-1]
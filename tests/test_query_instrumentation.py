@@ -0,0 +1,12 @@
+import bot
+
+def test_only_registered_queries_are_explained():
+    assert bot.explainable(f"EXECUTE {bot.FIGHTER_BY_ID} (5)")
+    assert bot.explainable(bot.prepared_queries[bot.GYM_BY_ID]['sql'])
+
+    assert not bot.explainable("SELECT pg_advisory_lock(7305118)")
+    assert not bot.explainable("SELECT nextval('fighter_fighter_id_seq')")
+    assert not bot.explainable("SELECT pg_notify('name_lookup', '{}')")
+    assert not bot.explainable("SELECT * FROM gym FOR SHARE")
+    assert not bot.explainable("EXECUTE unknown_statement (1)")
+    assert not bot.explainable("DELETE FROM gym WHERE gym_id = 1")
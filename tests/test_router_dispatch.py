@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import bot
+
+class CountingDict(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lookups = 0
+
+    def get(self, key, default=None):
+        self.lookups += 1
+        return super().get(key, default)
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        return super().__getitem__(key)
+
+def build_router(actions, called):
+    router = bot.UpdateRouter()
+    for number in range(actions):
+        router.text(f'action {number}')(lambda message, number=number: called.append(number))
+    return router
+
+def message(text):
+    return SimpleNamespace(chat=SimpleNamespace(id=1), text=text)
+
+def test_dispatch_is_one_lookup_however_many_actions():
+    for actions in (30, 300):
+        called = []
+        router = build_router(actions, called)
+        router.texts = CountingDict(router.texts)
+        # The last registered text is the worst case for a linear scan.
+        router.dispatch_message(message(f'action {actions - 1}'))
+
+        assert called == [actions - 1]
+        assert router.texts.lookups == 1
+
+def test_unrouted_text_is_one_lookup():
+    called = []
+    router = build_router(300, called)
+    router.texts = CountingDict(router.texts)
+    router.dispatch_message(message('something else'))
+
+    assert called == []
+    assert router.texts.lookups == 1
+
+def test_telebot_sees_one_handler_per_update_type():
+    assert len(bot.bot.message_handlers) == 1
+    assert len(bot.bot.callback_query_handlers) == 1
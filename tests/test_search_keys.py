@@ -0,0 +1,23 @@
+import bot
+
+def test_search_key_keeps_vowels():
+    assert bot.normalize_search_key('Ali') == 'ali'
+    assert bot.normalize_search_key('Amir') != bot.normalize_search_key('Omar')
+    assert len({bot.normalize_search_key(name) for name in ('Hossein', 'Hassan', 'Ehsan')}) == 3
+
+def test_search_key_folds_persian_spellings():
+    assert bot.normalize_search_key('علي') == bot.normalize_search_key('علی')
+    assert bot.normalize_search_key('محمد\u200cرضا') == bot.normalize_search_key('محمدرضا')
+    assert bot.normalize_search_key('  Ali-Reza! ') == 'alireza'
+
+def test_skeleton_key_bridges_scripts():
+    assert bot.normalize_skeleton_key('Mohammad') == bot.normalize_skeleton_key('محمد') == 'mhmd'
+
+def test_short_skeletons_are_not_matched(monkeypatch):
+    monkeypatch.setattr(bot, 'trigram_search', False)
+    where, rank, params = bot.build_search_filter(None, ['f.name'], 'Ali', 'f.search_key', 'f.search_skeleton')
+    assert 'f.search_skeleton' not in where
+
+    where, rank, params = bot.build_search_filter(None, ['f.name'], 'Mohammad', 'f.search_key', 'f.search_skeleton')
+    assert 'f.search_skeleton' in where
+    assert rank.startswith('CASE WHEN')